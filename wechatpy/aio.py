@@ -0,0 +1,568 @@
+""" Asyncio WeChatBot
+  AsyncWeChatBot runs the long-poll, the sends and the contact lookups
+  on one event loop, with bounded concurrency.
+
+    bot = AsyncWeChatBot()
+    asyncio.run(bot.run())
+"""
+
+import os
+import sys
+import json
+import time
+import asyncio
+import traceback
+
+import aiohttp
+
+from . import config
+from . import parsers
+from . import metrics
+from .media import Media
+from .profiling import profiled
+from .exception import WeChatBotError
+from .resolver import AsyncContactResolver
+from .policy import backoff, endpoint
+from .core import WeChatBot, SUCCESS, SCANNED, BAD_REQUEST, TIMEOUT
+
+
+def client_timeout(url, total=None):
+    """ `total` seconds, else (connect, read) of the endpoint of `url` from
+    `config.TIMEOUTS`, as the sync transport
+    """
+    if total is not None:
+        return aiohttp.ClientTimeout(total=total)
+    connect, read = config.TIMEOUTS.get(endpoint(url), config.DEFAULT_TIMEOUT)
+    return aiohttp.ClientTimeout(sock_connect=connect, sock_read=read)
+
+
+async def _stream(body):
+    for part in body:
+        yield part
+
+
+class AsyncMedia(Media):
+    """ `Media` on the loop of an `AsyncWeChatBot`, `upload`, `send_image`,
+    `send_file` and `download` are coroutines
+    """
+
+    def __init__(self, bot, workers=None):
+        super(AsyncMedia, self).__init__(bot, workers=workers)
+        self.semaphore = None
+
+    def data_ticket(self):
+        if self.bot.http is not None:
+            for cookie in self.bot.http.cookie_jar:
+                if cookie.key == 'webwx_data_ticket':
+                    return cookie.value
+        return ''
+
+    async def upload(self, path, to_user_name='filehelper'):
+        """ See `Media.upload` """
+        res = {}
+        for chunk, chunks, url, body, headers in self._upload_chunks(
+                path, to_user_name):
+            # a length, not a chunked body
+            headers['Content-Length'] = str(len(body))
+            res = await self.bot._post_res(
+                url=url, data=_stream(body), headers=headers)
+            if not self.bot.request_ok(res):
+                self.bot.log.error('Upload Error, %s chunk %d/%d: %s' % (
+                    path, chunk + 1, chunks, res.get('BaseResponse')))
+                return None
+        return res.get('MediaId')
+
+    async def _send(self, endpoint, msg):
+        url, data = self._send_request(endpoint, msg)
+        res = await self.bot._post_res(url=url, data=data)
+        ok = self.bot.request_ok(res)
+        self.bot._observe_sent(ok)
+        return ok
+
+    async def download(self, msg, path=None):
+        """ Stream the media of `msg` to `path`, `workers` at a time
+
+        :return: the path, None if the download failed or `msg` carries
+            no media
+        """
+        request = self._download_request(msg, path)
+        if request is None:
+            return None
+        if self.semaphore is None:
+            self.semaphore = asyncio.Semaphore(self.workers)
+        async with self.semaphore:
+            return await self._download(*request)
+
+    async def _download(self, url, params, headers, path):
+        await self.bot.open()
+        tmp = '%s.part' % path
+        try:
+            async with self.bot.http.get(
+                    url, params=params, headers=headers,
+                    timeout=client_timeout(url)) as r:
+                if r.status not in (200, 206):
+                    self.bot.log.error('Download Error, %s: HTTP %d' % (
+                        url, r.status))
+                    return None
+                with open(tmp, 'wb') as fp:
+                    async for chunk in r.content.iter_chunked(
+                            config.MEDIA_STREAM_CHUNK):
+                        fp.write(chunk)
+            os.replace(tmp, path)
+        except (aiohttp.ClientError, asyncio.TimeoutError, OSError) as e:
+            self.bot.log.error('Download Error, %s: %s' % (url, repr(e)))
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            return None
+        return path
+
+
+class AsyncWeChatBot(WeChatBot):
+    """"""
+
+    def __init__(self, auto_reload=True, store_backend=None,
+                 concurrency=config.AIO_CONCURRENCY):
+        super(AsyncWeChatBot, self).__init__(
+            auto_reload=auto_reload, store_backend=store_backend)
+        self.concurrency = concurrency
+        self.http = None
+        self._semaphore = None
+        self._contact_semaphore = None
+        self.resolver = AsyncContactResolver(self.add_new_contact)
+        self.media = AsyncMedia(self)
+
+    async def open(self):
+        if self.http is None:
+            connector = aiohttp.TCPConnector(limit=self.concurrency)
+            self.http = aiohttp.ClientSession(
+                connector=connector,
+                headers=config.HEADERS,
+                cookie_jar=aiohttp.CookieJar(unsafe=True),
+            )
+            self._semaphore = asyncio.Semaphore(self.concurrency)
+            self._contact_semaphore = asyncio.Semaphore(
+                config.BATCH_CONTACT_WORKERS)
+        return self.http
+
+    async def close(self):
+        if self.http is not None:
+            await self.http.close()
+            self.http = None
+
+    async def _get_res(self, reg=r'.*', url='', text='', params=None,
+                       headers=None, json_res=False, parser=None, timeout=None):
+        if text or not url:
+            return self._parse_res(reg, text, parser)
+        await self.open()
+        start = time.perf_counter()
+        try:
+            async with self.http.get(
+                    url, params=params, headers=headers,
+                    timeout=client_timeout(url, timeout)) as r:
+                raw = await r.read()
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            self._observe(url, start, False)
+            self.log.error('Get Res Error, %s' % repr(e))
+            return {}
+        self._observe(url, start, r.status < 400)
+        if json_res:
+            return parsers.loads(raw)
+        return self._parse_res(reg, raw.decode('utf-8', 'replace'), parser)
+
+    @profiled('_post_res')
+    async def _post_res(self, url='', data=None, content=None, headers=None):
+        if url:
+            await self.open()
+            default_headers = {
+                'ContentType': 'application/json; charset=UTF-8',
+            }
+            headers = headers if headers else default_headers
+            start = time.perf_counter()
+            try:
+                async with self._semaphore:
+                    async with self.http.post(
+                            url, data=data, headers=headers,
+                            timeout=client_timeout(url)) as r:
+                        content = await r.read()
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                content = ''
+                self.log.error('Post Res Error, %s' % repr(e))
+        res = self._decode_res(content)
+        if url:
+            self._observe(url, start, bool(content) and self.request_ok(res))
+        return res
+
+    async def init_uuid(self):
+        """"""
+        url = '{}/jslogin'.format(config.ROOT_URL)
+        params = {
+            'appid': config.APP_ID,
+            'fun': config.FUN,
+        }
+        uuid = (await self._get_res(
+            url=url, params=params, parser=parsers.parse_jslogin)).get('uuid')
+        self.cache.set('uuid', uuid)
+        return uuid
+
+    async def _pre_login(self):
+        self.log.info('Init uuid')
+        await self.init_uuid()
+        self.log.info('Gen QR Code')
+        self.gen_qr_code(
+            file_path=self.qr,
+            tty=self.tty,
+            email=self.email,
+        )
+        self.log.info('Waiting for Scan QR')
+
+    async def _process_login(self, login_res):
+        """"""
+        redirect_uri = parsers.parse_redirect_uri(login_res).get(
+            'redirect_uri')
+        async with self.http.get(redirect_uri, allow_redirects=False) as r:
+            text = await r.text(encoding='utf-8')
+        self._set_login_info(redirect_uri, text)
+        return str(r.status)
+
+    async def _await_login(self):
+        url = '{}/cgi-bin/mmwebwx-bin/login'.format(config.ROOT_URL)
+        local_time = int(time.time())
+        params = {
+            'loginicon': 'true',
+            'uuid': self.cache.uuid,
+            'tip': 0,
+            'r': local_time / 1579,
+            '_': local_time,
+        }
+        await self.open()
+        try:
+            async with self.http.get(url, params=params) as r:
+                text = await r.text(encoding='utf-8')
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            return BAD_REQUEST
+        data = parsers.parse_login(text)
+        status_code = data.get('code')
+        if data and status_code == SUCCESS:
+            await self._process_login(text)
+            return SUCCESS
+        elif data:
+            return status_code
+        else:
+            return BAD_REQUEST
+
+    async def login(self):
+        await self._pre_login()
+        retry = config.MAX_RETRY
+        while retry:
+            login_status = await self._await_login()
+            if login_status == SUCCESS:
+                self.log.info('Log in Success!')
+                break
+            elif login_status == SCANNED:
+                self.log.debug('Please Confirm Login On Your Phone')
+            elif login_status == TIMEOUT:
+                await asyncio.sleep(20)
+                self.log.debug(TIMEOUT + ' Time Out! Retrying %d' % retry)
+                await self._pre_login()
+                retry -= 1
+                self.log.debug('Retrying %d' % retry)
+                if not retry:
+                    self.log.error('Maximum Retries !!')
+                    sys.exit()
+        return await self._init_web()
+
+    async def _init_web(self):
+        url = '{}/webwxinit?r={}'.format(self.cache.ticket, int(time.time()))
+        data = {
+            'BaseRequest': self.cache.base_request
+        }
+        res = await self._post_res(url, data=json.dumps(data))
+        self.cache.set('self', res.get('User'))  # self info
+        self._update_sync_key(res.get('SyncKey'))
+        return self.request_ok(res)
+
+    async def status_notify(self):
+        url = '{}/webwxstatusnotify?lang=zh_CN&pass_ticket={}'.format(
+            self.cache.ticket, self.cache.pass_ticket
+        )
+        data = {
+            'BaseRequest': self.cache.base_request,
+            "Code": 3,
+            "FromUserName": self.cache.self.get('UserName'),
+            "ToUserName": self.cache.self.get('UserName'),
+            "ClientMsgId": int(time.time())
+        }
+        res = await self._post_res(url, data=json.dumps(data))
+        return self.request_ok(res)
+
+    async def batch_get_contacts(self, user_list):
+        """"""
+        url = '{}/webwxbatchgetcontact?type=ex&pass_ticket={}&r={}'.format(
+            self.cache.ticket,
+            self.cache.pass_ticket,
+            int(time.time()),
+        )
+        data = {
+            'BaseRequest': self.cache.base_request,
+            'Count': len(user_list),
+            'List': [
+                {
+                    'UserName': user.get('UserName', ''),
+                    'EncryChatRoomId': ''
+                }
+                for user in user_list
+            ]
+        }
+        return await self._post_res(url, data=json.dumps(data))
+
+    async def get_contacts(self):
+        """"""
+        url = '{}/webwxgetcontact?pass_ticket={}&skey={}&r={}'.format(
+            self.cache.ticket,
+            self.cache.pass_ticket,
+            self.cache.skey,
+            int(time.time()),
+        )
+        return await self._post_res(url, data=json.dumps({}))
+
+    async def _add_contact_chunk(self, user_list):
+        async with self._contact_semaphore:
+            res = await self.batch_get_contacts(user_list)
+        if not self.request_ok(res):
+            raise WeChatBotError(
+                'Batch Get Contacts Error, %s' % res.get('BaseResponse'))
+        ret = self._parse_contacts(res)
+        self._update_contact(ret)
+        return ret
+
+    async def add_new_contact(self, user_list, progress=None):
+        """ See `WeChatBot.add_new_contact` """
+        size = config.BATCH_CONTACT_SIZE
+        chunks = [user_list[i:i + size] for i in range(0, len(user_list), size)]
+        ret = {'chunks': len(chunks), 'done': 0, 'contacts': [], 'failed': []}
+
+        async def collect(chunk):
+            try:
+                ret['contacts'].extend(await self._add_contact_chunk(chunk))
+            except (WeChatBotError, Exception) as e:
+                ret['failed'].append((chunk, getattr(e, 'message', repr(e))))
+                self.log.error('Add Contacts Error, %d users: %s' % (
+                    len(chunk), ret['failed'][-1][1]))
+            ret['done'] += 1
+            self.log.debug('Add Contacts %d/%d' % (ret['done'], ret['chunks']))
+            if progress:
+                progress(ret)
+
+        await asyncio.gather(*[collect(chunk) for chunk in chunks])
+        return ret
+
+    async def get_members(self, group_user_name):
+        """ See `WeChatBot.get_members` """
+        members = self.store.members.get(group_user_name)
+        if members is None:
+            await self.resolver.resolve([group_user_name])
+            members = self.store.members.get(group_user_name)
+        return members or {}
+
+    async def _init_all_contacts(self, reconcile=False):
+        """ See `WeChatBot._init_all_contacts` """
+        stored = self.store.keys() if reconcile else ()
+        contacts = self._parse_contacts(await self.get_contacts(), 'MemberList')
+        self._update_contact(contacts)
+        self._drop_stale_contacts(stored, contacts)
+
+        group_list = self._get_group_list(contacts)
+        if group_list and not config.LAZY_MEMBERS:
+            await self.add_new_contact(group_list)
+        self.store.flush()
+
+    async def sync_check(self):
+        url = '{}/synccheck'.format(self.cache.sync_url)
+        params = {
+            'r': int(time.time() * 1000),
+            'skey': self.cache.skey,
+            'sid': self.cache.wxsid,
+            'uin': self.cache.wxuin,
+            'deviceid': self.cache.deviceid,
+            'synckey': self.cache.sync_key_str,
+            '_': int(time.time() * 1000),
+        }
+        res = await self._get_res(url=url, params=params,
+                                  parser=parsers.parse_synccheck,
+                                  timeout=config.AIO_SYNC_TIMEOUT)
+        return res.get('retcode', -1), res.get('selector', -1)
+
+    async def sync(self):
+        url = '{}/webwxsync?sid={}&skey={}&pass_ticket={}'.format(
+            self.cache.ticket, self.cache.wxsid, self.cache.skey,
+            self.cache.pass_ticket
+        )
+        data = {
+            'BaseRequest': self.cache.base_request,
+            'SyncKey': self.cache.sync_key,
+            'rr': ~int(time.time()),
+        }
+        res = await self._post_res(url=url, data=json.dumps(data))
+        if not self.request_ok(res):
+            return {}
+
+        self._update_sync_key(res.get('SyncCheckKey'))
+        return res
+
+    def _resolve_senders(self, msg_list):
+        """ Senders are resolved on the loop before `handle_msg` """
+
+    @profiled('receive_msg')
+    async def receive_msg(self, msg):
+        received = time.time()
+        unknown = self._unknown_senders(msg.get('AddMsgList') or [])
+        try:
+            if unknown:
+                await self.resolver.resolve(unknown)
+            msgs = self.handle_msg(msg)
+        except Exception:
+            self.log.error('Handle Msg Error:\n %s' % traceback.format_exc())
+        else:
+            self._deliver(msgs, received)
+
+    async def handle(self):
+        """"""
+
+    async def _proc_msg(self):
+        """ See `WeChatBot._proc_msg` """
+        adaptive = config.SYNC_MODE == 'adaptive'
+        retry = config.MAX_RETRY
+        errors = 0
+        while retry:
+            if self.sampler:
+                self.sampler.iteration()
+            sync_time = time.time()
+            retcode, selector = await self.sync_check()
+            metrics.SYNC_CHECKS.inc(
+                bot=self.name, retcode=retcode, selector=selector)
+            self.alive = True
+            if retcode == '0':
+                res = await self.sync() \
+                    if selector != '0' or not adaptive else {}
+                if res:
+                    self._apply_contact_deltas(res)
+                if adaptive:
+                    if selector != '0' and not res:
+                        errors += 1
+                    else:
+                        errors, retry = 0, config.MAX_RETRY
+                    if res.get('AddMsgList'):
+                        await self.receive_msg(res)
+                elif not res or selector == '0':
+                    await asyncio.sleep(1)
+                    continue
+                elif selector == '2':  # New msg
+                    await self.receive_msg(res)
+            elif retcode == -1:
+                # no response or the breaker is open, not a server verdict
+                errors += 1
+                self.log.debug('Sync Check Failed, Retrying')
+            elif retcode in {'1100', '1101'}:
+                retry -= 1
+                errors += 1
+                self.log.debug('Log out, Retrying')
+                if not retry:
+                    self.log.info('Log out')
+                    self.alive = False
+                    break
+            else:
+                self.log.debug(
+                    'Unknown Code %s, Retrying' % repr([retcode, selector]))
+                retry -= 1
+                errors += 1
+                if not retry:
+                    self.alive = False
+                    self.log.info(
+                        'Unkonwn Code %s, Log out' % repr([retcode, selector]))
+                    break
+            try:
+                await self.handle()  # Run every time sync
+            except Exception:
+                self.log.error(traceback.format_exc())
+
+            duration = time.time() - sync_time
+            if retcode == -1:
+                await asyncio.sleep(self._retry_delay(errors))
+            elif not adaptive:
+                if duration <= 20:
+                    await asyncio.sleep(1)
+            elif errors:
+                await asyncio.sleep(backoff(errors))
+            elif selector == '0' and duration < config.SYNC_MIN_INTERVAL:
+                await asyncio.sleep(config.SYNC_MIN_INTERVAL - duration)
+
+    async def run(self):
+        try:
+            await self.login()
+            await self.status_notify()
+            self.log.info('Hello %s' % self.cache.self.get('NickName', ''))
+            if self.store.warm(self.cache.wxsid):
+                self.log.info('Warm Start, %d contacts' % len(self.store))
+                asyncio.ensure_future(self._init_all_contacts(True))
+            else:
+                await self._init_all_contacts()
+            await self._proc_msg()
+        finally:
+            self.alive = False
+            self.dispatcher.shutdown(wait=False)
+            if self.sampler:
+                self.sampler.stop()
+            self.store.flush()
+            await self.close()
+
+    async def _send_msg(self, msg_content, to_user_name):
+        url = '{}/webwxsendmsg?pass_ticket={}'.format(
+            self.cache.ticket, self.cache.pass_ticket
+        )
+        data = self._send_msg_data(msg_content, to_user_name)
+        res = await self._post_res(url=url, data=data)
+        ok = self.request_ok(res)
+        self._observe_sent(ok)
+        return ok
+
+    @profiled('send_msg')
+    async def send_msg(self, msg_content, **kwargs):
+        user_list = self.store.select(**kwargs)
+        sent = await asyncio.gather(*[
+            self._send_msg(msg_content, user['UserName'])
+            for user in user_list
+        ])
+        return [int(ok) for ok in sent]
+
+    async def _send_media(self, path, send, **kwargs):
+        """ See `WeChatBot._send_media`, the sends run on the loop """
+        user_list = self.store.select(**kwargs)
+        if not user_list:
+            return []
+        media_id = await self.media.upload(path, user_list[0]['UserName'])
+        if not media_id:
+            self._observe_sent(False)
+            return [0] * len(user_list)
+        sent = await asyncio.gather(*[
+            send(media_id, user['UserName']) for user in user_list])
+        return [int(ok) for ok in sent]
+
+    async def broadcast(self, msg_content, recipients, workers=None):
+        """ See `WeChatBot.broadcast`, `workers` sends at a time on the loop """
+        url = '{}/webwxsendmsg?pass_ticket={}'.format(
+            self.cache.ticket, self.cache.pass_ticket
+        )
+        template = self._send_msg_template(msg_content)
+        ret, sends = self._broadcast_sends(recipients)
+        semaphore = asyncio.Semaphore(workers or config.BROADCAST_WORKERS)
+
+        async def send(recipient, user_name):
+            async with semaphore:
+                start = time.time()
+                res = await self._post_res(
+                    url=url, data=self._fill_msg_template(template, user_name))
+            return self._broadcast_result(recipient, user_name, res, start)
+
+        ret.extend(await asyncio.gather(*[
+            send(recipient, user_name) for recipient, user_name in sends]))
+        return ret
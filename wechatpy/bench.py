@@ -0,0 +1,466 @@
+""" Benchmarks
+  python -m wechatpy.bench [name ...]
+"""
+
+import sys
+import copy
+import time
+import threading
+import tracemalloc
+
+BENCHMARKS = {}
+
+
+def benchmark(func):
+    BENCHMARKS[func.__name__.replace('bench_', '')] = func
+    return func
+
+
+def measure(func, number):
+    """ Per call time (us) and peak allocation (bytes) of `func` """
+    start = time.perf_counter()
+    for _ in range(number):
+        func()
+    elapsed = time.perf_counter() - start
+
+    peak = 0
+    tracemalloc.start()
+    for _ in range(number):
+        tracemalloc.reset_peak()
+        before = tracemalloc.get_traced_memory()[0]
+        func()
+        peak += tracemalloc.get_traced_memory()[1] - before
+    tracemalloc.stop()
+    return elapsed / number * 1e6, peak / number
+
+
+def report(name, us, alloc=None):
+    line = '  {:<32} {:>10.2f} us'.format(name, us)
+    if alloc is not None:
+        line += ' {:>12.0f} B'.format(alloc)
+    print(line)
+
+
+def fake_members(size, offset=0):
+    return {
+        '@%064x' % i: {
+            'UserName': '@%064x' % i,
+            'NickName': 'member %d' % i,
+            'DisplayName': '',
+            'AttrStatus': 0,
+            'Uin': 0,
+            'MemberStatus': 0,
+            'KeyWord': '',
+        }
+        for i in range(offset, offset + size)
+    }
+
+
+def fake_group(user_name, size):
+    return {
+        'UserName': user_name,
+        'NickName': 'group %s' % user_name[-4:],
+        'ContactType': 2,
+        'MemberCount': size,
+    }
+
+
+def fake_group_msg(group_name, user_name, content='hello'):
+    return {
+        'MsgId': str(time.time()),
+        'MsgType': 1,
+        'FromUserName': group_name,
+        'ToUserName': '@self',
+        'Content': '%s:<br/>%s' % (user_name, content),
+        'CreateTime': int(time.time()),
+    }
+
+
+def _bot():
+    from .core import WeChatBot
+    return WeChatBot()
+
+
+@benchmark
+def bench_enrich(number=2000, members=500):
+    """ handle_msg group message enrichment, deep copies vs views """
+    bot = _bot()
+    group_name = '@@%064x' % 1
+    bot.store.update(group_name, fake_group(group_name, members))
+    bot.store.members.set(group_name, fake_members(members))
+    user_name = '@%064x' % (members // 2)
+
+    def deepcopy_enrich():
+        msg = fake_group_msg(group_name, user_name)
+        from_group = copy.deepcopy(bot.store.get(group_name)) or {}
+        members_ = copy.deepcopy(bot.store.members.get(group_name)) or {}
+        msg['FromGroup'] = from_group
+        msg['FromUser'] = copy.deepcopy(members_.get(user_name)) or {}
+        return msg
+
+    def view_enrich():
+        return bot.handle_msg({
+            'AddMsgList': [fake_group_msg(group_name, user_name)]})
+
+    print('enrich, %d member group, per message:' % members)
+    report('deepcopy (before)', *measure(deepcopy_enrich, number // 10))
+    report('handle_msg (views)', *measure(view_enrich, number))
+
+
+@benchmark
+def bench_members(groups=200, members=500, msgs=20000, budget=20000):
+    """ resident member memory of a 100k member account, all member maps
+    kept vs the `store.members` LRU, and its misses under skewed traffic
+    """
+    import random
+
+    def run(max_entries):
+        from .storage import MemberCache
+        bot = _bot()
+        bot.store.members = MemberCache(max_entries)
+        group_names = ['@@%064x' % i for i in range(groups)]
+        fetches = []
+
+        def fetch(user_list):
+            fetches.append(len(user_list))
+            for user in user_list:
+                i = group_names.index(user['UserName'])
+                bot.store.members.set(
+                    user['UserName'], fake_members(members, i * members))
+            return {'contacts': user_list}
+
+        bot.resolver.fetch = fetch
+        tracemalloc.start()
+        before = tracemalloc.get_traced_memory()[0]
+        for i, group_name in enumerate(group_names):
+            bot.store.update(group_name, fake_group(group_name, members))
+            bot.store.members.set(
+                group_name, fake_members(members, i * members))
+        resident = tracemalloc.get_traced_memory()[0] - before
+        tracemalloc.stop()
+
+        # a few busy groups, a long tail of quiet ones
+        rand = random.Random(0)
+        batch = [
+            fake_group_msg(
+                group_names[min(int(rand.paretovariate(1.2)) - 1, groups - 1)],
+                '@%064x' % 0)
+            for _ in range(msgs)
+        ]
+        start = time.perf_counter()
+        for i in range(0, msgs, 20):
+            bot.handle_msg({'AddMsgList': batch[i:i + 20]})
+        elapsed = time.perf_counter() - start
+        return resident, elapsed / msgs * 1e6, len(fetches)
+
+    print('members, %d groups of %d, %d messages:' % (
+        groups, members, msgs))
+    for name, max_entries in (('all kept (before)', groups * members),
+                              ('LRU, %d entries' % budget, budget)):
+        resident, us, fetches = run(max_entries)
+        print('  {:<32} {:>10.1f} MB {:>8.2f} us/msg {:>5} refetches'.format(
+            name, resident / 2 ** 20, us, fetches))
+
+
+def fake_contact(i):
+    """ A webwxgetcontact contact with all its fields """
+    return {
+        'Uin': 0, 'UserName': '@%064x' % i, 'NickName': 'friend %d' % i,
+        'HeadImgUrl': '/cgi-bin/mmwebwx-bin/webwxgeticon?seq=%d&username='
+                      '@%064x&skey=@crypt_fake' % (i, i),
+        'ContactFlag': 3, 'MemberCount': 0, 'MemberList': [],
+        'RemarkName': '', 'HideInputBarFlag': 0, 'Sex': 1,
+        'Signature': 'signature %d' % i, 'VerifyFlag': 0, 'OwnerUin': 0,
+        'PYInitial': 'FRIEND', 'PYQuanPin': 'friend%d' % i,
+        'RemarkPYInitial': '', 'RemarkPYQuanPin': '', 'StarFriend': 0,
+        'AppAccountFlag': 0, 'Statues': 0, 'AttrStatus': 33783999,
+        'Province': 'Province', 'City': 'City', 'Alias': '', 'SnsFlag': 17,
+        'UniFriend': 0, 'DisplayName': '', 'ChatRoomId': 0, 'KeyWord': '',
+        'EncryChatRoomId': '', 'IsOwner': 0,
+    }
+
+
+@benchmark
+def bench_records(contacts=20000, members=100000, msgs=20000):
+    """ resident memory of raw json dicts vs `records`, decoded from json
+    like the server responses
+    """
+    import json
+    from . import parsers
+    from .records import Contact, Member, Message
+
+    self_name = '@%064x' % 0
+    payloads = {
+        'contacts': json.dumps([fake_contact(i) for i in range(contacts)]),
+        'members': json.dumps(list(fake_members(members).values())),
+        'messages': json.dumps([
+            dict(fake_group_msg('@@%064x' % (i % 100), '@%064x' % i),
+                 ToUserName=self_name)
+            for i in range(msgs)]),
+    }
+
+    def resident(build):
+        tracemalloc.start()
+        before = tracemalloc.get_traced_memory()[0]
+        kept = build()
+        ret = tracemalloc.get_traced_memory()[0] - before
+        tracemalloc.stop()
+        del kept
+        return ret
+
+    print('records, resident memory:')
+    for name, record in (('contacts', Contact), ('members', Member),
+                         ('messages', Message)):
+        payload = payloads[name]
+        raw = resident(lambda: parsers.loads(payload))
+        compact = resident(
+            lambda: [record(data) for data in parsers.loads(payload)])
+        n = len(parsers.loads(payload))
+        print('  {:<10} {:>7} {:>10.0f} B dict {:>10.0f} B record'.format(
+            name, n, raw / n, compact / n))
+
+
+@benchmark
+def bench_parsers(number=20000):
+    """ protocol response parsers, per call regex vs parsers """
+    import re
+    import json
+    from . import parsers
+
+    jslogin = 'window.QRLogin.code = 200; window.QRLogin.uuid = "gYmgd1grLg==";'
+    login = ('window.code=200;\nwindow.redirect_uri="https://wx2.qq.com/'
+             'cgi-bin/mmwebwx-bin/webwxnewloginpage?ticket=A8qwapRV_lQ44viWM0'
+             'mZmnpm@qrticket_0&uuid=gYmgd1grLg==&lang=zh_CN&scan=1479978616";')
+    redirect = ('<error><ret>0</ret><message></message><skey>@crypt_14ae1b12'
+                '_f59314d1ca34ea2e6b4d2e8e5bfe7b30</skey><wxsid>sWnnPzmbCx5Sp'
+                'Ftg</wxsid><wxuin>1302760367</wxuin><pass_ticket>0J8QnAqy1b8'
+                'RFsx5Q%2FEd3lNpk2kOeM9u4RVqjRzr1fVzaFbO6fx5B8CDqLNWkL7o</pas'
+                's_ticket><isgrayscale>1</isgrayscale></error>')
+    synccheck = 'window.synccheck={retcode:"0",selector:"2"}'
+    content = '@%064x:<br/>hello, world' % 1
+    body = json.dumps({
+        'BaseResponse': {'Ret': 0, 'ErrMsg': ''},
+        'AddMsgList': [fake_group_msg('@@%064x' % 1, '@%064x' % i)
+                       for i in range(20)],
+    }).encode('utf-8')
+
+    def regex(reg, text):
+        return lambda: re.search(reg, text).groupdict()
+
+    def redirect_dom():
+        import xml.dom.minidom
+        ret = {}
+        for node in xml.dom.minidom.parseString(
+                redirect).documentElement.childNodes:
+            if node.childNodes:
+                ret[node.nodeName] = node.childNodes[0].data
+        return ret
+
+    cases = (
+        ('jslogin', regex(
+            r'window.QRLogin.code = (?P<code>\d+); window.QRLogin.uuid = '
+            r'"(?P<uuid>\S+?)";', jslogin),
+         lambda: parsers.parse_jslogin(jslogin)),
+        ('login', regex(r'window.code=(?P<code>\d+)', login),
+         lambda: parsers.parse_login(login)),
+        ('redirect', redirect_dom, lambda: parsers.parse_redirect(redirect)),
+        ('synccheck', regex(
+            r'window.synccheck={retcode:"(?P<retcode>\d+)",'
+            r'selector:"(?P<selector>\d+)"}', synccheck),
+         lambda: parsers.parse_synccheck(synccheck)),
+        ('group content', regex(
+            r'(?P<user_name>@\w+)(?:\:\<br\/\>)(?P<content>.*)', content),
+         lambda: parsers.parse_group_content(content)),
+        ('json', lambda: json.loads(body.decode('utf-8', 'replace')),
+         lambda: parsers.loads(body)),
+    )
+    print('parsers, per call (json backend: %s):' % parsers.JSON_BACKEND)
+    for name, before, after in cases:
+        report('%s (before)' % name, measure(before, number)[0])
+        report('%s (parsers)' % name, measure(after, number)[0])
+
+
+class _FakeBot(object):
+    """ A bot logged in to a FakeWeChatServer """
+
+    def __init__(self, bot_cls=None, bot_kwargs=None, **server_conf):
+        from . import config
+        from .core import WeChatBot
+        from .fake_server import FakeWeChatServer
+        from requests.adapters import HTTPAdapter
+
+        class Bot(bot_cls or WeChatBot):
+            def gen_qr_code(self, *args, **kwargs):
+                """"""
+
+        self.server = FakeWeChatServer(**server_conf).start()
+        self.root_url, config.ROOT_URL = config.ROOT_URL, self.server.url
+        self.bot = Bot(auto_reload=False, **(bot_kwargs or {}))
+        # every endpoint is on the one fake host, not only login
+        self.bot.session.mount(self.server.url, HTTPAdapter(
+            pool_connections=1, pool_maxsize=config.POOL_SIZES['index'],
+            pool_block=True))
+        self.thread = None
+
+    def login(self):
+        self.bot.login()
+        self.bot.status_notify()
+        self.bot._init_all_contacts()
+
+    def start(self):
+        self.thread = threading.Thread(target=self.bot._proc_msg)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def close(self):
+        from . import config
+        self.server.stop()
+        config.ROOT_URL = self.root_url
+
+
+@benchmark
+def bench_e2e(contacts=2000, groups=200, members=100, msgs=5000, sends=500,
+              latency=0.002):
+    """ login to ready, inbound msgs/s and outbound sends/s
+    against a local FakeWeChatServer
+    """
+    fake = _FakeBot(contacts=contacts, groups=groups, members=members,
+                    latency=latency, long_poll=1)
+    bot = fake.bot
+    print('e2e, %d contacts, %d groups of %d, %.0fms latency:' % (
+        contacts, groups, members, latency * 1e3))
+    try:
+        start = time.perf_counter()
+        fake.login()
+        elapsed = time.perf_counter() - start
+        print('  {:<32} {:>10.3f} s ({} contacts)'.format(
+            'login to ready', elapsed, len(bot.store)))
+
+        fake.start()
+        start = time.perf_counter()
+        fake.server.inject(msgs)
+        while bot.store.msgs.qsize() < msgs and fake.thread.is_alive():
+            time.sleep(0.001)
+        elapsed = time.perf_counter() - start
+        print('  {:<32} {:>10.0f} msgs/s'.format(
+            'inbound _proc_msg', bot.store.msgs.qsize() / elapsed))
+        bot.store.msgs.drain()
+
+        users = [user_name for user_name in list(fake.server.contacts)[:sends]]
+        start = time.perf_counter()
+        for user_name in users[:sends // 5]:
+            bot._send_msg('hello', user_name)
+        elapsed = time.perf_counter() - start
+        print('  {:<32} {:>10.0f} msgs/s'.format(
+            'outbound _send_msg', sends // 5 / elapsed))
+
+        start = time.perf_counter()
+        res = bot.broadcast('hello', users)
+        elapsed = time.perf_counter() - start
+        print('  {:<32} {:>10.0f} msgs/s ({} failed)'.format(
+            'outbound broadcast', len(res) / elapsed,
+            len([r for r in res if not r['ok']])))
+    finally:
+        fake.close()
+
+
+@benchmark
+def bench_mq(msgs=2000, recipients=5, contacts=500, latency=0.002):
+    """ queue to acked sends through a Listener on a FakeBroker, the
+    connections dropped halfway
+    """
+    import json
+    from .main import AssBot
+    from .listeners import Listener
+    from .fake_broker import FakeBroker
+    from .scheduler import SendScheduler
+
+    scheduler = SendScheduler(rate=1e6, capacity=1e6)
+    fake = _FakeBot(contacts=contacts, groups=0, latency=latency,
+                    long_poll=1, bot_cls=AssBot,
+                    bot_kwargs={'scheduler': scheduler})
+    bot = fake.bot
+    broker = FakeBroker()
+    listener = Listener({'room': bot.mq_forwarder}, ready=bot.mq_ready,
+                        connect=broker.connect)
+    print('mq, %d msgs to %d recipients, %.0fms latency:' % (
+        msgs, recipients, latency * 1e3))
+    try:
+        fake.login()
+        bot.alive = True
+        listener.start()
+        start = time.perf_counter()
+        for i in range(msgs):
+            users = [{'NickName': 'friend %d' % ((i + j) % contacts)}
+                     for j in range(recipients)]
+            broker.publish('room', json.dumps(
+                {'Content': 'hello %d' % i, 'ToUserList': users}),
+                message_id=str(i))
+        dropped = False
+        while broker.depth() or broker.unacked() or listener.stats()['inflight']:
+            if not dropped and broker.acked >= msgs // 2:
+                broker.drop()
+                dropped = True
+            time.sleep(0.005)
+        elapsed = time.perf_counter() - start
+        sent = len(fake.server.sent)
+        print('  {:<32} {:>10.0f} msgs/s'.format('published to acked',
+                                                 msgs / elapsed))
+        print('  {:<32} {:>10.0f} sends/s ({} sent, {} expected)'.format(
+            'sends', sent / elapsed, sent, msgs * recipients))
+        print('  {:<32} {}'.format('broker', broker.stats()))
+        print('  {:<32} {}'.format('listener', listener.stats()))
+    finally:
+        listener.stop()
+        scheduler.stop(wait=False)
+        fake.close()
+
+
+@benchmark
+def bench_import(modules=('wechatpy.core', 'wechatpy.main', 'wechatpy.aio'),
+                 top=4):
+    """ cold import time per module, `python -X importtime` in a fresh
+    interpreter, and its heaviest imports
+    """
+    import subprocess
+
+    print('import, cumulative ms:')
+    for module in modules:
+        proc = subprocess.run(
+            [sys.executable, '-X', 'importtime', '-c', 'import ' + module],
+            stderr=subprocess.PIPE, universal_newlines=True)
+        if proc.returncode:
+            print('  {:<16} failed, {}'.format(
+                module, proc.stderr.strip().splitlines()[-1]))
+            continue
+        # import time: self [us] | cumulative | imported package, children
+        # indented under and listed before their parent
+        children, total = [], None
+        for line in proc.stderr.splitlines():
+            fields = line.split('|')
+            if len(fields) != 3 or not fields[1].strip().isdigit():
+                continue
+            name = fields[2].rstrip()
+            depth = (len(name) - len(name.lstrip()) - 1) // 2
+            name = name.strip()
+            if depth == 0:
+                if name == module:
+                    total = int(fields[1])
+                    break
+                children = []
+            elif depth == 1:
+                children.append((int(fields[1]), name))
+        heaviest = sorted(children, reverse=True)[:top]
+        print('  {:<16} {:>8.1f}   {}'.format(
+            module, total / 1e3, ', '.join(
+                '%s %.1f' % (name, us / 1e3) for us, name in heaviest)))
+
+
+def main(names=None):
+    names = names or list(BENCHMARKS)
+    for name in names:
+        BENCHMARKS[name]()
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
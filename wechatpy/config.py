@@ -22,3 +22,101 @@ BEAT_URL = (
     ('web2.wechat.com', ('file.web2.wechat.com', 'webpush.web2.wechat.com')),
     ('wechat.com', ('file.web.wechat.com', 'webpush.web.wechat.com'))
 )
+
+# asyncio engine
+AIO_CONCURRENCY = 20
+AIO_SYNC_TIMEOUT = 35
+
+# webwxbatchgetcontact
+BATCH_CONTACT_SIZE = 50
+BATCH_CONTACT_WORKERS = 4
+
+# unknown sender lookups
+NEGATIVE_CONTACT_TTL = 60
+NEGATIVE_CONTACT_SIZE = 1024
+
+# group members, an LRU of member maps refetched on miss
+MEMBER_CACHE_SIZE = 50000  # members of all cached groups
+LAZY_MEMBERS = True  # fetch the members of a group on its first message
+
+# contact, member and message records keep the raw server json
+KEEP_RAW = False
+
+# transport
+POOL_SIZES = {
+    'login': 2,
+    'index': 10,
+    'file': 4,
+    'webpush': 2,
+}
+TIMEOUTS = {  # (connect, read) by endpoint
+    'synccheck': (5, 35),
+    'login': (5, 35),
+    'webwxuploadmedia': (5, 120),
+    'webwxgetmsgimg': (5, 120),
+    'webwxgetmedia': (5, 120),
+}
+DEFAULT_TIMEOUT = (5, 15)
+BACKOFF_BASE = 0.5
+BACKOFF_MAX = 10
+RETRY_BUDGET_RATIO = 0.2  # retries allowed per request
+RETRY_BUDGET_MAX = 10
+BREAKER_THRESHOLD = 5  # consecutive failures
+BREAKER_RESET = 30  # seconds before a half-open probe
+
+# send scheduler
+SEND_WORKERS = 8
+MAX_SEND_FREQUENCY = 10  # seconds between sends to one recipient
+SEND_BURST = 1
+SEND_BUCKETS_MAX = 10000
+
+# mq listeners
+MQ_HOST = 'localhost'
+MQ_CONSUMERS = 1  # connections per listener, each consuming every queue
+MQ_PREFETCH = 200  # unacked messages per connection
+MQ_BATCH_SIZE = 50  # messages handed to the scheduler at once
+MQ_BATCH_TIMEOUT = 0.1  # seconds before a partial batch is handed over
+MQ_RECONNECT_MAX = 30  # seconds between reconnects, at most
+MQ_DONE_SIZE = 10000  # handled messages remembered to ack redeliveries
+
+# broadcast
+BROADCAST_WORKERS = 8
+
+# persistent contact store
+STORE_PATH = os.path.join(BASE_DIR, 'contacts.sqlite3')
+STORE_COMMIT_EVERY = 500
+
+# media upload and download
+MEDIA_DIR = os.path.join(BASE_DIR, 'media')
+MEDIA_CHUNK_SIZE = 524288  # webwxuploadmedia chunk
+MEDIA_STREAM_CHUNK = 65536  # socket and disk writes
+MEDIA_WORKERS = 4  # concurrent downloads
+
+# session snapshot
+SESSION_PATH = '.session'
+SESSION_VERSION = 1
+SESSION_SAVE_INTERVAL = 60  # seconds between snapshots on sync key updates
+
+# inbound message queue
+MSG_QUEUE_SIZE = 10000
+MSG_QUEUE_POLICY = 'drop_oldest'  # block, drop_oldest, drop_newest
+MSG_DRAIN_SIZE = 500
+MSG_DEDUP_SIZE = 20000  # MsgIds remembered to drop webwxsync redeliveries
+MSG_DEDUP_WINDOW = 3600  # seconds a MsgId is remembered
+
+# message handlers
+HANDLER_WORKERS = 8
+DELAY_SAMPLES = 1024
+
+# sync loop
+SYNC_MODE = 'adaptive'  # adaptive, fixed
+SYNC_MIN_INTERVAL = 0.5  # seconds, for synccheck returning without long poll
+
+# metrics
+METRICS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+# sampling profiler
+PROFILE_FRACTION = 0.01  # of sync iterations
+PROFILE_INTERVAL = 0.005  # seconds between samples
+PROFILE_PATH = 'assbot.folded'
+PROFILE_FLUSH_EVERY = 10  # sampled iterations
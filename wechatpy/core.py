@@ -7,15 +7,23 @@ import copy
 import json
 import time
 import random
-import xml.dom.minidom
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
-import requests
-import pyqrcode
 import traceback
 
 from . import config
+from . import parsers
+from . import snapshot
+from . import metrics
+from .profiling import profiled, SamplingProfiler
 from .exception import WeChatBotError
 from .storage import Store, Cache
+from .policy import backoff, endpoint
+from .resolver import ContactResolver
+from .dispatch import Dispatcher
+from .media import Media
+from .records import Contact, Member, Message, EMPTY, intern
 
 import logging
 
@@ -27,35 +35,28 @@ BAD_REQUEST = '400'
 TIMEOUT = '408'
 
 
-class AssSession(requests.Session):
-
-    def post(self, url, data=None, json=None, **kwargs):
-        retry = config.MAX_RETRY
-        while retry:
-            try:
-                return super(AssSession, self).post(url, data, json, **kwargs)
-            except:
-                pass
-            retry -= 1
-
-    def get(self, url, **kwargs):
-        retry = config.MAX_RETRY
-        while retry:
-            try:
-                return super(AssSession, self).post(url, **kwargs)
-            except:
-                pass
-            retry -= 1
-
-
 class WeChatBot(object):
     """"""
 
-    def __init__(self, auto_reload=True):
+    def __init__(self, auto_reload=True, store_backend=None, session=None,
+                 dispatcher=None):
+        """
+        :param session: an `AssSession`, e.g. on adapters shared by bots
+        :param dispatcher: a `Dispatcher`, e.g. on a shared executor
+        """
         self.configure()
-        self.store = Store()
+        self.store = Store(backend=store_backend)
         self.cache = Cache()
-        self.session = AssSession()
+        if session is None:
+            from .transport import AssSession
+            session = AssSession()
+        self.session = session
+        self.resolver = ContactResolver(self.add_new_contact)
+        self.dispatcher = dispatcher or Dispatcher()
+        self.media = Media(self)
+        self.sampler = None
+        self.session_saved = 0
+        metrics.REGISTRY.collector(self._collect_metrics)
         self.auto_reload = auto_reload
         self.alive = False
         self.log = logging.getLogger('assbot')
@@ -65,6 +66,8 @@ class WeChatBot(object):
             'qr': os.path.join(config.BASE_DIR, 'qr.png'),
             'tty': 1,
             'email': None,
+            'name': 'assbot',
+            'session_path': config.SESSION_PATH,
         }
         for k, v in ret.items():
             setattr(self, k, v)
@@ -74,26 +77,67 @@ class WeChatBot(object):
         for k, v in conf.items():
             setattr(self, k, v)
 
+    def _collect_metrics(self):
+        metrics.MSG_QUEUE_DEPTH.set(self.store.msgs.qsize(), bot=self.name)
+        metrics.MSG_QUEUE_DROPPED.set(self.store.msgs.dropped, bot=self.name)
+        metrics.CONTACTS.set(len(self.store), bot=self.name)
+
+    @staticmethod
+    def _observe(url, start, ok):
+        name = endpoint(url)
+        metrics.REQUEST_LATENCY.observe(time.perf_counter() - start, endpoint=name)
+        if not ok:
+            metrics.REQUEST_ERRORS.inc(endpoint=name)
+
+    def _observe_sent(self, ok):
+        if ok:
+            metrics.MSGS_SENT.inc(bot=self.name)
+        else:
+            metrics.MSGS_SEND_FAILED.inc(bot=self.name)
+
+    @staticmethod
+    def _parse_res(reg, text, parser=None):
+        if parser:
+            return parser(text)
+        res = re.search(reg, text)
+        return res.groupdict() if res else {}
+
     def _get_res(self, reg=r'.*', url='', text='', params=None, headers=None,
-                 json_res=False):
+                 json_res=False, parser=None):
         res = None
         if text:
-            res = re.search(reg, text)
-            res = res.groupdict() if res else {}
+            res = self._parse_res(reg, text, parser)
         elif url:
             headers = headers if headers else config.HEADERS
+            start = time.perf_counter()
             r = self.session.get(url, params=params, headers=headers)
+            self._observe(url, start, bool(r))
             if not r:
                 res = {}
                 self.log.error('Get Res Error, No Response')
             elif json_res:
-                res = r.json()
+                res = parsers.loads(r.content)
             else:
                 r.encoding = 'utf-8'
-                res = re.search(reg, r.text)
-                res = res.groupdict() if res else {}
+                res = self._parse_res(reg, r.text, parser)
         return res
 
+    def _decode_res(self, content):
+        """ The json of a response, Ret -1004 if it is not json """
+        try:
+            return parsers.loads(content)
+        except Exception as e:
+            if isinstance(content, bytes):
+                content = content.decode('utf-8', 'replace')
+            return {
+                'Data': content,
+                'BaseResponse': {
+                    'Ret': -1004,
+                    'ErrMsg': 'Json load err: %s' % e,
+                },
+            }
+
+    @profiled('_post_res')
     def _post_res(self, url='', data=None, content=None, headers=None):
         if url:
             default_headers = copy.copy(config.HEADERS)
@@ -101,19 +145,13 @@ class WeChatBot(object):
                 'ContentType': 'application/json; charset=UTF-8',
             })
             headers = headers if headers else default_headers
+            start = time.perf_counter()
             r = self.session.post(url, data=data, headers=headers)
-            content = r.content.decode('utf-8', 'replace')
+            content = r.content if r is not None else b''
 
-        try:
-            res = json.loads(content)
-        except Exception as e:
-            res = {
-                'Data': content,
-                'BaseResponse': {
-                    'Ret': -1004,
-                    'ErrMsg': 'Json load err: %s' % e,
-                },
-            }
+        res = self._decode_res(content)
+        if url:
+            self._observe(url, start, r is not None and self.request_ok(res))
         return res
 
     def init_uuid(self):
@@ -123,9 +161,8 @@ class WeChatBot(object):
             'appid': config.APP_ID,
             'fun': config.FUN,
         }
-        reg = r'window.QRLogin.code = (?P<code>\d+); window.QRLogin.uuid = ' \
-              r'"(?P<uuid>\S+?)";'
-        uuid = self._get_res(reg, url, params=params).get('uuid')
+        uuid = self._get_res(
+            url=url, params=params, parser=parsers.parse_jslogin).get('uuid')
         self.cache.set('uuid', uuid)
         return uuid
 
@@ -135,15 +172,25 @@ class WeChatBot(object):
     def email_info(self, info):
         """"""
 
+    def render_qr(self, url, file_path=None, tty=None, scale=8):
+        """ The QR of `url` as terminal text if `tty`, else a png at
+        `file_path`. pyqrcode is imported here, on the first QR login
+        """
+        import pyqrcode
+        qr = pyqrcode.create(url)
+        if tty:
+            return qr.terminal(quiet_zone=tty)
+        qr.png(file=file_path, scale=scale)
+
     def gen_qr_code(self, file_path='', tty=None, scale=8, email=None):
         """"""
         url = '{}/l/{}'.format(config.ROOT_URL, self.cache.uuid)
-        qr = pyqrcode.create(url)
         if tty:
-            return self.log.debug('Please Scan QR\n' + qr.terminal(quiet_zone=tty))
+            return self.log.debug(
+                'Please Scan QR\n' + self.render_qr(url, tty=tty))
 
         file_path = file_path if file_path else self.qr
-        qr.png(file=file_path, scale=scale)
+        self.render_qr(url, file_path=file_path, scale=scale)
 
         if email and os.path.isfile(file_path):
             self.email_qr(file_path)
@@ -204,68 +251,180 @@ class WeChatBot(object):
             - 2: group
             - 3: friend
         """
-        if contact.get('VerifyFlag', '') & 8 != 0:
+        if (contact.get('VerifyFlag') or 0) & 8 != 0:
             return 1
-        if contact.get('UserName', '').startswith('@@'):
+        user_name = contact.get('UserName') or ''
+        if user_name.startswith('@@'):
             return 2
-        if contact.get('UserName').startswith('@'):
+        if user_name.startswith('@'):
             return 3
         return 0
 
-    def _get_group_list(self, member_list):
-        return list(filter(
-            lambda x: self.contact_type(x) == 2,
-            member_list
-        ))
+    def _get_group_list(self, contacts):
+        return [
+            contact for contact in contacts if contact['ContactType'] == 2
+        ]
 
-    def _update_contact(self, user_list):
-        for user in user_list:
-            user_name = user.get('UserName')
-            if not user_name:
+    def _update_contact(self, contacts):
+        for contact in contacts:
+            self.store.update(contact['UserName'], contact)
+
+    def _set_members(self, group_user_name, member_list):
+        members = {}
+        for member in member_list:
+            member = Member(member)
+            members[member.UserName] = member
+        self.store.members.set(group_user_name, members)
+
+    def _parse_contacts(self, res, key='ContactList'):
+        """ `Contact` records, typed once here. Group `MemberList`s go to
+        the `store.members` LRU, a group without `MemberList` keeps the
+        members already cached
+        """
+        ret = []
+        for user in res.get(key) or []:
+            if not isinstance(user, dict) or not user.get('UserName'):
                 self.log.debug('Wrong User %s' % repr(user))
                 continue
-            user.update(ContactType=self.contact_type(user))
-            self.store.update(user_name, user)
+            try:
+                contact = Contact(user, self.contact_type(user))
+            except (TypeError, ValueError) as e:
+                self.log.error('Wrong User %s: %s' % (repr(user), repr(e)))
+                continue
+            if contact.ContactType == 2:
+                member_list = user.get('MemberList')
+                if member_list:
+                    self._set_members(contact.UserName, member_list)
+            ret.append(contact)
+        return ret
+
+    def get_members(self, group_user_name):
+        """ {member UserName: member} of a group, fetched if not cached """
+        members = self.store.members.get(group_user_name)
+        if members is None:
+            self.resolver.resolve([group_user_name])
+            members = self.store.members.get(group_user_name)
+        return members or {}
+
+    def _apply_contact_deltas(self, res):
+        """ Apply webwxsync contact deltas to the store
+            - ModContactList: new or changed contacts
+            - DelContactList: removed contacts
+            - ModChatRoomMemberList: groups with a new MemberList
+        """
+        self._update_contact(self._parse_contacts(res, 'ModContactList'))
+        for contact in res.get('DelContactList') or []:
+            if isinstance(contact, dict) and contact.get('UserName'):
+                self.store.delete(contact['UserName'])
+        for room in res.get('ModChatRoomMemberList') or []:
+            if not isinstance(room, dict):
+                continue
+            user_name = room.get('UserName')
+            if self.store.get(user_name) is None or 'MemberList' not in room:
+                continue
+            self._set_members(user_name, room['MemberList'])
 
-    def add_new_contact(self, user_list):
+    def _add_contact_chunk(self, user_list):
+        res = self.batch_get_contacts(user_list)
+        if not self.request_ok(res):
+            raise WeChatBotError(
+                'Batch Get Contacts Error, %s' % res.get('BaseResponse'))
+        ret = self._parse_contacts(res)
+        self._update_contact(ret)
+        return ret
+
+    def add_new_contact(self, user_list, progress=None):
         """ Add new contact
         For example: groups not in contacts
 
+        `user_list` is fetched in chunks of `config.BATCH_CONTACT_SIZE`,
+        `config.BATCH_CONTACT_WORKERS` at a time, each chunk is merged into
+        the store as soon as it arrives.
+
         :param user_list: [{'UserName': '@....'}]
+        :param progress: callback(ret) after every chunk
+        :return: {
+        'chunks': 2,
+        'done': 2,
+        'contacts': [{'UserName': '@...', ...}, ...],
+        'failed': [([{'UserName': '@...'}, ...], 'error'), ...],
+        }
         """
-        res = self.batch_get_contacts(user_list)
-        contact_list = res.get('ContactList')
-        ret = []
-        for contact in contact_list:
-            if self.contact_type(contact) == 2:
-                member_list = contact.pop('MemberList')
-                members = {}
-                for member in member_list:
-                    members[member.get('UserName')] = member
-                contact['Members'] = members
-            ret.append(contact)
-        self._update_contact(ret)
+        size = config.BATCH_CONTACT_SIZE
+        chunks = [user_list[i:i + size] for i in range(0, len(user_list), size)]
+        ret = {'chunks': len(chunks), 'done': 0, 'contacts': [], 'failed': []}
 
-    def _init_all_contacts(self):
-        """"""
-        contacts = self.get_contacts()
-        member_list = contacts.get('MemberList')
-        self._update_contact(member_list)
+        def collect(chunk, fetch):
+            try:
+                ret['contacts'].extend(fetch())
+            except (WeChatBotError, Exception) as e:
+                ret['failed'].append((chunk, getattr(e, 'message', repr(e))))
+                self.log.error('Add Contacts Error, %d users: %s' % (
+                    len(chunk), ret['failed'][-1][1]))
+            ret['done'] += 1
+            self.log.debug('Add Contacts %d/%d' % (ret['done'], ret['chunks']))
+            if progress:
+                progress(ret)
+
+        if len(chunks) <= 1:
+            for chunk in chunks:
+                collect(chunk, lambda: self._add_contact_chunk(chunk))
+            return ret
+
+        workers = min(config.BATCH_CONTACT_WORKERS, len(chunks))
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = {
+                executor.submit(self._add_contact_chunk, chunk): chunk
+                for chunk in chunks
+            }
+            for future in as_completed(futures):
+                collect(futures[future], future.result)
+        return ret
 
-        group_list = self._get_group_list(member_list)
-        if group_list:
+    def _drop_stale_contacts(self, stored, contacts):
+        """ Delete the `stored` keys missing from `contacts`, a fresh
+        webwxgetcontact. Groups are kept, unsaved groups are only known
+        from webwxbatchgetcontact.
+        """
+        fresh = {contact['UserName'] for contact in contacts}
+        stale = [key for key in stored
+                 if key not in fresh and not key.startswith('@@')]
+        for key in stale:
+            self.store.delete(key)
+        if stale:
+            self.log.info('Dropped %d stale contacts' % len(stale))
+
+    def _init_all_contacts(self, reconcile=False):
+        """ :param reconcile: also drop the stored contacts the server
+        no longer lists, for warm starts
+        """
+        stored = self.store.keys() if reconcile else ()
+        contacts = self._parse_contacts(self.get_contacts(), 'MemberList')
+        self._update_contact(contacts)
+        self._drop_stale_contacts(stored, contacts)
+
+        group_list = self._get_group_list(contacts)
+        if group_list and not config.LAZY_MEMBERS:
             self.add_new_contact(group_list)
+        self.store.flush()
+
+    def _warm_start(self):
+        """ Contacts of a resumed session are served from the store backend
+        while they are reconciled with the server in the background
+        """
+        if not self.store.warm(self.cache.wxsid):
+            return False
+        self.log.info('Warm Start, %d contacts' % len(self.store))
+        t = threading.Thread(target=self._init_all_contacts, args=(True, ))
+        t.daemon = True
+        t.start()
+        return True
 
-    def _set_base_request_info(self, node):
+    def _set_base_request_info(self, info):
         """"""
-        if node.nodeName == 'skey':
-            self.cache.set('skey', node.childNodes[0].data)
-        elif node.nodeName == 'wxsid':
-            self.cache.set('wxsid', node.childNodes[0].data)
-        elif node.nodeName == 'wxuin':
-            self.cache.set('wxuin', node.childNodes[0].data)
-        elif node.nodeName == 'pass_ticket':
-            self.cache.set('pass_ticket', node.childNodes[0].data)
+        for key in ('skey', 'wxsid', 'wxuin', 'pass_ticket'):
+            if info.get(key):
+                self.cache.set(key, info[key])
         base_request = {
             'Skey': self.cache.skey,
             'Sid': self.cache.wxsid,
@@ -277,19 +436,20 @@ class WeChatBot(object):
 
     def _process_login(self, login_res):
         """"""
-        reg = r'window.redirect_uri="(?P<redirect_uri>\S+)";'
-        redirect_uri = self._get_res(reg, text=login_res).get('redirect_uri')
+        redirect_uri = parsers.parse_redirect_uri(login_res).get(
+            'redirect_uri')
 
         r = self.session.get(
             redirect_uri, headers=config.HEADERS, allow_redirects=False
         )
-        child_nodes = xml.dom.minidom.parseString(
-            r.text
-        ).documentElement.childNodes
-        for node in child_nodes:
-            if not node.childNodes:
-                continue
-            self._set_base_request_info(node)
+        if r is None:
+            return BAD_REQUEST
+        self._set_login_info(redirect_uri, r.text)
+        return str(r.status_code)
+
+    def _set_login_info(self, redirect_uri, redirect_res):
+        """"""
+        self._set_base_request_info(parsers.parse_redirect(redirect_res))
 
         self.cache.set('ticket', redirect_uri[:redirect_uri.rfind('/')])
         self.cache.set('deviceid', 'e' + str(random.random())[2:17])
@@ -303,7 +463,6 @@ class WeChatBot(object):
                 break
         else:
             self.cache.file_url = self.cache.sync_url = self.cache.ticket
-        return str(r.status_code)
 
     def _await_login(self):
         url = '{}/cgi-bin/mmwebwx-bin/login'.format(config.ROOT_URL)
@@ -316,7 +475,9 @@ class WeChatBot(object):
             '_': local_time,
         }
         r = self.session.get(url, params=params, headers=config.HEADERS)
-        data = self._get_res(r'window.code=(?P<code>\d+)', text=r.text)
+        if r is None:
+            return BAD_REQUEST
+        data = parsers.parse_login(r.text)
         status_code = data.get('code')
         if data and status_code == SUCCESS:
             self._process_login(r.text)
@@ -356,6 +517,8 @@ class WeChatBot(object):
     def _update_sync_key(self, sync_key_dict):
         self.cache.set('sync_key', sync_key_dict)
         self.cache.set('sync_key_str', self._synckey_str(sync_key_dict))
+        if time.time() - self.session_saved >= config.SESSION_SAVE_INTERVAL:
+            self.save_session()
 
     def _init_web(self):
         url = '{}/webwxinit?r={}'.format(self.cache.ticket, int(time.time()))
@@ -378,25 +541,44 @@ class WeChatBot(object):
         )
         self.log.info('Waiting for Scan QR')
 
-    def push_login(self):
-        # cookies_dict = self.session.cookies.get_dict()
-        # TODO:
-        return False
-        if not self.cache.load('.cookies'):
+    def save_session(self):
+        """ Snapshot the session to `self.session_path`, once logged in """
+        if not self.cache.sync_key:
+            return
+        self.session_saved = time.time()
+        try:
+            snapshot.dump(self.cache, self.session.cookies, self.session_path)
+        except OSError as e:
+            self.log.error('Save Session Error, %s' % repr(e))
+
+    def resume(self):
+        """ Resume the snapshot session if the server still accepts it """
+        saved = snapshot.load(self.session_path)
+        if not saved:
             return False
+        snapshot.restore(saved, self.cache, self.session.cookies)
+        retcode, _ = self.sync_check()
+        return retcode == '0'
 
-        # mmwebwx-bin/webwxpushloginurl?uin=1302760367
-        url = '{}/cgi-bin/mmwebwx-bin/webwxpushloginurl?uin={}'.format(
+    def push_login(self):
+        """ Ask the phone to confirm the login of the snapshot account """
+        if not (self.cache.ticket and self.cache.wxuin):
+            return False
+        url = '{}/webwxpushloginurl?uin={}'.format(
             self.cache.ticket,
             self.cache.wxuin
         )
-        res = self._get_res(url=url, json_res=True)
-        request_ok = self.request_ok(res) and 'uuid' in res
+        res = self._get_res(url=url, json_res=True) or {}
+        request_ok = str(res.get('ret')) == '0' and 'uuid' in res
         if request_ok:
             self.cache.set('uuid', res.get('uuid'))
         return request_ok
 
     def login(self):
+        """ Resume the snapshot session, else push login, else QR login """
+        if self.auto_reload and self.resume():
+            self.log.info('Session Resumed')
+            return True
         if self.auto_reload and self.push_login():
             self.email_info(' Push Login, Please Confirm login On Your Phone')
             self.log.info(' Push Login, Please Confirm login On Your Phone')
@@ -443,9 +625,8 @@ class WeChatBot(object):
             'synckey': self.cache.sync_key_str,
             '_': int(time.time() * 1000),
         }
-        reg = r'window.synccheck={retcode:"(?P<retcode>\d+)",' \
-              r'selector:"(?P<selector>\d+)"}'
-        res = self._get_res(reg, url=url, params=params)
+        res = self._get_res(
+            url=url, params=params, parser=parsers.parse_synccheck)
         return res.get('retcode', -1), res.get('selector', -1)
 
     def sync(self):
@@ -465,67 +646,149 @@ class WeChatBot(object):
         self._update_sync_key(res.get('SyncCheckKey'))
         return res
 
+    def enable_profiling(self, fraction=None, interval=None, path=None):
+        """ Sample the stacks of a `fraction` of the sync iterations into
+        collapsed stacks at `path`, see `SamplingProfiler`
+        """
+        self.sampler = SamplingProfiler(
+            fraction=fraction, interval=interval, path=path)
+        return self.sampler
+
+    def on(self, **kwargs):
+        """ Register a message handler, see `Dispatcher.register` """
+        return self.dispatcher.register(**kwargs)
+
     def handle(self):
         """"""
 
+    def _unknown_senders(self, msg_list):
+        """ Senders not in the store, and groups without cached members """
+        return [
+            msg['FromUserName'] for msg in msg_list
+            if not self.store.get(msg['FromUserName']) or (
+                msg['FromUserName'].startswith('@@') and
+                msg['FromUserName'] not in self.store.members)
+        ]
+
+    def _resolve_senders(self, msg_list):
+        unknown = self._unknown_senders(msg_list)
+        if unknown:
+            self.resolver.resolve(unknown)
+
+    def _new_msgs(self, msg_list):
+        """ `msg_list` without the MsgIds already received """
+        if not msg_list:
+            return msg_list
+        seen = self.store.seen.seen
+        new = [msg for msg in msg_list
+               if msg.get('MsgId') is None or not seen(msg['MsgId'])]
+        if len(new) < len(msg_list):
+            metrics.MSGS_DUPLICATE.inc(len(msg_list) - len(new), bot=self.name)
+        return new
+
+    @profiled('handle_msg')
     def handle_msg(self, msg):
         """
+        `Message` records, `FromUser` and `FromGroup` are the stored
+        records, not copies.
+
         :param msg:
         :return:
         """
-        msg_list = msg.get('AddMsgList')
+        msg_list = self._new_msgs(msg.get('AddMsgList'))
         if not msg_list:
             return {}
+        self._resolve_senders(msg_list)
         ret = list()
         for msg in msg_list:
-            from_user_name = msg['FromUserName']
-            if not self.store.get(from_user_name):
-                self.add_new_contact([{'UserName': from_user_name}])
+            msg = Message(msg)
+            from_user_name = msg.FromUserName
             if from_user_name.startswith('@@'):
                 # {'Content':
                 # '@75c2dc6b639c5a00068791bbbcbad88b7d1797eaa3d5038920db5d802146b30a:<br/>BB'}
-                reg = r'(?P<user_name>@\w+)(?:\:\<br\/\>)(?P<content>.*)'
-                res = re.search(reg, msg.get('Content', ''))
-                res_dict = res.groupdict() if res else {
-                    'content': msg.get('Content')}
-                msg['FromUserName'], msg['Content'] = res_dict.get(
-                    'user_name'), res_dict.get('content')
-                from_group = copy.deepcopy(
-                    self.store.get(from_user_name)) or {}
-                members = from_group.pop('Members', {})
-                msg['FromGroup'] = from_group
-                msg['FromUser'] = copy.deepcopy(
-                    members.get(msg['FromUserName'])) or {}
+                user_name, msg.Content = \
+                    parsers.parse_group_content(msg.Content or '')
+                # system notices carry no sender, FromUserName is None
+                msg.FromUserName = intern(user_name) if user_name else None
+                members = self.store.members.get(from_user_name) or {}
+                msg.FromGroup = self.store.get(from_user_name) or EMPTY
+                msg.FromUser = members.get(msg.FromUserName) or EMPTY
             else:
-                msg['FromUser'] = self.store.get(msg['FromUserName'])
+                msg.FromUser = self.store.get(from_user_name)
             ret.append(msg)
         return ret
 
+    @profiled('receive_msg')
     def receive_msg(self, msg):
+        received = time.time()
         try:
             msgs = self.handle_msg(msg)
         except:
             self.log.error('Handle Msg Error:\n %s' % traceback.format_exc())
         else:
-            for msg in msgs:
+            self._deliver(msgs, received)
+
+    def _deliver(self, msgs, received=None):
+        """ Messages go to their registered handlers, or to `store.msgs` """
+        metrics.MSGS_RECEIVED.inc(len(msgs), bot=self.name)
+        for msg in msgs:
+            msg['ReceiveTime'] = received or time.time()
+            if not self.dispatcher.dispatch(msg):
                 self.store.msgs.put(msg)
 
+    def _retry_delay(self, errors):
+        """ Backoff after failed sync checks, at least until the breaker
+        of the sync host lets a probe through
+        """
+        retry_after = getattr(self.session, 'retry_after', None)
+        wait = retry_after(self.cache.sync_url or '') if retry_after else 0
+        return max(backoff(errors), wait)
+
     def _proc_msg(self):
+        """ Sync loop
+
+        * fixed: sleep a second after every short iteration
+        * adaptive: re-sync at once while the server reports data, a
+          synccheck return is the wake signal, back off only on errors
+
+        Only server retcodes count towards logging out, a synccheck without
+        response backs off until the host breaker lets a probe through.
+        """
+        adaptive = config.SYNC_MODE == 'adaptive'
         retry = config.MAX_RETRY
+        errors = 0
         while retry:
+            if self.sampler:
+                self.sampler.iteration()
             sync_time = time.time()
             retcode, selector = self.sync_check()
+            metrics.SYNC_CHECKS.inc(
+                bot=self.name, retcode=retcode, selector=selector)
             self.alive = True
             # self.log.info('alive')
             if retcode == '0':
-                res = self.sync()
-                if not res or selector == '0':
+                res = self.sync() if selector != '0' or not adaptive else {}
+                if res:
+                    self._apply_contact_deltas(res)
+                if adaptive:
+                    if selector != '0' and not res:
+                        errors += 1
+                    else:
+                        errors, retry = 0, config.MAX_RETRY
+                    if res.get('AddMsgList'):
+                        self.receive_msg(res)
+                elif not res or selector == '0':
                     time.sleep(1)
                     continue
-                if selector == '2':  # New msg
+                elif selector == '2':  # New msg
                     self.receive_msg(res)
+            elif retcode == -1:
+                # no response or the breaker is open, not a server verdict
+                errors += 1
+                self.log.debug('Sync Check Failed, Retrying')
             elif retcode in {'1100', '1101'}:
                 retry -= 1
+                errors += 1
                 self.log.debug('Log out, Retrying')
                 if not retry:
                     self.log.info('Log out')
@@ -535,6 +798,7 @@ class WeChatBot(object):
                 self.log.debug(
                     'Unknown Code %s, Retrying' % repr([retcode, selector]))
                 retry -= 1
+                errors += 1
                 if not retry:
                     self.alive = False
                     self.log.info(
@@ -546,17 +810,34 @@ class WeChatBot(object):
                 self.log.error(traceback.format_exc())
 
             duration = time.time() - sync_time
-            if duration <= 20:
-                time.sleep(1)
+            if retcode == -1:
+                time.sleep(self._retry_delay(errors))
+            elif not adaptive:
+                if duration <= 20:
+                    time.sleep(1)
+            elif errors:
+                time.sleep(backoff(errors))
+            elif selector == '0' and duration < config.SYNC_MIN_INTERVAL:
+                # synccheck returned nothing without long polling
+                time.sleep(config.SYNC_MIN_INTERVAL - duration)
 
     def run(self):
-        self.login()
-        self.status_notify()
-        self.log.info('Hello %s' % self.cache.self.get('NickName', ''))
-        self.cache.dump('.cookies')
-        self._init_all_contacts()
-        self._proc_msg()
-        self.alive = False
+        try:
+            self.login()
+            self.status_notify()
+            self.log.info('Hello %s' % self.cache.self.get('NickName', ''))
+            self.save_session()
+            if not self._warm_start():
+                self._init_all_contacts()
+            self._proc_msg()
+        finally:
+            self.alive = False
+            self.dispatcher.shutdown(wait=False)
+            self.media.shutdown(wait=False)
+            if self.sampler:
+                self.sampler.stop()
+            self.store.flush()
+            self.save_session()
 
     @staticmethod
     def gen_msgid():
@@ -564,29 +845,139 @@ class WeChatBot(object):
                  str(random.random())[:5].replace('.', '')
         return msg_id
 
-    def _send_msg(self, msg_content, to_user_name):
-        url = '{}/webwxsendmsg?pass_ticket={}'.format(
-            self.cache.ticket, self.cache.pass_ticket
-        )
-        msg_id = self.gen_msgid()
+    def _send_msg_template(self, msg_content):
+        """ Encoded webwxsendmsg payload, `%` slots for
+        ToUserName, LocalID and ClientMsgId
+        """
         data = {
             'BaseRequest': self.cache.base_request,
             'Msg': {
                 "Type": 1,
                 "Content": msg_content,
                 "FromUserName": self.cache.self['UserName'],
-                "ToUserName": to_user_name,
-                "LocalID": msg_id,
-                "ClientMsgId": msg_id
             }
         }
         data = json.dumps(data, ensure_ascii=False).encode('utf8')
+        return data[:-2].replace(b'%', b'%%') + \
+            b', "ToUserName": %s, "LocalID": "%s", "ClientMsgId": "%s"}}'
+
+    def _fill_msg_template(self, template, to_user_name):
+        msg_id = self.gen_msgid().encode('utf8')
+        to_user_name = json.dumps(to_user_name).encode('utf8')
+        return template % (to_user_name, msg_id, msg_id)
+
+    def _send_msg_data(self, msg_content, to_user_name):
+        return self._fill_msg_template(
+            self._send_msg_template(msg_content), to_user_name)
+
+    def _send_msg(self, msg_content, to_user_name):
+        url = '{}/webwxsendmsg?pass_ticket={}'.format(
+            self.cache.ticket, self.cache.pass_ticket
+        )
+        data = self._send_msg_data(msg_content, to_user_name)
         res = self._post_res(url=url, data=data)
-        return self.request_ok(res)
+        ok = self.request_ok(res)
+        self._observe_sent(ok)
+        return ok
 
+    @profiled('send_msg')
     def send_msg(self, msg_content, **kwargs):
         user_list = self.store.select(**kwargs)
         ret = list()
         for user in user_list:
             ret.append(int(self._send_msg(msg_content, user['UserName'])))
         return ret
+
+    def _send_media(self, path, send, **kwargs):
+        """ Upload `path` once, send it to the users selected by `kwargs` """
+        user_list = self.store.select(**kwargs)
+        if not user_list:
+            return []
+        media_id = self.media.upload(path, user_list[0]['UserName'])
+        if not media_id:
+            self._observe_sent(False)
+            return [0] * len(user_list)
+        return [int(send(media_id, user['UserName'])) for user in user_list]
+
+    def send_image(self, path, **kwargs):
+        return self._send_media(path, self.media.send_image, **kwargs)
+
+    def send_file(self, path, **kwargs):
+        return self._send_media(
+            path, lambda media_id, to_user_name:
+            self.media.send_file(media_id, to_user_name, path), **kwargs)
+
+    def download(self, msg, path=None):
+        """ Stream the media of `msg` to disk, see `Media.download` """
+        return self.media.download(msg, path)
+
+    def _resolve_recipients(self, recipients):
+        """ [(recipient, [user, ...]), ...] under one store lock """
+        with self.store.lock:
+            ret = []
+            for recipient in recipients:
+                if isinstance(recipient, dict):
+                    users = self.store.select(**recipient)
+                else:
+                    user = self.store.get(recipient)
+                    users = [user] if user else []
+                ret.append((recipient, users))
+            return ret
+
+    def _broadcast_sends(self, recipients):
+        """ ([not found result, ...], [(recipient, UserName), ...]),
+        a UserName once
+        """
+        ret, sends, seen = [], [], set()
+        for recipient, users in self._resolve_recipients(recipients):
+            if not users:
+                ret.append({'recipient': recipient, 'user_name': None,
+                            'ok': False, 'latency': 0, 'error': 'Not Found'})
+            for user in users:
+                if user['UserName'] not in seen:
+                    seen.add(user['UserName'])
+                    sends.append((recipient, user['UserName']))
+        return ret, sends
+
+    def _broadcast_result(self, recipient, user_name, res, start):
+        ok = self.request_ok(res)
+        self._observe_sent(ok)
+        return {
+            'recipient': recipient,
+            'user_name': user_name,
+            'ok': ok,
+            'latency': time.time() - start,
+            'error': res.get('BaseResponse', {}).get('ErrMsg', ''),
+        }
+
+    def broadcast(self, msg_content, recipients, workers=None):
+        """ Send `msg_content` to every recipient
+
+        :param recipients: UserNames or `select` filters,
+            ['@...', {'NickName': 'foo'}, ...]
+        :param workers: concurrent sends, `config.BROADCAST_WORKERS`
+        :return: [{
+            'recipient': {'NickName': 'foo'},
+            'user_name': '@...',
+            'ok': True,
+            'latency': 0.12,
+            'error': '',
+        }, ...]
+        """
+        url = '{}/webwxsendmsg?pass_ticket={}'.format(
+            self.cache.ticket, self.cache.pass_ticket
+        )
+        template = self._send_msg_template(msg_content)
+        ret, sends = self._broadcast_sends(recipients)
+
+        def send(item):
+            recipient, user_name = item
+            start = time.time()
+            res = self._post_res(
+                url=url, data=self._fill_msg_template(template, user_name))
+            return self._broadcast_result(recipient, user_name, res, start)
+
+        workers = min(workers or config.BROADCAST_WORKERS, len(sends) or 1)
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            ret.extend(executor.map(send, sends))
+        return ret
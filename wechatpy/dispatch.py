@@ -0,0 +1,255 @@
+""" Handler Dispatch
+  Routes messages to handlers by MsgType, sender contact type, group and
+  content pattern. Handlers run on a worker pool, never on the sync thread:
+    - plain functions on a thread pool
+    - coroutine functions on a dedicated event loop thread
+
+    @bot.on(msg_type=1, contact_type=2, pattern=r'^ping')
+    def pong(msg):
+        bot.send_msg('pong', UserName=msg['FromGroup']['UserName'])
+"""
+
+import re
+import time
+import inspect
+import logging
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from . import config
+
+log = logging.getLogger('assbot')
+
+
+def _as_set(value):
+    if value is None:
+        return None
+    if isinstance(value, (list, tuple, set, frozenset)):
+        return frozenset(value)
+    return frozenset((value,))
+
+
+class Handler(object):
+    """"""
+
+    def __init__(self, func, msg_type=None, contact_type=None, group=None,
+                 pattern=None, concurrency=None, timeout=None):
+        self.func = func
+        self.name = getattr(func, '__name__', repr(func))
+        self.msg_type = _as_set(msg_type)
+        self.contact_type = _as_set(contact_type)
+        self.group = _as_set(group)
+        self.pattern = re.compile(pattern) if pattern else None
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.is_async = inspect.iscoroutinefunction(func)
+        self.semaphore = None  # coroutine handlers, set on the loop
+        # plain handlers at `concurrency` queue here, not on a worker
+        self.lock = threading.Lock()
+        self.running = 0
+        self.pending = deque()
+        self.calls = self.errors = self.timeouts = 0
+
+    def match(self, msg):
+        if self.msg_type is not None and msg.get('MsgType') not in self.msg_type:
+            return False
+        from_group = msg.get('FromGroup')
+        if self.contact_type is not None:
+            sender = from_group if from_group else msg.get('FromUser') or {}
+            if sender.get('ContactType') not in self.contact_type:
+                return False
+        if self.group is not None:
+            if not from_group or (
+                    from_group.get('UserName') not in self.group and
+                    from_group.get('NickName') not in self.group):
+                return False
+        if self.pattern is not None and \
+                not self.pattern.search(msg.get('Content') or ''):
+            return False
+        return True
+
+
+class Dispatcher(object):
+    """ `executor`, a thread pool shared with other dispatchers,
+    left running on `shutdown`
+    """
+
+    def __init__(self, workers=None, executor=None):
+        self.workers = workers or config.HANDLER_WORKERS
+        self.handlers = []
+        self.executor = executor
+        self.shared = executor is not None
+        self.loop = None
+        self.lock = threading.Lock()
+        # (seconds since webwxsync returned, since the server created msg)
+        self.delays = deque(maxlen=config.DELAY_SAMPLES)
+
+    def __len__(self):
+        return len(self.handlers)
+
+    def register(self, msg_type=None, contact_type=None, group=None,
+                 pattern=None, concurrency=None, timeout=None):
+        """ Decorator registering a handler(msg)
+
+        :param msg_type: MsgType or MsgTypes
+        :param contact_type: sender `WeChatBot.contact_type`(s), 2 for groups
+        :param group: group UserName(s) or NickName(s)
+        :param pattern: regex searched in Content
+        :param concurrency: max concurrent calls of the handler
+        :param timeout: seconds, coroutine handlers are cancelled,
+            slow plain handlers are logged
+        """
+        def decorator(func):
+            self.handlers.append(Handler(
+                func, msg_type=msg_type, contact_type=contact_type,
+                group=group, pattern=pattern, concurrency=concurrency,
+                timeout=timeout,
+            ))
+            return func
+        return decorator
+
+    def _start(self):
+        import asyncio
+        with self.lock:
+            if self.executor is None:
+                self.executor = ThreadPoolExecutor(
+                    max_workers=self.workers, thread_name_prefix='handler')
+            if self.loop is None and any(h.is_async for h in self.handlers):
+                self.loop = asyncio.new_event_loop()
+                t = threading.Thread(
+                    target=self.loop.run_forever, name='handler-loop')
+                t.daemon = True
+                t.start()
+
+    def dispatch(self, msg):
+        """ Submit `msg` to every matching handler, the number of handlers """
+        matched = [h for h in self.handlers if h.match(msg)]
+        if not matched:
+            return 0
+        if self.executor is None or (self.loop is None and any(
+                h.is_async for h in matched)):
+            self._start()
+        for handler in matched:
+            if handler.is_async:
+                self.loop.call_soon_threadsafe(
+                    self.loop.create_task, self._arun(handler, msg))
+            else:
+                self._submit(handler, msg)
+        return len(matched)
+
+    def _submit(self, handler, msg):
+        if handler.concurrency:
+            with handler.lock:
+                if handler.running >= handler.concurrency:
+                    handler.pending.append(msg)
+                    return
+                handler.running += 1
+        self.executor.submit(self._run, handler, msg)
+
+    def _release(self, handler):
+        """ Pass the slot of a finished call to the next pending msg """
+        with handler.lock:
+            if not handler.pending:
+                handler.running -= 1
+                return
+            msg = handler.pending.popleft()
+        try:
+            self.executor.submit(self._run, handler, msg)
+        except RuntimeError:
+            # shut down
+            with handler.lock:
+                handler.running -= 1
+
+    def _delay(self, msg, start):
+        """ Record the delays of `msg`, a bad time field is logged only """
+        try:
+            self.delays.append((
+                start - msg.get('ReceiveTime', start),
+                start - msg.get('CreateTime', start),
+            ))
+        except (TypeError, ValueError) as e:
+            log.warning('Msg Delay Error, %s' % repr(e))
+
+    def _run(self, handler, msg):
+        start = time.time()
+        self._delay(msg, start)
+        try:
+            handler.calls += 1
+            handler.func(msg)
+        except Exception:
+            handler.errors += 1
+            log.exception('Handler %s Error' % handler.name)
+        finally:
+            if handler.concurrency:
+                self._release(handler)
+        duration = time.time() - start
+        if handler.timeout and duration > handler.timeout:
+            handler.timeouts += 1
+            log.warning('Handler %s Slow, %.2fs > %ss' % (
+                handler.name, duration, handler.timeout))
+
+    async def _arun(self, handler, msg):
+        import asyncio
+        if handler.concurrency and handler.semaphore is None:
+            handler.semaphore = asyncio.Semaphore(handler.concurrency)
+        try:
+            handler.calls += 1
+            if handler.semaphore:
+                async with handler.semaphore:
+                    self._delay(msg, time.time())
+                    await asyncio.wait_for(handler.func(msg), handler.timeout)
+            else:
+                self._delay(msg, time.time())
+                await asyncio.wait_for(handler.func(msg), handler.timeout)
+        except asyncio.TimeoutError:
+            handler.timeouts += 1
+            log.warning('Handler %s Timeout, %ss' % (
+                handler.name, handler.timeout))
+        except Exception:
+            handler.errors += 1
+            log.exception('Handler %s Error' % handler.name)
+
+    def stats(self):
+        return {
+            h.name: {
+                'calls': h.calls, 'errors': h.errors, 'timeouts': h.timeouts,
+                'pending': len(h.pending),
+            }
+            for h in self.handlers
+        }
+
+    def delay_stats(self):
+        """ Inbound message to handler delays, seconds
+            - sync: since webwxsync returned the message
+            - server: since the server created it, CreateTime precision
+        """
+        ret = {}
+        delays = list(self.delays)
+        for i, name in enumerate(('sync', 'server')):
+            samples = sorted(delay[i] for delay in delays)
+            if not samples:
+                continue
+            ret[name] = {
+                'count': len(samples),
+                'avg': sum(samples) / len(samples),
+                'p50': samples[len(samples) // 2],
+                'p99': samples[int(len(samples) * 0.99)],
+                'max': samples[-1],
+            }
+        return ret
+
+    def _drain(self):
+        """ Wait for the msgs pending on handlers at their concurrency """
+        while any(h.running for h in self.handlers if h.concurrency):
+            time.sleep(0.01)
+
+    def shutdown(self, wait=True):
+        if self.executor is not None and wait:
+            self._drain()
+        if self.executor is not None and not self.shared:
+            self.executor.shutdown(wait=wait)
+            self.executor = None
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self.loop = None
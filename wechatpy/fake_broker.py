@@ -0,0 +1,198 @@
+""" Fake Broker
+  An in-process stand-in for RabbitMQ, for load tests of the listeners:
+  connections with the pika BlockingConnection calls `Listener` makes,
+  prefetch, acks and nacks, redelivery of the unacked messages of a
+  closed connection, and `drop` to kill every connection.
+
+    broker = FakeBroker()
+    listener = Listener(routes, connect=broker.connect).start()
+    broker.publish('room', body)
+"""
+
+import time
+import itertools
+import threading
+from types import SimpleNamespace
+from collections import deque
+
+
+class ConnectionClosed(ConnectionError):
+    """"""
+
+
+class FakeChannel(object):
+    """"""
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.broker = connection.broker
+        self.prefetch = 0
+        self.consumers = []  # [(queue, callback)]
+        self.unacked = {}  # delivery_tag -> (queue, body, properties)
+
+    def basic_qos(self, prefetch_count=0):
+        self.prefetch = prefetch_count
+
+    def queue_declare(self, queue):
+        self.connection.check()
+        with self.broker.cond:
+            self.broker.queues.setdefault(queue, deque())
+
+    def basic_consume(self, consumer_callback, queue, no_ack=False):
+        self.connection.check()
+        self.consumers.append((queue, consumer_callback))
+
+    def basic_ack(self, delivery_tag, multiple=False):
+        self.connection.check()
+        with self.broker.cond:
+            self.unacked.pop(delivery_tag)
+            self.broker.acked += 1
+            self.broker.cond.notify_all()
+
+    def basic_nack(self, delivery_tag, multiple=False, requeue=True):
+        self.connection.check()
+        with self.broker.cond:
+            queue, body, properties = self.unacked.pop(delivery_tag)
+            self.broker.nacked += 1
+            if requeue:
+                self.broker.queues[queue].appendleft((body, properties, True))
+            self.broker.cond.notify_all()
+
+    def _take(self):
+        """ Deliveries up to the prefetch, under the broker lock """
+        deliveries = []
+        while self.consumers:
+            taken = False
+            for queue, callback in self.consumers:
+                if self.prefetch and len(self.unacked) >= self.prefetch:
+                    return deliveries
+                q = self.broker.queues[queue]
+                if not q:
+                    continue
+                body, properties, redelivered = q.popleft()
+                tag = next(self.broker.tags)
+                self.unacked[tag] = (queue, body, properties)
+                method = SimpleNamespace(
+                    delivery_tag=tag, redelivered=redelivered,
+                    routing_key=queue)
+                deliveries.append((callback, self, method, properties, body))
+                taken = True
+            if not taken:
+                break
+        return deliveries
+
+
+class FakeConnection(object):
+    """"""
+
+    def __init__(self, broker):
+        self.broker = broker
+        self.channels = []
+        self.callbacks = deque()
+        self.is_open = True
+
+    def check(self):
+        if not self.is_open:
+            raise ConnectionClosed('connection closed')
+
+    def channel(self):
+        self.check()
+        channel = FakeChannel(self)
+        self.channels.append(channel)
+        return channel
+
+    def add_callback_threadsafe(self, callback):
+        self.check()
+        with self.broker.cond:
+            self.callbacks.append(callback)
+            self.broker.cond.notify_all()
+
+    def process_data_events(self, time_limit=0):
+        """ Run the pending callbacks and deliveries, waiting up to
+        `time_limit` seconds for some
+        """
+        deadline = time.time() + (time_limit or 0)
+        cond = self.broker.cond
+        with cond:
+            while True:
+                self.check()
+                callbacks = list(self.callbacks)
+                self.callbacks.clear()
+                deliveries = [d for ch in self.channels for d in ch._take()]
+                remaining = deadline - time.time()
+                if callbacks or deliveries or remaining <= 0:
+                    break
+                cond.wait(remaining)
+        for callback in callbacks:
+            callback()
+        for callback, channel, method, properties, body in deliveries:
+            callback(channel, method, properties, body)
+
+    def close(self):
+        with self.broker.cond:
+            if not self.is_open:
+                return
+            self.is_open = False
+            self.broker.connections.remove(self)
+            for channel in self.channels:
+                for queue, body, properties in reversed(
+                        list(channel.unacked.values())):
+                    self.broker.queues[queue].appendleft(
+                        (body, properties, True))
+                    self.broker.redelivered += 1
+                channel.unacked.clear()
+            self.broker.cond.notify_all()
+
+
+class FakeBroker(object):
+    """"""
+
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.queues = {}
+        self.connections = []
+        self.tags = itertools.count(1)
+        self.published = self.acked = self.nacked = self.redelivered = 0
+
+    def connect(self):
+        """ A new connection, the `connect` of `Listener` """
+        connection = FakeConnection(self)
+        with self.cond:
+            self.connections.append(connection)
+        return connection
+
+    def publish(self, queue, body, message_id=None):
+        if isinstance(body, str):
+            body = body.encode('utf-8')
+        properties = SimpleNamespace(message_id=message_id)
+        with self.cond:
+            self.queues.setdefault(queue, deque()).append(
+                (body, properties, False))
+            self.published += 1
+            self.cond.notify_all()
+
+    def drop(self):
+        """ Close every connection, their unacked messages are requeued """
+        for connection in list(self.connections):
+            connection.close()
+
+    def depth(self, queue=None):
+        with self.cond:
+            if queue is not None:
+                return len(self.queues.get(queue, ()))
+            return sum(len(q) for q in self.queues.values())
+
+    def unacked(self):
+        with self.cond:
+            return sum(len(ch.unacked) for conn in self.connections
+                       for ch in conn.channels)
+
+    def stats(self):
+        return {
+            'published': self.published,
+            'acked': self.acked,
+            'nacked': self.nacked,
+            'redelivered': self.redelivered,
+            'depth': self.depth(),
+            'unacked': self.unacked(),
+        }
@@ -0,0 +1,281 @@
+""" Fake WeChat Web Server
+  A local stand-in for the web protocol, for benchmarks and tests:
+  jslogin, login/redirect, webwxinit, webwxgetcontact,
+  webwxbatchgetcontact, synccheck, webwxsync, webwxsendmsg,
+  webwxstatusnotify and the media endpoints, with configurable latency,
+  error injection and message generation rate.
+
+    server = FakeWeChatServer(latency=0.01, error_rate=0.01, msg_rate=100)
+    server.start()
+    config.ROOT_URL = server.url
+"""
+
+import json
+import time
+import socket
+import random
+import threading
+from urllib.parse import urlsplit, parse_qs
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+BATCH_CONTACT_LIMIT = 50
+ROUTES = (
+    'jslogin', 'login', 'webwxnewloginpage', 'webwxinit', 'webwxstatusnotify',
+    'webwxgetcontact', 'webwxbatchgetcontact', 'synccheck', 'webwxsync',
+    'webwxsendmsg', 'webwxlogout', 'webwxuploadmedia', 'webwxsendmsgimg',
+    'webwxsendappmsg', 'webwxgetmsgimg', 'webwxgetmedia',
+)
+
+
+class FakeWeChatServer(object):
+    """"""
+
+    def __init__(self, contacts=100, groups=10, members=50, latency=0,
+                 error_rate=0, msg_rate=0, long_poll=25, port=0,
+                 media_size=1 << 20):
+        """
+        :param latency: seconds added to every response
+        :param error_rate: fraction of requests answered with HTTP 500
+        :param msg_rate: generated messages per second, see `inject`
+        :param long_poll: seconds synccheck waits for messages
+        :param media_size: bytes of every downloaded media
+        """
+        self.latency = latency
+        self.error_rate = error_rate
+        self.msg_rate = msg_rate
+        self.long_poll = long_poll
+        self.port = port
+        self.cond = threading.Condition()
+        self.pending = []
+        self.sent = []
+        self.uploaded = 0
+        self.media_size = media_size
+        self.sync_key = 1
+        self.logged_out = False
+        self.requests = 0
+        self.self_user = {'UserName': '@%064x' % 0, 'NickName': 'fake'}
+        self.contacts = {}
+        for i in range(contacts):
+            user_name = '@%064x' % (i + 1)
+            self.contacts[user_name] = {
+                'UserName': user_name, 'NickName': 'friend %d' % i,
+                'RemarkName': '', 'Alias': '', 'VerifyFlag': 0,
+            }
+        self.groups = {}
+        for i in range(groups):
+            user_name = '@@%064x' % (i + 1)
+            self.groups[user_name] = {
+                'UserName': user_name, 'NickName': 'group %d' % i,
+                'VerifyFlag': 0, 'MemberCount': members,
+                'MemberList': [
+                    {'UserName': '@%064x' % (1 << 32 | i << 16 | j),
+                     'NickName': 'member %d.%d' % (i, j), 'DisplayName': ''}
+                    for j in range(members)
+                ],
+            }
+        self.server = None
+        self.generator = None
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:%d' % self.server.server_port
+
+    def start(self):
+        self.server = ThreadingHTTPServer(
+            ('127.0.0.1', self.port), self._handler())
+        self.server.daemon_threads = True
+        t = threading.Thread(target=self.server.serve_forever)
+        t.daemon = True
+        t.start()
+        if self.msg_rate:
+            self.generator = threading.Thread(target=self._generate)
+            self.generator.daemon = True
+            self.generator.start()
+        return self
+
+    def stop(self):
+        self.logout()
+        self.msg_rate = 0
+        self.server.shutdown()
+        self.server.server_close()
+
+    def logout(self):
+        """ synccheck answers 1101 from now on """
+        with self.cond:
+            self.logged_out = True
+            self.cond.notify_all()
+
+    def message(self, group=True):
+        if group:
+            group = random.choice(list(self.groups.values()))
+            member = random.choice(group['MemberList'])
+            from_user_name = group['UserName']
+            content = '%s:<br/>hello %f' % (member['UserName'], time.time())
+        else:
+            from_user_name = random.choice(list(self.contacts))
+            content = 'hello %f' % time.time()
+        return {
+            'MsgId': '%d' % random.getrandbits(63),
+            'MsgType': 1,
+            'FromUserName': from_user_name,
+            'ToUserName': self.self_user['UserName'],
+            'Content': content,
+            'CreateTime': int(time.time()),
+        }
+
+    def inject(self, n, group=True):
+        """ Queue `n` messages for the next syncs """
+        msgs = [self.message(group) for _ in range(n)]
+        with self.cond:
+            self.pending.extend(msgs)
+            self.cond.notify_all()
+
+    def _generate(self):
+        while self.msg_rate:
+            time.sleep(0.1)
+            n = int(self.msg_rate * 0.1) or int(random.random() <
+                                                self.msg_rate * 0.1)
+            if n:
+                self.inject(n)
+
+    def _base(self, **kwargs):
+        kwargs['BaseResponse'] = {'Ret': 0, 'ErrMsg': ''}
+        return kwargs
+
+    def _sync_key(self):
+        return {'Count': 1, 'List': [{'Key': 1, 'Val': self.sync_key}]}
+
+    # routes, route(query, data) -> text or json object
+
+    def jslogin(self, query, data):
+        return 'window.QRLogin.code = 200; window.QRLogin.uuid = "fake==";'
+
+    def login(self, query, data):
+        return 'window.code=200;\nwindow.redirect_uri="%s/cgi-bin/mmwebwx-' \
+               'bin/webwxnewloginpage?ticket=fake&uuid=fake==&scan=1";' % self.url
+
+    def webwxnewloginpage(self, query, data):
+        return '<error><ret>0</ret><message></message><skey>@crypt_fake</skey>' \
+               '<wxsid>fakesid</wxsid><wxuin>1</wxuin><pass_ticket>fake' \
+               '</pass_ticket><isgrayscale>1</isgrayscale></error>'
+
+    def webwxinit(self, query, data):
+        return self._base(User=self.self_user, SyncKey=self._sync_key())
+
+    def webwxstatusnotify(self, query, data):
+        return self._base(MsgID='%d' % random.getrandbits(63))
+
+    def webwxgetcontact(self, query, data):
+        member_list = list(self.contacts.values()) + [
+            {k: v for k, v in group.items() if k != 'MemberList'}
+            for group in self.groups.values()
+        ]
+        return self._base(MemberCount=len(member_list), MemberList=member_list)
+
+    def webwxbatchgetcontact(self, query, data):
+        contact_list = []
+        for user in data.get('List', [])[:BATCH_CONTACT_LIMIT]:
+            user_name = user.get('UserName')
+            contact = self.groups.get(user_name) or self.contacts.get(user_name)
+            if contact:
+                contact_list.append(dict(contact))
+        return self._base(Count=len(contact_list), ContactList=contact_list)
+
+    def synccheck(self, query, data):
+        with self.cond:
+            self.cond.wait_for(
+                lambda: self.pending or self.logged_out, self.long_poll)
+            if self.logged_out:
+                retcode, selector = '1101', '0'
+            else:
+                retcode, selector = '0', '2' if self.pending else '0'
+        return 'window.synccheck={retcode:"%s",selector:"%s"}' % (
+            retcode, selector)
+
+    def webwxsync(self, query, data):
+        with self.cond:
+            msgs, self.pending = self.pending, []
+            self.sync_key += 1
+        return self._base(
+            AddMsgCount=len(msgs), AddMsgList=msgs,
+            ModContactCount=0, ModContactList=[],
+            DelContactCount=0, DelContactList=[],
+            ModChatRoomMemberCount=0, ModChatRoomMemberList=[],
+            SyncKey=self._sync_key(), SyncCheckKey=self._sync_key(),
+        )
+
+    def webwxsendmsg(self, query, data):
+        msg = data.get('Msg', {})
+        with self.cond:
+            self.sent.append(msg)
+        return self._base(
+            MsgID='%d' % random.getrandbits(63), LocalID=msg.get('LocalID'))
+
+    def webwxuploadmedia(self, query, data):
+        """ multipart bodies, counted """
+        with self.cond:
+            self.uploaded += len(data)
+        return self._base(MediaId='@crypt_media_%d' % random.getrandbits(32))
+
+    webwxsendmsgimg = webwxsendappmsg = webwxsendmsg
+
+    def webwxgetmsgimg(self, query, data):
+        return b'\xff' * self.media_size
+
+    webwxgetmedia = webwxgetmsgimg
+
+    def webwxlogout(self, query, data):
+        self.logout()
+        return ''
+
+    def _handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def setup(self):
+                BaseHTTPRequestHandler.setup(self)
+                self.connection.setsockopt(
+                    socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+            def _respond(self):
+                server.requests += 1
+                url = urlsplit(self.path)
+                length = int(self.headers.get('Content-Length') or 0)
+                body = self.rfile.read(length) if length else b''
+                name = url.path[url.path.rfind('/') + 1:]
+                if server.latency:
+                    time.sleep(server.latency)
+                if name not in ROUTES:
+                    return self._send(404, b'')
+                route = getattr(server, name)
+                if random.random() < server.error_rate:
+                    return self._send(500, b'')
+                try:
+                    data = json.loads(body.decode('utf-8')) if body else {}
+                except ValueError:
+                    data = body
+                res = route(parse_qs(url.query), data)
+                if isinstance(res, bytes):
+                    return self._send(200, res)
+                if not isinstance(res, str):
+                    res = json.dumps(res, ensure_ascii=False)
+                self._send(200, res.encode('utf-8'))
+
+            def _send(self, status, body):
+                self.send_response(status)
+                self.send_header('Content-Length', str(len(body)))
+                if status == 200 and self.path.startswith(
+                        '/cgi-bin/mmwebwx-bin/webwxnewloginpage'):
+                    self.send_header(
+                        'Set-Cookie', 'webwx_data_ticket=fake; Path=/')
+                self.end_headers()
+                self.wfile.write(body)
+
+            do_GET = do_POST = _respond
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
@@ -1,24 +1,295 @@
+""" MQ Listeners
+  Listener consumes queues with manual acks:
+    - at most `config.MQ_PREFETCH` unacked messages per consumer
+    - messages handed to the route handlers in batches of up to
+      `config.MQ_BATCH_SIZE`, every `config.MQ_BATCH_TIMEOUT` seconds,
+      once `ready(queue)`
+    - a message is acked by its handler once it is sent, `Fanout`
+    - reconnects with backoff, a redelivered message that was already
+      handled is acked, not handled again. Messages are told apart by
+      their `message_id` property, publishers must set it, messages
+      without one are handled again when redelivered
 
-import pika
+    listener = Listener({'room': bot.mq_forwarder}, ready=lambda q: bot.alive)
+    listener.start()
+
+  `connect` returns a pika BlockingConnection like object, pika is
+  imported by the default one, `fake_broker.FakeBroker.connect` runs
+  without a broker.
+"""
+
+import time
 import logging
+import functools
+import threading
+from collections import OrderedDict
+
+from . import config
+from .policy import backoff
 
 log = logging.getLogger('assbot')
 
 
-def rooms_listener(callback, queue='room'):
-    connection = pika.BlockingConnection(
-        pika.ConnectionParameters(host='localhost'))
+def pika_connect(host=None):
+    import pika
+    return pika.BlockingConnection(
+        pika.ConnectionParameters(host=host or config.MQ_HOST))
+
+
+class Delivery(object):
+    """ A consumed message, settled once by `ack` or `nack` """
+    __slots__ = ('listener', 'connection', 'channel', 'tag', 'queue', 'body',
+                 'key', 'redelivered', 'followers', 'settled')
+
+    def __init__(self, listener, connection, channel, tag, queue, body, key,
+                 redelivered):
+        self.listener = listener
+        self.connection = connection
+        self.channel = channel
+        self.tag = tag
+        self.queue = queue
+        self.body = body
+        self.key = key
+        self.redelivered = redelivered
+        self.followers = []  # redeliveries received while in flight
+        self.settled = False
+
+    def ack(self):
+        self.listener.settle(self, True)
+
+    def nack(self, requeue=True):
+        self.listener.settle(self, False, requeue)
+
+
+class Fanout(object):
+    """ Settles `delivery` after `n` sends: acked if all were sent,
+    requeued if none was, dropped if only some were
+    """
+
+    def __init__(self, delivery, n):
+        self.delivery = delivery
+        self.n = n
+        self.sent = self.failed = 0
+        self.lock = threading.Lock()
+
+    def done(self, ok, res):
+        """ `SendScheduler` callback """
+        with self.lock:
+            if ok and res:
+                self.sent += 1
+            else:
+                self.failed += 1
+            if self.sent + self.failed < self.n:
+                return
+        if not self.failed:
+            self.delivery.ack()
+        elif not self.sent:
+            self.delivery.nack(requeue=True)
+        else:
+            log.error('Partly Sent, %d of %d failed, %r' % (
+                self.failed, self.n, self.delivery.body))
+            self.delivery.nack(requeue=False)
+
+
+class Listener(object):
+    """"""
+
+    def __init__(self, routes, ready=None, connect=None, consumers=None,
+                 prefetch=None, batch_size=None, batch_timeout=None):
+        """
+        :param routes: {queue: handler([Delivery, ...])}, handlers must
+            not block, every delivery must be acked or nacked
+        :param ready: ready(queue), deliveries are held until True
+        :param connect: connect() -> BlockingConnection, `pika_connect`
+        :param consumers: connections, each consuming every queue
+        """
+        self.routes = routes
+        self.ready = ready
+        self.connect = connect or pika_connect
+        self.consumers = consumers or config.MQ_CONSUMERS
+        self.prefetch = prefetch or config.MQ_PREFETCH
+        self.batch_size = batch_size or config.MQ_BATCH_SIZE
+        self.batch_timeout = batch_timeout or config.MQ_BATCH_TIMEOUT
+        self.lock = threading.Lock()
+        self.inflight = {}
+        self.done = OrderedDict()
+        self.threads = []
+        self.running = False
+        self.received = self.acked = self.nacked = self.duplicates = 0
+        self.reconnects = 0
+
+    def start(self):
+        self.running = True
+        for i in range(self.consumers):
+            t = threading.Thread(target=self._consume, name='mq-%d' % i)
+            t.daemon = True
+            t.start()
+            self.threads.append(t)
+        return self
+
+    def run(self):
+        """ Consume on this thread and `consumers - 1` others """
+        self.running = True
+        for i in range(1, self.consumers):
+            t = threading.Thread(target=self._consume, name='mq-%d' % i)
+            t.daemon = True
+            t.start()
+            self.threads.append(t)
+        self._consume()
+
+    def stop(self, wait=True):
+        self.running = False
+        if wait:
+            for t in self.threads:
+                t.join()
+        self.threads = []
+
+    def _key(self, properties):
+        """ The message_id, None if not set: the message is never taken
+        for a redelivery, identical bodies may be legitimate repeats
+        """
+        return getattr(properties, 'message_id', None) or None
+
+    def _on_message(self, connection, buffers, queue, channel, method,
+                    properties, body):
+        key = self._key(properties)
+        delivery = Delivery(self, connection, channel, method.delivery_tag,
+                            queue, body, key, method.redelivered)
+        with self.lock:
+            self.received += 1
+            if method.redelivered and key is not None:
+                if key in self.done:
+                    self.duplicates += 1
+                    self._settle([delivery], True, False)
+                    return
+                first = self.inflight.get(key)
+                if first is not None:
+                    self.duplicates += 1
+                    first.followers.append(delivery)
+                    return
+            if key is not None:
+                self.inflight[key] = delivery
+        buffers[queue].append(delivery)
+        if len(buffers[queue]) >= self.batch_size:
+            self._flush(buffers, queue)
+
+    def _flush(self, buffers, queue):
+        batch = buffers[queue]
+        if not batch or (self.ready and not self.ready(queue)):
+            return
+        buffers[queue] = []
+        try:
+            self.routes[queue](batch)
+        except Exception:
+            log.exception('Listener %s Handler Error' % queue)
+            for delivery in batch:
+                if not delivery.settled:
+                    delivery.nack(requeue=True)
+
+    def settle(self, delivery, ok, requeue=False):
+        """ Ack or nack `delivery` and its redeliveries, thread safe, once """
+        with self.lock:
+            if delivery.settled:
+                return
+            if self.inflight.get(delivery.key) is delivery:
+                del self.inflight[delivery.key]
+            if ok and delivery.key is not None:
+                self.done[delivery.key] = None
+                if len(self.done) > config.MQ_DONE_SIZE:
+                    self.done.popitem(last=False)
+            self._settle([delivery] + delivery.followers, ok, requeue)
+
+    def _settle(self, deliveries, ok, requeue):
+        for delivery in deliveries:
+            delivery.settled = True
+            if ok:
+                self.acked += 1
+                callback = functools.partial(
+                    delivery.channel.basic_ack, delivery_tag=delivery.tag)
+            else:
+                self.nacked += 1
+                callback = functools.partial(
+                    delivery.channel.basic_nack, delivery_tag=delivery.tag,
+                    requeue=requeue)
+            try:
+                delivery.connection.add_callback_threadsafe(callback)
+            except Exception as e:
+                # the connection is gone, the broker redelivers
+                log.debug('Settle Dropped, %s' % repr(e))
+
+    def _consume(self):
+        attempt = 0
+        while self.running:
+            connection, buffers = None, {}
+            try:
+                connection = self.connect()
+                channel = connection.channel()
+                channel.basic_qos(prefetch_count=self.prefetch)
+                buffers.update((queue, []) for queue in self.routes)
+                for queue in self.routes:
+                    channel.queue_declare(queue=queue)
+                    channel.basic_consume(
+                        functools.partial(
+                            self._on_message, connection, buffers, queue),
+                        queue=queue,
+                        no_ack=False,
+                    )
+                log.info('%s listener start consuming' % ', '.join(self.routes))
+                attempt = 0
+                while self.running:
+                    connection.process_data_events(
+                        time_limit=self.batch_timeout)
+                    for queue in self.routes:
+                        self._flush(buffers, queue)
+            except Exception as e:
+                attempt += 1
+                self.reconnects += 1
+                log.error('Listener Error, reconnecting: %s' % repr(e))
+            finally:
+                self._abandon(buffers)
+                if connection is not None:
+                    try:
+                        connection.close()
+                    except Exception:
+                        pass
+            if attempt and self.running:
+                time.sleep(backoff(attempt, cap=config.MQ_RECONNECT_MAX))
+
+    def _abandon(self, buffers):
+        """ Forget the deliveries of a closed connection that were never
+        handed to a handler, the broker redelivers them. Redeliveries
+        already waiting on them are requeued.
+        """
+        with self.lock:
+            for batch in buffers.values():
+                for delivery in batch:
+                    delivery.settled = True
+                    if self.inflight.get(delivery.key) is delivery:
+                        del self.inflight[delivery.key]
+                    if delivery.followers:
+                        self._settle(delivery.followers, False, True)
+            buffers.clear()
+
+    def stats(self):
+        with self.lock:
+            return {
+                'received': self.received,
+                'inflight': len(self.inflight),
+                'acked': self.acked,
+                'nacked': self.nacked,
+                'duplicates': self.duplicates,
+                'reconnects': self.reconnects,
+            }
+
+
+def rooms_listener(callback, queue='room', **kwargs):
+    """ Consume `queue` with `callback([Delivery, ...])` """
+    Listener({queue: callback}, **kwargs).run()
 
-    channel = connection.channel()
-    channel.queue_declare(queue=queue)
 
-    channel.basic_consume(
-        callback,
-        queue=queue,
-        no_ack=True,
-    )
-    log.info('%s listener start consuming' % queue)
-    channel.start_consuming()
+def queues_listener(routes, **kwargs):
+    """ Consume every queue of `routes`, {queue: callback} """
+    Listener(routes, **kwargs).run()
 
 
 LISTENERS = [
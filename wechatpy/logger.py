@@ -6,14 +6,17 @@ from __future__ import absolute_import
 import os
 import logging
 
-from django.conf import settings
 
-
-def getLogger(name):
+def getLogger(name, file=None):
+    """ :param file: log file, `BASE_DIR/logs/assbot.log` of the django
+    settings by default
+    """
     log = logging.getLogger(name)
     log.setLevel(logging.DEBUG)
 
-    file = os.path.join(settings.BASE_DIR, 'logs', 'assbot.log')
+    if file is None:
+        from django.conf import settings
+        file = os.path.join(settings.BASE_DIR, 'logs', 'assbot.log')
     fh = logging.FileHandler(file)
     fh.setLevel(logging.INFO)
     fh.setFormatter(logging.Formatter(
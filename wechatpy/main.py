@@ -1,28 +1,60 @@
 """ Bot Main
   run() to run AssBot
+  run_many(accounts) to run an AssBot per account in one process
+
+  Django settings, the minions mailer and pika are imported when first
+  used, AssBot takes any `settings` object and `mailer(**mail)` callable.
 """
 
 import os
 import copy
 import json
-import queue
-import random
-import time
+import functools
 import threading
 
-from django.conf import settings
-from django.core.cache import cache
+from concurrent.futures import ThreadPoolExecutor
 
+from . import config
 from .core import WeChatBot
-from .listeners import LISTENERS
+from .dispatch import Dispatcher
+from .storage import SqliteCache
+from .scheduler import SendScheduler
+from .listeners import LISTENERS, Fanout, Listener
 from .utils import get_suser
-from minions.mailer.tasks import email_task
 
 
-MAX_SEND_FREQUENCY = 10
+def django_settings():
+    from django.conf import settings
+    return settings
+
+
+def email_task(**mail):
+    """ The minions celery mailer """
+    from minions.mailer.tasks import email_task
+    return email_task.delay(**mail)
 
 
 class AssBot(WeChatBot):
+    def __init__(self, *args, scheduler=None, settings=None, mailer=None,
+                 **kwargs):
+        """
+        :param scheduler: a `SendScheduler` shared by bots
+        :param settings: ADMINS, GEEBOT_ADMIN, DEFAULT_FROM_EMAIL and
+            QR_DIR, django settings by default
+        :param mailer: mailer(email_to=, subject=, ...), `email_task`
+            by default
+        """
+        super(AssBot, self).__init__(*args, **kwargs)
+        self.scheduler = scheduler or SendScheduler()
+        self._settings = settings
+        self.mailer = mailer or email_task
+
+    @property
+    def settings(self):
+        if self._settings is None:
+            self._settings = django_settings()
+        return self._settings
+
     def email_qr(self, file):
         mail_html = '''<html><body>
         <h1> <span style="color:red">WARNING:</span>
@@ -30,11 +62,11 @@ class AssBot(WeChatBot):
         <hr>
         <p><img src="cid:qr"></p>
         </body></html>'''
-        email_to = list(dict(settings.ADMINS).values())
+        email_to = list(dict(self.settings.ADMINS).values())
         subject = '请为 AssBot 扫码！'
-        email_from = settings.DEFAULT_FROM_EMAIL
+        email_from = self.settings.DEFAULT_FROM_EMAIL
         message_html = mail_html
-        email_task.delay(
+        self.mailer(
             email_to=email_to,
             subject=subject,
             email_from=email_from,
@@ -48,11 +80,11 @@ class AssBot(WeChatBot):
         <h1 style="color:red">WARNING</h1><br>
         <h2><code>INFO: </code>{} <br></h2>
         </body></html>'''.format(info)
-        email_to = settings.GEEBOT_ADMIN
+        email_to = self.settings.GEEBOT_ADMIN
         subject = 'AssBot 通知！'
-        email_from = settings.DEFAULT_FROM_EMAIL
+        email_from = self.settings.DEFAULT_FROM_EMAIL
         message_html = mail_html
-        email_task.delay(
+        self.mailer(
             email_to=email_to,
             subject=subject,
             email_from=email_from,
@@ -63,62 +95,161 @@ class AssBot(WeChatBot):
         return msg
 
     def sender(self, msg):
+        """ True if sent to every user matching msg['ToUser'] """
         user, content = msg['ToUser'], msg['Content']
         suser = get_suser(user)
         sent = self.send_msg(msg['Content'], **user)
-        if not all(sent):
-
+        if not sent or not all(sent):
             self.log.error('Sent Error, %s, %s' % (suser, msg['Content']))
-        else:
-            self.log.info('Sent Success %s, %s' % (suser, msg['Content']))
-
-    def mq_forwarder(self, ch, method, properties, body):
-        while not self.alive:
-            self.log.info('%s listener waiting for consuming' % queue)
-            time.sleep(10)
-
-        self.log.info('Received %r' % body)
-        msg = json.loads(str(body, 'utf-8'))
-
-        for user in msg['ToUserList']:
-            _msg = copy.deepcopy(msg)
-            _msg['ToUser'] = user
-            suser = get_suser(user)
-            delay = cache.ttl(suser)
-            if delay:
-                self.log.info('Waiting %d, %s %s' % (delay, suser, _msg['Content']))
-                time.sleep(delay)
-            t = threading.Thread(target=self.sender, args=(_msg, ))
-            t.start()
-            cache.set(suser, 1, timeout=MAX_SEND_FREQUENCY)
+            return False
+        self.log.info('Sent Success %s, %s' % (suser, msg['Content']))
+        return True
+
+    def mq_ready(self, queue=None):
+        return self.alive
+
+    def mq_forwarder(self, deliveries):
+        """ Schedule a batch of queue messages, each acked once sent to
+        every user of its ToUserList
+        """
+        tasks = []
+        for delivery in deliveries:
+            self.log.info('Received %r' % delivery.body)
+            try:
+                msg = json.loads(str(delivery.body, 'utf-8'))
+                users = msg['ToUserList']
+            except (ValueError, KeyError, TypeError) as e:
+                self.log.error('Bad Message %r, %s' % (delivery.body, repr(e)))
+                delivery.nack(requeue=False)
+                continue
+            if not users:
+                delivery.ack()
+                continue
+            fanout = Fanout(delivery, len(users))
+            for user in users:
+                _msg = copy.deepcopy(msg)
+                _msg['ToUser'] = user
+                tasks.append((
+                    (self.name, get_suser(user)), self.sender, (_msg, ),
+                    fanout.done))
+        self.scheduler.submit_many(tasks)
+        self.log.info('Send Queue %s' % self.scheduler.stats())
 
     def receiver(self):
-        while not self.store.msgs.empty():
-            msg = self.store.msgs.get()
-            if msg.get('Content'):
-                self.log.info(' Received Msg: %s ' % msg.get('Content'))
+        while True:
+            msgs = self.store.msgs.drain(config.MSG_DRAIN_SIZE)
+            if not msgs:
+                break
+            for msg in msgs:
+                if msg.get('Content'):
+                    self.log.info(' Received Msg: %s ' % msg.get('Content'))
 
     def handle(self):
         self.receiver()
 
 
-def run():
+def _stop(assbot):
+    if not assbot.store.msgs.empty():
+        assbot.log.error('%s MsgQueue Not Empty: %s' % (
+            assbot.name, assbot.store.msgs.stats()))
+        for msg in assbot.store.msgs.drain():
+            assbot.log.error('  Msg: %s' % str(msg))
+    assbot.alive = False
+    assbot.save_session()
+
+
+def run(listeners=None):
+    """ :param listeners: listener(callback, ready=) functions, `LISTENERS` """
     assbot = AssBot()
-    qr = os.path.join(settings.QR_DIR, 'qr.png')
+    qr = os.path.join(assbot.settings.QR_DIR, 'qr.png')
     assbot.configure(qr=qr, tty=False, email=True)
-    for listener in LISTENERS:
+    for listener in listeners or LISTENERS:
         forwarder = threading.Thread(
-            target=listener, args=(assbot.mq_forwarder, ))
+            target=listener, args=(assbot.mq_forwarder, ),
+            kwargs={'ready': assbot.mq_ready})
         forwarder.setDaemon(True)
         forwarder.start()
 
     try:
         assbot.run()
     except (KeyboardInterrupt, SystemExit):
-        if not assbot.store.msgs.empty():
-            assbot.log.error('MsgQueue Not Empty: ')
-            while not assbot.store.msgs.empty():
-                msg = assbot.store.msgs.get()
-                assbot.log.error('  Msg: %s' % str(msg))
-        assbot.alive = False
-
+        _stop(assbot)
+        assbot.scheduler.stop(wait=False)
+
+
+def run_many(accounts, settings=None, mailer=None):
+    """ Run an AssBot per account in one process
+
+    The bots share the connection pools, the send scheduler and the
+    handler pool, and keep their own cookies, cache, store and session
+    snapshot. One listener consumes the queues of all the bots, a queue
+    is held while its bot is logged out.
+
+    :param accounts: names, or dicts of `name`, `queues` (default
+        [name]), `store_backend`, `store_path` of a `SqliteCache` backend
+        (default `config.STORE_PATH` with the name) and `configure`
+        options
+    :param settings: `settings` of every AssBot
+    :param mailer: `mailer` of every AssBot
+    """
+    from .transport import AssSession, pool_adapters
+    accounts = [
+        {'name': account} if isinstance(account, str) else dict(account)
+        for account in accounts
+    ]
+    adapters = pool_adapters(scale=len(accounts))
+    scheduler = SendScheduler()
+    executor = ThreadPoolExecutor(
+        max_workers=config.HANDLER_WORKERS, thread_name_prefix='handler')
+    bots, routes, owners = [], {}, {}
+    for account in accounts:
+        name = account.pop('name')
+        queues = account.pop('queues', None) or [name]
+        store_backend = account.pop('store_backend', None)
+        store_path = account.pop('store_path', None)
+        if isinstance(store_backend, type) and \
+                issubclass(store_backend, SqliteCache):
+            root, ext = os.path.splitext(config.STORE_PATH)
+            store_backend = functools.partial(
+                store_backend, path=store_path or '%s.%s%s' % (
+                    root, name, ext))
+        assbot = AssBot(
+            store_backend=store_backend,
+            session=AssSession(adapters=adapters),
+            dispatcher=Dispatcher(executor=executor),
+            scheduler=scheduler,
+            settings=settings,
+            mailer=mailer,
+        )
+        conf = {
+            'qr': os.path.join(assbot.settings.QR_DIR, '%s.png' % name),
+            'tty': False,
+            'email': True,
+            'session_path': '%s.%s' % (config.SESSION_PATH, name),
+        }
+        conf.update(account)
+        assbot.configure(name=name, **conf)
+        for q in queues:
+            routes[q] = assbot.mq_forwarder
+            owners[q] = assbot
+        bots.append(assbot)
+
+    listener = Listener(routes, ready=lambda q: owners[q].alive).start()
+
+    threads = []
+    for assbot in bots:
+        t = threading.Thread(target=assbot.run, name=assbot.name)
+        t.daemon = True
+        t.start()
+        threads.append(t)
+    try:
+        for t in threads:
+            while t.is_alive():
+                t.join(1)
+    except (KeyboardInterrupt, SystemExit):
+        for assbot in bots:
+            _stop(assbot)
+    finally:
+        listener.stop(wait=False)
+        scheduler.stop(wait=False)
+        executor.shutdown(wait=False)
@@ -0,0 +1,284 @@
+""" Media
+  Image and file messages over the file host:
+    - uploads to webwxuploadmedia in `config.MEDIA_CHUNK_SIZE` chunks,
+      streamed from a memory-mapped file, never read whole into memory
+    - downloads of inbound media, webwxgetmsgimg, webwxgetvoice,
+      webwxgetvideo and webwxgetmedia, streamed to disk on a pool of
+      `config.MEDIA_WORKERS` threads
+
+    bot.send_image('cat.jpg', NickName='foo')
+    bot.download(msg).add_done_callback(...)
+"""
+
+import os
+import json
+import mmap
+import time
+import uuid
+import hashlib
+import logging
+import mimetypes
+import itertools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from . import config
+
+log = logging.getLogger('assbot')
+
+# MsgType: (download endpoint, file extension)
+IMAGE, VOICE, VIDEO, APP = 3, 34, 43, 49
+DOWNLOADS = {
+    IMAGE: ('webwxgetmsgimg', '.jpg'),
+    VOICE: ('webwxgetvoice', '.mp3'),
+    VIDEO: ('webwxgetvideo', '.mp4'),
+    APP: ('webwxgetmedia', ''),
+}
+APP_MSG = (
+    "<appmsg appid='wxeb7ec651dd0aefa9' sdkver=''><title>%s</title>"
+    "<des></des><action></action><type>6</type><content></content>"
+    "<url></url><lowurl></lowurl><appattach><totallen>%d</totallen>"
+    "<attachid>%s</attachid><fileext>%s</fileext></appattach>"
+    "<extinfo></extinfo></appmsg>"
+)
+
+
+class MultipartBody(object):
+    """ A multipart/form-data body of text `fields` and one file part,
+    `data` sent in `config.MEDIA_STREAM_CHUNK` slices of a memoryview,
+    not joined into one buffer. Iterable again for retries.
+    """
+
+    def __init__(self, fields, name, filename, data):
+        self.boundary = uuid.uuid4().hex
+        head = []
+        for key, value in fields:
+            head.append(
+                '--%s\r\nContent-Disposition: form-data; name="%s"'
+                '\r\n\r\n%s\r\n' % (self.boundary, key, value))
+        head.append(
+            '--%s\r\nContent-Disposition: form-data; name="%s"; '
+            'filename="%s"\r\nContent-Type: application/octet-stream'
+            '\r\n\r\n' % (self.boundary, name, filename))
+        self.head = ''.join(head).encode('utf-8')
+        self.tail = ('\r\n--%s--\r\n' % self.boundary).encode('utf-8')
+        self.data = memoryview(data)
+
+    @property
+    def content_type(self):
+        return 'multipart/form-data; boundary=%s' % self.boundary
+
+    def __len__(self):
+        return len(self.head) + len(self.data) + len(self.tail)
+
+    def __iter__(self):
+        yield self.head
+        size = config.MEDIA_STREAM_CHUNK
+        for start in range(0, len(self.data), size):
+            yield self.data[start:start + size]
+        yield self.tail
+
+
+class Media(object):
+    """"""
+
+    def __init__(self, bot, workers=None):
+        self.bot = bot
+        self.workers = workers or config.MEDIA_WORKERS
+        self.executor = None
+        self.lock = threading.Lock()
+        self.file_ids = itertools.count()
+
+    def media_type(self, path):
+        mime = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+        if mime.startswith('image/'):
+            return mime, 'pic'
+        if mime.startswith('video/'):
+            return mime, 'video'
+        return mime, 'doc'
+
+    def data_ticket(self):
+        return self.bot.session.cookies.get('webwx_data_ticket', '')
+
+    def upload(self, path, to_user_name='filehelper'):
+        """ Upload the file at `path`, its MediaId, None on failure """
+        res = {}
+        for chunk, chunks, url, body, headers in self._upload_chunks(
+                path, to_user_name):
+            res = self.bot._post_res(url=url, data=body, headers=headers)
+            if not self.bot.request_ok(res):
+                log.error('Upload Error, %s chunk %d/%d: %s' % (
+                    path, chunk + 1, chunks, res.get('BaseResponse')))
+                return None
+        return res.get('MediaId')
+
+    def _upload_chunks(self, path, to_user_name):
+        """ (chunk, chunks, url, body, headers) of the requests uploading
+        the file at `path`, none if it is empty
+        """
+        cache = self.bot.cache
+        url = '{}/webwxuploadmedia?f=json'.format(cache.file_url)
+        name = os.path.basename(path)
+        mime, media_type = self.media_type(path)
+        with open(path, 'rb') as fp:
+            size = os.fstat(fp.fileno()).st_size
+            if not size:
+                log.error('Upload Error, %s is empty' % path)
+                return
+            with mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                request = json.dumps({
+                    'UploadType': 2,
+                    'BaseRequest': cache.base_request,
+                    'ClientMediaId': int(time.time() * 1e4),
+                    'TotalLen': size,
+                    'StartPos': 0,
+                    'DataLen': size,
+                    'MediaType': 4,
+                    'FromUserName': cache.self['UserName'],
+                    'ToUserName': to_user_name,
+                    'FileMd5': hashlib.md5(mm).hexdigest(),
+                }, separators=(',', ':'))
+                fields = [
+                    ('id', 'WU_FILE_%d' % next(self.file_ids)),
+                    ('name', name),
+                    ('type', mime),
+                    ('lastModifiedDate', time.strftime(
+                        '%a %b %d %Y %H:%M:%S GMT+0800 (CST)')),
+                    ('size', size),
+                    ('mediatype', media_type),
+                    ('uploadmediarequest', request),
+                    ('webwx_data_ticket', self.data_ticket()),
+                    ('pass_ticket', cache.pass_ticket),
+                ]
+                chunk_size = config.MEDIA_CHUNK_SIZE
+                chunks = (size - 1) // chunk_size + 1
+                for chunk in range(chunks):
+                    chunk_fields = fields
+                    if chunks > 1:
+                        chunk_fields = fields + [
+                            ('chunks', chunks), ('chunk', chunk)]
+                    # one chunk in memory at a time
+                    body = MultipartBody(
+                        chunk_fields, 'filename', name,
+                        mm[chunk * chunk_size:(chunk + 1) * chunk_size])
+                    headers = dict(config.HEADERS)
+                    headers['Content-Type'] = body.content_type
+                    yield chunk, chunks, url, body, headers
+
+    def _send_request(self, endpoint, msg):
+        """ (url, data) of a media message """
+        cache = self.bot.cache
+        url = '{}/{}?fun=async&f=json&pass_ticket={}'.format(
+            cache.ticket, endpoint, cache.pass_ticket)
+        msg_id = self.bot.gen_msgid()
+        msg.update({
+            'FromUserName': cache.self['UserName'],
+            'LocalID': msg_id,
+            'ClientMsgId': msg_id,
+        })
+        data = {'BaseRequest': cache.base_request, 'Msg': msg, 'Scene': 0}
+        return url, json.dumps(data, ensure_ascii=False).encode('utf8')
+
+    def _send(self, endpoint, msg):
+        url, data = self._send_request(endpoint, msg)
+        res = self.bot._post_res(url=url, data=data)
+        ok = self.bot.request_ok(res)
+        self.bot._observe_sent(ok)
+        return ok
+
+    def send_image(self, media_id, to_user_name):
+        return self._send('webwxsendmsgimg', {
+            'Type': 3, 'MediaId': media_id, 'ToUserName': to_user_name,
+        })
+
+    def send_file(self, media_id, to_user_name, path):
+        name = os.path.basename(path)
+        return self._send('webwxsendappmsg', {
+            'Type': 6, 'ToUserName': to_user_name,
+            'Content': APP_MSG % (
+                name, os.path.getsize(path), media_id,
+                os.path.splitext(name)[1].lstrip('.')),
+        })
+
+    def _download_request(self, msg, path=None):
+        """ (url, params, headers, path) of the media of `msg`, None if
+        none, `path` by default under `config.MEDIA_DIR`
+        """
+        cache = self.bot.cache
+        endpoint, ext = DOWNLOADS.get(msg.get('MsgType'), (None, None))
+        if endpoint is None:
+            return None
+        headers = dict(config.HEADERS)
+        if endpoint == 'webwxgetmedia':
+            if not msg.get('MediaId'):
+                return None
+            from_group = msg.get('FromGroup')
+            sender = from_group['UserName'] if from_group \
+                else msg.get('FromUserName')
+            url = '{}/webwxgetmedia'.format(cache.file_url)
+            params = {
+                'sender': sender,
+                'mediaid': msg['MediaId'],
+                'filename': msg.get('FileName') or '',
+                'fromuser': cache.wxuin,
+                'pass_ticket': cache.pass_ticket,
+                'webwx_data_ticket': self.data_ticket(),
+            }
+            name = '%s_%s' % (msg['MsgId'], os.path.basename(
+                msg.get('FileName') or 'file'))
+        else:
+            url = '{}/{}'.format(cache.ticket, endpoint)
+            params = {'msgid': msg['MsgId'], 'skey': cache.skey}
+            name = '%s%s' % (msg['MsgId'], ext)
+        if endpoint == 'webwxgetvideo':
+            headers['Range'] = 'bytes=0-'
+        if path is None:
+            os.makedirs(config.MEDIA_DIR, exist_ok=True)
+            path = os.path.join(config.MEDIA_DIR, name)
+        return url, params, headers, path
+
+    def _download(self, url, params, headers, path):
+        r = self.bot.session.get(url, params=params, headers=headers,
+                                 stream=True)
+        if r is None:
+            return None
+        tmp = '%s.part' % path
+        try:
+            with r:
+                if r.status_code not in (200, 206):
+                    log.error('Download Error, %s: HTTP %d' % (
+                        url, r.status_code))
+                    return None
+                with open(tmp, 'wb') as fp:
+                    for chunk in r.iter_content(config.MEDIA_STREAM_CHUNK):
+                        fp.write(chunk)
+            os.replace(tmp, path)
+        except (OSError, ValueError) as e:
+            # requests errors while streaming are OSErrors
+            log.error('Download Error, %s: %s' % (url, repr(e)))
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            return None
+        return path
+
+    def download(self, msg, path=None):
+        """ Stream the media of `msg` to `path`, by default under
+        `config.MEDIA_DIR`, on the download pool
+
+        :return: a Future of the path, None if the download failed,
+            None instead of a Future if `msg` carries no media
+        """
+        request = self._download_request(msg, path)
+        if request is None:
+            return None
+        with self.lock:
+            if self.executor is None:
+                self.executor = ThreadPoolExecutor(
+                    max_workers=self.workers, thread_name_prefix='media')
+        return self.executor.submit(self._download, *request)
+
+    def shutdown(self, wait=True):
+        with self.lock:
+            if self.executor is not None:
+                self.executor.shutdown(wait=wait)
+                self.executor = None
@@ -0,0 +1,222 @@
+""" Metrics
+  Counters, gauges and histograms with a Prometheus text exposition,
+  served on a local port or pushed to a callback.
+
+    metrics.serve(9108)
+    metrics.push(print, interval=60)
+"""
+
+import time
+import bisect
+import weakref
+import logging
+import threading
+
+from . import config
+
+log = logging.getLogger('assbot')
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace(
+        '"', '\\"').replace('\n', '\\n')
+
+
+def _labels(names, values, extra=''):
+    pairs = ['%s="%s"' % (k, _escape(v)) for k, v in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{%s}' % ','.join(pairs) if pairs else ''
+
+
+class Metric(object):
+    type = 'untyped'
+
+    def __init__(self, name, help='', labels=()):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(labels)
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def _key(self, labels):
+        return tuple(labels.get(name, '') for name in self.label_names)
+
+    def samples(self):
+        with self.lock:
+            items = list(self.values.items())
+        for key, value in items:
+            yield self.name + _labels(self.label_names, key), value
+
+    def exposition(self):
+        lines = ['# HELP %s %s' % (self.name, self.help),
+                 '# TYPE %s %s' % (self.name, self.type)]
+        lines.extend('%s %s' % sample for sample in self.samples())
+        return '\n'.join(lines)
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, value=1, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + value
+
+
+class Gauge(Metric):
+    type = 'gauge'
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = value
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name, help='', labels=(), buckets=None):
+        super(Histogram, self).__init__(name, help, labels)
+        self.buckets = tuple(sorted(buckets or config.METRICS_BUCKETS))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        i = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            counts = self.values.get(key)
+            if counts is None:
+                # per bucket counts, +Inf, sum
+                counts = self.values[key] = [0] * (len(self.buckets) + 1) + [0]
+            counts[i] += 1
+            counts[-1] += value
+
+    def samples(self):
+        with self.lock:
+            items = [(key, list(counts)) for key, counts in self.values.items()]
+        for key, counts in items:
+            total = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                total += count
+                yield self.name + '_bucket' + _labels(
+                    self.label_names, key, 'le="%s"' % bound), total
+            yield self.name + '_sum' + _labels(self.label_names, key), counts[-1]
+            yield self.name + '_count' + _labels(self.label_names, key), total
+
+
+class Registry(object):
+    """"""
+
+    def __init__(self):
+        self.metrics = {}
+        self.collectors = []
+        self.lock = threading.Lock()
+
+    def _get(self, cls, name, help, labels, **kwargs):
+        with self.lock:
+            metric = self.metrics.get(name)
+            if metric is None:
+                metric = self.metrics[name] = cls(name, help, labels, **kwargs)
+            return metric
+
+    def counter(self, name, help='', labels=()):
+        return self._get(Counter, name, help, labels)
+
+    def gauge(self, name, help='', labels=()):
+        return self._get(Gauge, name, help, labels)
+
+    def histogram(self, name, help='', labels=(), buckets=None):
+        return self._get(Histogram, name, help, labels, buckets=buckets)
+
+    def collector(self, method):
+        """ Register a bound method run before every exposition,
+        held weakly so it does not keep its object alive
+        """
+        with self.lock:
+            self.collectors.append(weakref.WeakMethod(method))
+
+    def collect(self):
+        with self.lock:
+            self.collectors = [ref for ref in self.collectors if ref()]
+            collectors = [ref() for ref in self.collectors]
+        for method in collectors:
+            if method is None:
+                continue
+            try:
+                method()
+            except Exception as e:
+                log.error('Metrics Collector Error, %s' % repr(e))
+
+    def exposition(self):
+        """ Prometheus text format """
+        self.collect()
+        with self.lock:
+            metrics = list(self.metrics.values())
+        return '\n'.join(metric.exposition() for metric in metrics) + '\n'
+
+    def serve(self, port, addr='127.0.0.1'):
+        """ Serve the exposition on http://addr:port/metrics """
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+        registry = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = registry.exposition().encode('utf-8')
+                self.send_response(200)
+                self.send_header(
+                    'Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        server = ThreadingHTTPServer((addr, port), Handler)
+        t = threading.Thread(target=server.serve_forever, name='metrics')
+        t.daemon = True
+        t.start()
+        return server
+
+    def push(self, callback, interval=60):
+        """ callback(exposition) every `interval` seconds """
+        def run():
+            while True:
+                time.sleep(interval)
+                try:
+                    callback(self.exposition())
+                except Exception as e:
+                    log.error('Metrics Push Error, %s' % repr(e))
+
+        t = threading.Thread(target=run, name='metrics-push')
+        t.daemon = True
+        t.start()
+        return t
+
+
+REGISTRY = Registry()
+serve = REGISTRY.serve
+push = REGISTRY.push
+
+REQUEST_LATENCY = REGISTRY.histogram(
+    'wechatpy_request_seconds', 'Request latency by endpoint', ('endpoint',))
+REQUEST_ERRORS = REGISTRY.counter(
+    'wechatpy_request_errors_total', 'Failed requests by endpoint',
+    ('endpoint',))
+SYNC_CHECKS = REGISTRY.counter(
+    'wechatpy_synccheck_total', 'synccheck results',
+    ('bot', 'retcode', 'selector'))
+MSGS_RECEIVED = REGISTRY.counter(
+    'wechatpy_msgs_received_total', 'Messages received', ('bot',))
+MSGS_SENT = REGISTRY.counter(
+    'wechatpy_msgs_sent_total', 'Messages sent', ('bot',))
+MSGS_SEND_FAILED = REGISTRY.counter(
+    'wechatpy_msgs_send_failures_total', 'Messages failed to send', ('bot',))
+MSGS_DUPLICATE = REGISTRY.counter(
+    'wechatpy_msgs_duplicate_total', 'Redelivered messages dropped', ('bot',))
+MSG_QUEUE_DEPTH = REGISTRY.gauge(
+    'wechatpy_msg_queue_depth', 'Store.msgs depth', ('bot',))
+MSG_QUEUE_DROPPED = REGISTRY.gauge(
+    'wechatpy_msg_queue_dropped', 'Messages dropped by Store.msgs', ('bot',))
+CONTACTS = REGISTRY.gauge(
+    'wechatpy_contacts', 'Contacts in the store', ('bot',))
@@ -0,0 +1,85 @@
+""" Protocol Response Parsers
+  Precompiled parsers for the web protocol responses,
+  and `loads` which decodes json from raw bytes with the fastest
+  installed backend: orjson, ujson, json.
+"""
+
+import re
+import json
+
+try:
+    import orjson as _json
+except ImportError:
+    try:
+        import ujson as _json
+    except ImportError:
+        _json = json
+
+JSON_BACKEND = _json.__name__
+
+JSLOGIN = re.compile(
+    r'window.QRLogin.code = (?P<code>\d+); window.QRLogin.uuid = '
+    r'"(?P<uuid>\S+?)";'
+)
+LOGIN_CODE = re.compile(r'window.code=(?P<code>\d+)')
+REDIRECT_URI = re.compile(r'window.redirect_uri="(?P<redirect_uri>\S+)";')
+XML_NODE = re.compile(r'<(\w+)>([^<]*)</\1>')
+SYNCCHECK = re.compile(
+    r'window.synccheck={retcode:"(?P<retcode>\d+)",'
+    r'selector:"(?P<selector>\d+)"}'
+)
+
+GROUP_CONTENT_SEP = ':<br/>'
+
+
+def loads(content):
+    """ Decode json from bytes or str """
+    try:
+        return _json.loads(content)
+    except ValueError:
+        if isinstance(content, bytes):
+            return json.loads(content.decode('utf-8', 'replace'))
+        raise
+
+
+def parse_jslogin(text):
+    """ {'code': '200', 'uuid': '...'} """
+    res = JSLOGIN.search(text)
+    return res.groupdict() if res else {}
+
+
+def parse_login(text):
+    """ {'code': '200'} """
+    res = LOGIN_CODE.search(text)
+    return res.groupdict() if res else {}
+
+
+def parse_redirect_uri(text):
+    """ {'redirect_uri': '...'} """
+    res = REDIRECT_URI.search(text)
+    return res.groupdict() if res else {}
+
+
+def parse_redirect(text):
+    """ <error><ret>0</ret><skey>...</skey>...</error>
+    -> {'ret': '0', 'skey': '...', ...}
+    """
+    return dict(XML_NODE.findall(text))
+
+
+def parse_synccheck(text):
+    """ window.synccheck={retcode:"0",selector:"2"}
+    -> {'retcode': '0', 'selector': '2'}
+    """
+    res = SYNCCHECK.search(text)
+    return res.groupdict() if res else {}
+
+
+def parse_group_content(content):
+    """ '@75c2dc6b...:<br/>BB' -> ('@75c2dc6b...', 'BB')
+    (None, content) for contents without a sender
+    """
+    user_name, sep, text = content.partition(GROUP_CONTENT_SEP)
+    if sep and user_name.startswith('@') and user_name[1:].isalnum():
+        return user_name, text
+    return None, content
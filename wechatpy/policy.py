@@ -0,0 +1,111 @@
+""" Retry Policy
+  The request policies of `transport.AssSession`, kept free of requests
+  so the sync loop and the asyncio engine import them cheaply:
+    - exponential backoff with jitter
+    - a retry budget
+    - a circuit breaker per host
+"""
+
+import time
+import random
+import threading
+from urllib.parse import urlsplit
+
+from . import config
+
+
+def endpoint(url):
+    """ https://wx2.qq.com/cgi-bin/mmwebwx-bin/webwxsync?sid= -> webwxsync """
+    path = urlsplit(url).path
+    return path[path.rfind('/') + 1:]
+
+
+def backoff(attempt, base=None, cap=None):
+    """ Full jitter backoff, seconds """
+    base = config.BACKOFF_BASE if base is None else base
+    cap = config.BACKOFF_MAX if cap is None else cap
+    # the exponent is clamped, 2.0 ** 1024 overflows
+    return random.uniform(0, min(cap, base * 2.0 ** min(attempt, 64)))
+
+
+class RetryBudget(object):
+    """ Every request deposits `ratio` token, every retry withdraws one """
+
+    def __init__(self, ratio=None, maximum=None):
+        self.ratio = config.RETRY_BUDGET_RATIO if ratio is None else ratio
+        self.maximum = config.RETRY_BUDGET_MAX if maximum is None else maximum
+        self.tokens = self.maximum
+        self.lock = threading.Lock()
+
+    def deposit(self):
+        with self.lock:
+            self.tokens = min(self.maximum, self.tokens + self.ratio)
+
+    def withdraw(self):
+        with self.lock:
+            if self.tokens < 1:
+                return False
+            self.tokens -= 1
+            return True
+
+
+class CircuitBreaker(object):
+    """
+    * closed: requests pass, `threshold` consecutive failures open it
+    * open: requests fail fast for `reset` seconds
+    * half open: one probe passes, its result closes or reopens it
+    """
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, threshold=None, reset=None):
+        self.threshold = config.BREAKER_THRESHOLD \
+            if threshold is None else threshold
+        self.reset = config.BREAKER_RESET if reset is None else reset
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0
+        self.lock = threading.Lock()
+
+    def allow(self):
+        with self.lock:
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.OPEN and \
+                    time.time() - self.opened_at >= self.reset:
+                self.state = self.HALF_OPEN
+                return True
+            return False
+
+    def retry_after(self):
+        """ Seconds until an open breaker lets a probe through, else 0 """
+        with self.lock:
+            if self.state != self.OPEN:
+                return 0
+            return max(0, self.opened_at + self.reset - time.time())
+
+    def success(self):
+        with self.lock:
+            self.state = self.CLOSED
+            self.failures = 0
+
+    def failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.state == self.HALF_OPEN or \
+                    self.failures >= self.threshold:
+                self.state = self.OPEN
+                self.opened_at = time.time()
+
+
+def pool_hosts():
+    """ {'https://login.weixin.qq.com': 'login', ...} """
+    hosts = {config.ROOT_URL: 'login'}
+    for index_url, (file_url, sync_url) in config.BEAT_URL:
+        # BEAT_URL keys are matched within the ticket, 'qq.com' for
+        # wx.qq.com, the index host is the file host without 'file.'
+        hosts['https://%s' % file_url.split('.', 1)[1]] = 'index'
+        hosts['https://%s' % file_url] = 'file'
+        hosts['https://%s' % sync_url] = 'webpush'
+    return hosts
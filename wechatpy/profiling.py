@@ -0,0 +1,157 @@
+""" Profiling
+  Opt-in profiling of the hot paths:
+
+  * enter/exit hooks around the `profiled` functions,
+    handle_msg, receive_msg, _post_res, Store.select and send_msg
+
+        profiling.add_hook(
+            enter=lambda name: ...,
+            exit=lambda name, seconds, error: ...,
+        )
+
+  * SamplingProfiler, samples the stacks of a fraction of the sync
+    iterations and writes them as collapsed stacks for flamegraph.pl
+
+        bot.enable_profiling(fraction=0.01, path='assbot.folded')
+"""
+
+import sys
+import time
+import random
+import logging
+import inspect
+import functools
+import threading
+from collections import Counter
+
+from . import config
+
+log = logging.getLogger('assbot')
+
+HOOKS = []
+
+
+def add_hook(enter=None, exit=None):
+    """ enter(name), exit(name, seconds, error) around `profiled` calls """
+    hook = (enter, exit)
+    HOOKS.append(hook)
+    return hook
+
+
+def remove_hook(hook):
+    HOOKS.remove(hook)
+
+
+def _enter(name):
+    for enter, _ in HOOKS:
+        if enter:
+            enter(name)
+
+
+def _exit(name, start, error):
+    seconds = time.perf_counter() - start
+    for _, exit in HOOKS:
+        if exit:
+            exit(name, seconds, error)
+
+
+def profiled(name):
+    """ Run the hooks around the function, a list check when there are none """
+    def decorator(func):
+        if inspect.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                if not HOOKS:
+                    return await func(*args, **kwargs)
+                _enter(name)
+                start, error = time.perf_counter(), None
+                try:
+                    return await func(*args, **kwargs)
+                except BaseException as e:
+                    error = e
+                    raise
+                finally:
+                    _exit(name, start, error)
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not HOOKS:
+                return func(*args, **kwargs)
+            _enter(name)
+            start, error = time.perf_counter(), None
+            try:
+                return func(*args, **kwargs)
+            except BaseException as e:
+                error = e
+                raise
+            finally:
+                _exit(name, start, error)
+        return wrapper
+    return decorator
+
+
+class SamplingProfiler(object):
+    """ Samples the stack of the sync thread every `interval` seconds
+    during a random `fraction` of the sync iterations
+    """
+
+    def __init__(self, fraction=None, interval=None, path=None,
+                 flush_every=None):
+        self.fraction = config.PROFILE_FRACTION \
+            if fraction is None else fraction
+        self.interval = interval or config.PROFILE_INTERVAL
+        self.path = path or config.PROFILE_PATH
+        self.flush_every = flush_every or config.PROFILE_FLUSH_EVERY
+        self.stacks = Counter()
+        self.lock = threading.Lock()
+        self.sampling = threading.Event()
+        self.thread_id = None
+        self.sampler = None
+        self.iterations = self.sampled = 0
+
+    def iteration(self):
+        """ Called by the sync thread at the start of every iteration """
+        self.iterations += 1
+        if self.sampling.is_set():
+            self.sampling.clear()
+            if self.sampled % self.flush_every == 0:
+                self.flush()
+        if random.random() >= self.fraction:
+            return
+        self.sampled += 1
+        self.thread_id = threading.get_ident()
+        if self.sampler is None:
+            self.sampler = threading.Thread(
+                target=self._sample, name='profiler')
+            self.sampler.daemon = True
+            self.sampler.start()
+        self.sampling.set()
+
+    def _sample(self):
+        while True:
+            self.sampling.wait()
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append('%s:%s' % (code.co_filename, code.co_name))
+                frame = frame.f_back
+            if stack:
+                with self.lock:
+                    self.stacks[';'.join(reversed(stack))] += 1
+            time.sleep(self.interval)
+
+    def flush(self):
+        """ Write the collapsed stacks, `stack count` per line """
+        with self.lock:
+            lines = ['%s %d\n' % item for item in self.stacks.items()]
+        try:
+            with open(self.path, 'w') as fp:
+                fp.writelines(lines)
+        except OSError as e:
+            log.error('Profile Flush Error, %s' % repr(e))
+
+    def stop(self):
+        self.sampling.clear()
+        self.flush()
@@ -0,0 +1,126 @@
+""" Records
+  Compact `__slots__` records of contacts, group members and messages,
+  in place of the raw server json:
+    - only the fields the bot uses, UserNames interned
+    - ContactType computed once, when the contact is ingested
+    - the raw json kept only with `keep_raw`, `config.KEEP_RAW`
+
+  Records read like the dicts they replace, `contact['NickName']`,
+  `contact.get('Alias')`, fields missing from the record fall back to
+  the raw json when kept. `to_dict` for json.
+"""
+
+import sys
+from types import MappingProxyType
+
+from . import config
+
+intern = sys.intern
+
+EMPTY = MappingProxyType({})
+
+
+class Record(object):
+    """"""
+    __slots__ = ('raw',)
+    FIELDS = ()
+    STRINGS = ()  # interned fields
+
+    def __init__(self, data, keep_raw=None):
+        keep_raw = config.KEEP_RAW if keep_raw is None else keep_raw
+        self.raw = data if keep_raw else None
+        for field in self.FIELDS:
+            setattr(self, field, data.get(field))
+        for field in self.STRINGS:
+            value = getattr(self, field)
+            if value is not None:
+                setattr(self, field, intern(value))
+
+    def __getitem__(self, key):
+        if key in self.FIELDS:
+            return getattr(self, key)
+        if self.raw is not None:
+            return self.raw[key]
+        raise KeyError(key)
+
+    def get(self, key, default=None):
+        """ `default` also for the fields absent from the json, None """
+        try:
+            value = self[key]
+        except KeyError:
+            return default
+        return default if value is None else value
+
+    def __contains__(self, key):
+        return key in self.FIELDS or (
+            self.raw is not None and key in self.raw)
+
+    def keys(self):
+        if self.raw is None:
+            return list(self.FIELDS)
+        return list(dict.fromkeys(self.FIELDS + tuple(self.raw)))
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def items(self):
+        return [(key, self[key]) for key in self.keys()]
+
+    def to_dict(self):
+        ret = dict(self.raw) if self.raw is not None else {}
+        for field in self.FIELDS:
+            ret[field] = getattr(self, field)
+        return ret
+
+    def __repr__(self):
+        return '<%s %s>' % (self.__class__.__name__, self.get('UserName'))
+
+
+class Contact(Record):
+    """ `ContactType`, see `WeChatBot.contact_type` """
+    __slots__ = FIELDS = (
+        'UserName', 'NickName', 'RemarkName', 'Alias', 'DisplayName',
+        'ContactType', 'VerifyFlag', 'MemberCount',
+    )
+    STRINGS = ('UserName', )
+
+    def __init__(self, data, contact_type=None, keep_raw=None):
+        super(Contact, self).__init__(data, keep_raw)
+        if contact_type is not None:
+            self.ContactType = contact_type
+
+
+class Member(Record):
+    """"""
+    __slots__ = FIELDS = ('UserName', 'NickName', 'DisplayName')
+    STRINGS = ('UserName', )
+
+
+class Message(Record):
+    """ A received message, `FromUser` and `FromGroup` are the records
+    of the sender and of its group
+    """
+    __slots__ = FIELDS = (
+        'MsgId', 'MsgType', 'FromUserName', 'ToUserName', 'Content',
+        'CreateTime', 'MediaId', 'FileName', 'FromUser', 'FromGroup',
+        'ReceiveTime',
+    )
+    STRINGS = ('FromUserName', 'ToUserName')
+
+    def __setitem__(self, key, value):
+        if key not in self.FIELDS:
+            raise KeyError(key)
+        setattr(self, key, value)
+
+    def to_dict(self):
+        ret = super(Message, self).to_dict()
+        for key in ('FromUser', 'FromGroup'):
+            if ret[key] is not None:
+                ret[key] = dict(ret[key])
+        return ret
+
+    def __repr__(self):
+        return '<Message %s>' % self.MsgId
@@ -0,0 +1,104 @@
+""" Contact Resolver
+  Resolves unknown UserNames with one batched lookup:
+    - concurrent lookups of the same UserName share one in-flight request
+    - failed lookups are kept in a short-TTL negative cache
+"""
+
+import time
+import threading
+
+from . import config
+from .exception import WeChatBotError
+
+
+class ContactResolver(object):
+    """"""
+
+    def __init__(self, fetch, ttl=config.NEGATIVE_CONTACT_TTL):
+        """
+        :param fetch: `add_new_contact` like callable,
+            fetch([{'UserName': '@...'}]) -> {'contacts': [...], ...}
+        :param ttl: seconds a failed UserName is not looked up again
+        """
+        self.fetch = fetch
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.pending = {}
+        self.missing = {}
+
+    def _claim(self, user_names, now):
+        """ Split `user_names` into names to fetch and lookups to wait """
+        own, wait = [], []
+        for user_name in set(user_names):
+            expire = self.missing.get(user_name)
+            if expire is not None:
+                if expire > now:
+                    continue
+                del self.missing[user_name]
+            if user_name in self.pending:
+                wait.append(self.pending[user_name])
+            else:
+                own.append(user_name)
+        return own, wait
+
+    def _release(self, own, found, now):
+        for user_name in own:
+            if user_name not in found:
+                self.missing[user_name] = now + self.ttl
+        if len(self.missing) > config.NEGATIVE_CONTACT_SIZE:
+            for user_name, expire in list(self.missing.items()):
+                if expire <= now:
+                    del self.missing[user_name]
+
+    def _found(self, res):
+        return {contact.get('UserName') for contact in res.get('contacts', [])}
+
+    def resolve(self, user_names):
+        """ Look up `user_names`, blocks until they are resolved or failed """
+        now = time.time()
+        with self.lock:
+            own, wait = self._claim(user_names, now)
+            event = threading.Event()
+            for user_name in own:
+                self.pending[user_name] = event
+        if own:
+            found = set()
+            try:
+                found = self._found(
+                    self.fetch([{'UserName': user_name} for user_name in own]))
+            except (WeChatBotError, Exception):
+                pass
+            finally:
+                with self.lock:
+                    self._release(own, found, now)
+                    for user_name in own:
+                        self.pending.pop(user_name, None)
+                event.set()
+        for pending in wait:
+            pending.wait()
+
+
+class AsyncContactResolver(ContactResolver):
+    """ ContactResolver for a coroutine `fetch`, used on one event loop """
+
+    async def resolve(self, user_names):
+        import asyncio
+        now = time.time()
+        own, wait = self._claim(user_names, now)
+        future = asyncio.get_running_loop().create_future()
+        for user_name in own:
+            self.pending[user_name] = future
+        if own:
+            found = set()
+            try:
+                found = self._found(await self.fetch(
+                    [{'UserName': user_name} for user_name in own]))
+            except (WeChatBotError, Exception):
+                pass
+            finally:
+                self._release(own, found, now)
+                for user_name in own:
+                    self.pending.pop(user_name, None)
+                future.set_result(None)
+        if wait:
+            await asyncio.gather(*set(wait))
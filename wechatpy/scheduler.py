@@ -0,0 +1,183 @@
+""" Send Scheduler
+  A fixed pool of workers sending through per-recipient token buckets,
+  a throttled recipient never holds back the others.
+
+    scheduler = SendScheduler()
+    scheduler.submit('@NickName:foo', bot.sender, msg)
+    scheduler.submit_many([(key, bot.sender, (msg, ), callback), ...])
+"""
+
+import time
+import heapq
+import logging
+import itertools
+import threading
+from collections import deque
+
+from . import config
+
+log = logging.getLogger('assbot')
+
+
+class TokenBucket(object):
+    """ `rate` tokens per second, at most `capacity` """
+
+    def __init__(self, rate, capacity=1):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.time()
+
+    def take(self, now=None):
+        """ 0 if a token is taken, otherwise seconds until the next one """
+        now = time.time() if now is None else now
+        self.tokens = min(
+            self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.rate
+
+
+class SendScheduler(object):
+    """"""
+
+    def __init__(self, workers=None, rate=None, capacity=None):
+        self.workers = workers or config.SEND_WORKERS
+        self.rate = rate or 1 / config.MAX_SEND_FREQUENCY
+        self.capacity = capacity or config.SEND_BURST
+        self.cond = threading.Condition()
+        self.queues = {}  # key -> deque([(enqueued_at, func, args, callback)])
+        self.buckets = {}
+        self.ready = []  # heap of (ready_at, seq, key), a key at most once
+        self.seq = itertools.count()
+        self.threads = []
+        self.alive = False
+        self.depth = self.started = self.sent = self.failed = 0
+        self.wait_total = self.wait_max = 0
+
+    def start(self):
+        with self.cond:
+            if self.alive:
+                return
+            self.alive = True
+            for i in range(self.workers):
+                t = threading.Thread(
+                    target=self._work, name='sender-%d' % i, daemon=True)
+                t.start()
+                self.threads.append(t)
+
+    def stop(self, wait=True):
+        with self.cond:
+            self.alive = False
+            self.cond.notify_all()
+        if wait:
+            for t in self.threads:
+                t.join()
+        self.threads = []
+
+    def submit(self, key, func, *args, callback=None):
+        """ Run func(*args) when `key` has a token, then callback(ok, res) """
+        if not self.alive:
+            self.start()
+        with self.cond:
+            q = self.queues.get(key)
+            if q is None:
+                q = self.queues[key] = deque()
+                heapq.heappush(self.ready, (0, next(self.seq), key))
+            q.append((time.time(), func, args, callback))
+            self.depth += 1
+            self.cond.notify()
+
+    def submit_many(self, tasks):
+        """ `submit` a batch of (key, func, args, callback) at once """
+        if not self.alive:
+            self.start()
+        now = time.time()
+        with self.cond:
+            for key, func, args, callback in tasks:
+                q = self.queues.get(key)
+                if q is None:
+                    q = self.queues[key] = deque()
+                    heapq.heappush(self.ready, (0, next(self.seq), key))
+                q.append((now, func, args, callback))
+            self.depth += len(tasks)
+            self.cond.notify_all()
+
+    def _next(self):
+        """ Pop the next runnable task, None when stopped """
+        with self.cond:
+            while self.alive:
+                now = time.time()
+                if not self.ready:
+                    self.cond.wait()
+                    continue
+                ready_at, _, key = self.ready[0]
+                if ready_at > now:
+                    self.cond.wait(ready_at - now)
+                    continue
+                heapq.heappop(self.ready)
+                bucket = self.buckets.get(key)
+                if bucket is None:
+                    bucket = self.buckets[key] = TokenBucket(
+                        self.rate, self.capacity)
+                delay = bucket.take(now)
+                if delay:
+                    heapq.heappush(self.ready, (now + delay, next(self.seq), key))
+                    continue
+                q = self.queues[key]
+                task = q.popleft()
+                if q:
+                    heapq.heappush(self.ready, (now, next(self.seq), key))
+                else:
+                    del self.queues[key]
+                    if len(self.buckets) > config.SEND_BUCKETS_MAX:
+                        self._prune(now)
+                self.depth -= 1
+                self.started += 1
+                wait = now - task[0]
+                self.wait_total += wait
+                self.wait_max = max(self.wait_max, wait)
+                return task
+
+    def _prune(self, now):
+        """ Drop the refilled buckets of idle recipients """
+        for key, bucket in list(self.buckets.items()):
+            if key not in self.queues and \
+                    bucket.tokens + (now - bucket.updated) * bucket.rate \
+                    >= bucket.capacity:
+                del self.buckets[key]
+
+    def _work(self):
+        while True:
+            task = self._next()
+            if task is None:
+                return
+            _, func, args, callback = task
+            try:
+                res, ok = func(*args), True
+            except Exception as e:
+                res, ok = e, False
+                log.error('Send Task Error, %s' % repr(e))
+            with self.cond:
+                if ok:
+                    self.sent += 1
+                else:
+                    self.failed += 1
+            if callback:
+                try:
+                    callback(ok, res)
+                except Exception as e:
+                    log.error('Send Callback Error, %s' % repr(e))
+
+    def stats(self):
+        with self.cond:
+            return {
+                'depth': self.depth,
+                'recipients': len(self.queues),
+                'sent': self.sent,
+                'failed': self.failed,
+                'wait_avg': self.wait_total / self.started if self.started else 0,
+                'wait_max': self.wait_max,
+            }
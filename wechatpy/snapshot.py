@@ -0,0 +1,67 @@
+""" Session Snapshot
+  A versioned json snapshot of a logged in session:
+  cookies, base_request, sync_key and host urls.
+"""
+
+import os
+import json
+import time
+
+from . import config
+
+SESSION_KEYS = (
+    'uuid', 'skey', 'wxsid', 'wxuin', 'pass_ticket', 'base_request',
+    'deviceid', 'ticket', 'file_url', 'sync_url', 'sync_key', 'sync_key_str',
+    'self',
+)
+
+
+def dump(cache, cookies, path):
+    """ Write the snapshot atomically, mode 0600 """
+    snapshot = {
+        'version': config.SESSION_VERSION,
+        'time': int(time.time()),
+        'cache': {key: cache.get(key) for key in SESSION_KEYS},
+        'cookies': [
+            {
+                'name': cookie.name,
+                'value': cookie.value,
+                'domain': cookie.domain,
+                'path': cookie.path,
+                'secure': cookie.secure,
+                'expires': cookie.expires,
+            }
+            for cookie in cookies
+        ],
+    }
+    tmp = '%s.tmp' % path
+    try:
+        os.remove(tmp)
+    except FileNotFoundError:
+        pass
+    # readable by the owner only, it holds the session credentials
+    fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    with os.fdopen(fd, 'w') as fp:
+        json.dump(snapshot, fp, ensure_ascii=False)
+    os.replace(tmp, path)
+
+
+def load(path):
+    """ The snapshot, None if missing, unreadable or of another version """
+    try:
+        with open(path) as fp:
+            snapshot = json.load(fp)
+    except (OSError, ValueError):
+        return None
+    if snapshot.get('version') != config.SESSION_VERSION:
+        return None
+    return snapshot
+
+
+def restore(snapshot, cache, cookies):
+    from requests.cookies import create_cookie
+    for key, value in snapshot['cache'].items():
+        if value is not None:
+            cache.set(key, value)
+    for cookie in snapshot['cookies']:
+        cookies.set_cookie(create_cookie(**cookie))
@@ -1,7 +1,19 @@
 """"""
+import json
+import time
 import pickle
+import sqlite3
 import itertools
-from queue import Queue
+import threading
+from queue import Empty
+from collections import deque, OrderedDict
+
+from . import config
+from . import parsers
+from .profiling import profiled
+from .records import Contact
+
+INDEXES = ('NickName', 'RemarkName', 'Alias', 'DisplayName', 'ContactType')
 
 
 class Cache(dict):
@@ -16,6 +28,9 @@ class Cache(dict):
     def set(self, key, value):
         self[key] = value
 
+    def delete(self, key):
+        self.pop(key, None)
+
     def all(self):
         return list(self.items())
 
@@ -35,6 +50,321 @@ class Cache(dict):
         return True
 
 
+class MsgQueue(object):
+    """ Bounded message queue
+
+    When full, `put` follows `policy`:
+        - block: wait for room, up to `timeout`
+        - drop_oldest: drop the oldest message
+        - drop_newest: drop the new message
+    `drain` takes up to `max_n` messages under one lock.
+    """
+    BLOCK = 'block'
+    DROP_OLDEST = 'drop_oldest'
+    DROP_NEWEST = 'drop_newest'
+
+    def __init__(self, maxsize=0, policy=BLOCK):
+        if policy not in (self.BLOCK, self.DROP_OLDEST, self.DROP_NEWEST):
+            raise ValueError('Unknown overflow policy %r' % policy)
+        self.maxsize = maxsize
+        self.policy = policy
+        self.queue = deque()
+        self.cond = threading.Condition()
+        self.high_watermark = self.dropped = self.puts = self.gets = 0
+
+    def __len__(self):
+        return len(self.queue)
+
+    def qsize(self):
+        return len(self.queue)
+
+    def empty(self):
+        return not self.queue
+
+    def full(self):
+        return 0 < self.maxsize <= len(self.queue)
+
+    def put(self, item, timeout=None):
+        """ False if `item`, or nothing for drop_oldest, was dropped """
+        with self.cond:
+            if self.full():
+                if self.policy == self.DROP_NEWEST:
+                    self.dropped += 1
+                    return False
+                if self.policy == self.DROP_OLDEST:
+                    self.queue.popleft()
+                    self.dropped += 1
+                elif not self.cond.wait_for(
+                        lambda: not self.full(), timeout):
+                    self.dropped += 1
+                    return False
+            self.queue.append(item)
+            self.puts += 1
+            self.high_watermark = max(self.high_watermark, len(self.queue))
+            self.cond.notify_all()
+            return True
+
+    def get(self, block=True, timeout=None):
+        with self.cond:
+            if block and not self.cond.wait_for(lambda: self.queue, timeout):
+                raise Empty
+            if not self.queue:
+                raise Empty
+            self.gets += 1
+            self.cond.notify_all()
+            return self.queue.popleft()
+
+    def drain(self, max_n=None, timeout=0):
+        """ Up to `max_n` messages, waits `timeout` for the first one """
+        with self.cond:
+            if timeout != 0:
+                self.cond.wait_for(lambda: self.queue, timeout)
+            n = len(self.queue) if max_n is None else min(max_n, len(self.queue))
+            ret = [self.queue.popleft() for _ in range(n)]
+            self.gets += n
+            if n:
+                self.cond.notify_all()
+            return ret
+
+    def stats(self):
+        return {
+            'depth': len(self.queue),
+            'high_watermark': self.high_watermark,
+            'dropped': self.dropped,
+            'put': self.puts,
+            'got': self.gets,
+        }
+
+
+class MemberCache(object):
+    """ Group member maps, {group UserName: {member UserName: member}}
+
+    Least recently used groups are evicted once the maps hold more than
+    `max_entries` members in all, the group just set is always kept.
+    """
+
+    def __init__(self, max_entries=None):
+        self.max_entries = config.MEMBER_CACHE_SIZE \
+            if max_entries is None else max_entries
+        self.groups = OrderedDict()
+        self.entries = 0
+        self.lock = threading.Lock()
+        self.hits = self.misses = self.evictions = 0
+
+    def __len__(self):
+        return len(self.groups)
+
+    def __contains__(self, group):
+        return group in self.groups
+
+    def get(self, group):
+        """ The member map of `group`, None if not loaded or evicted """
+        with self.lock:
+            members = self.groups.get(group)
+            if members is None:
+                self.misses += 1
+                return None
+            self.groups.move_to_end(group)
+            self.hits += 1
+            return members
+
+    def set(self, group, members):
+        with self.lock:
+            old = self.groups.pop(group, None)
+            if old is not None:
+                self.entries -= len(old)
+            self.groups[group] = members
+            self.entries += len(members)
+            while self.entries > self.max_entries and len(self.groups) > 1:
+                _, evicted = self.groups.popitem(last=False)
+                self.entries -= len(evicted)
+                self.evictions += 1
+
+    def discard(self, group):
+        with self.lock:
+            old = self.groups.pop(group, None)
+            if old is not None:
+                self.entries -= len(old)
+
+    def clear(self):
+        with self.lock:
+            self.groups.clear()
+            self.entries = 0
+
+    def stats(self):
+        return {
+            'groups': len(self.groups),
+            'entries': self.entries,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
+
+
+class MsgIdIndex(object):
+    """ MsgIds seen in the last `window` seconds, at most `max_entries`
+
+    Ids are kept in the order first seen, expired and overflowing ids
+    are popped from the front, a check is O(1) amortized.
+    """
+
+    def __init__(self, max_entries=None, window=None):
+        self.max_entries = config.MSG_DEDUP_SIZE \
+            if max_entries is None else max_entries
+        self.window = config.MSG_DEDUP_WINDOW if window is None else window
+        self.ids = OrderedDict()  # MsgId -> first seen
+        self.lock = threading.Lock()
+        self.checked = self.duplicates = self.expired = self.evictions = 0
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __contains__(self, msg_id):
+        return msg_id in self.ids
+
+    def seen(self, msg_id, now=None):
+        """ True if `msg_id` was seen within the window, else record it """
+        now = time.time() if now is None else now
+        with self.lock:
+            self.checked += 1
+            ids = self.ids
+            while ids:
+                oldest, first_seen = next(iter(ids.items()))
+                if now - first_seen < self.window:
+                    break
+                del ids[oldest]
+                self.expired += 1
+            if msg_id in ids:
+                self.duplicates += 1
+                return True
+            ids[msg_id] = now
+            if len(ids) > self.max_entries:
+                ids.popitem(last=False)
+                self.evictions += 1
+            return False
+
+    def clear(self):
+        with self.lock:
+            self.ids.clear()
+
+    def stats(self):
+        return {
+            'entries': len(self.ids),
+            'checked': self.checked,
+            'duplicates': self.duplicates,
+            'expired': self.expired,
+            'evictions': self.evictions,
+        }
+
+
+class SqliteCache(object):
+    """ Contacts persisted in sqlite, indexed on `INDEXES`
+
+    Opening is O(1): `Contact` records are decoded on first `get` and kept
+    in memory, writes are committed every `config.STORE_COMMIT_EVERY` sets
+    or on `flush`.
+    """
+
+    def __init__(self, path=None):
+        self.conn = sqlite3.connect(
+            path or config.STORE_PATH, check_same_thread=False)
+        self.lock = threading.RLock()
+        self.mirror = {}
+        self.pending = 0
+        columns = ''.join(', %s' % field for field in INDEXES)
+        with self.lock:
+            self.conn.execute(
+                'CREATE TABLE IF NOT EXISTS contacts '
+                '(key TEXT PRIMARY KEY, value BLOB%s)' % columns)
+            for field in INDEXES:
+                self.conn.execute(
+                    'CREATE INDEX IF NOT EXISTS contacts_%s '
+                    'ON contacts (%s)' % (field, field))
+            self.conn.execute(
+                'CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value)')
+            self.conn.commit()
+
+    def __len__(self):
+        with self.lock:
+            return self.conn.execute(
+                'SELECT COUNT(*) FROM contacts').fetchone()[0]
+
+    def _commit(self, force=False):
+        self.pending += 1
+        if force or self.pending >= config.STORE_COMMIT_EVERY:
+            self.conn.commit()
+            self.pending = 0
+
+    def flush(self):
+        with self.lock:
+            self.conn.commit()
+            self.pending = 0
+
+    def set(self, key, value):
+        data = value.to_dict() if hasattr(value, 'to_dict') else value
+        row = [key, json.dumps(data, ensure_ascii=False)]
+        row.extend(value.get(field) for field in INDEXES)
+        with self.lock:
+            self.mirror[key] = value
+            self.conn.execute(
+                'INSERT OR REPLACE INTO contacts VALUES (%s)' %
+                ', '.join('?' * len(row)), row)
+            self._commit()
+
+    def get(self, key, default=None):
+        with self.lock:
+            value = self.mirror.get(key)
+            if value is not None:
+                return value
+            row = self.conn.execute(
+                'SELECT value FROM contacts WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                return default
+            value = self.mirror[key] = Contact(parsers.loads(row[0]))
+            return value
+
+    def delete(self, key):
+        with self.lock:
+            self.mirror.pop(key, None)
+            self.conn.execute('DELETE FROM contacts WHERE key = ?', (key,))
+            self._commit()
+
+    def clear(self):
+        with self.lock:
+            self.mirror.clear()
+            self.conn.execute('DELETE FROM contacts')
+            self._commit(force=True)
+
+    def keys(self):
+        with self.lock:
+            return [row[0] for row in self.conn.execute(
+                'SELECT key FROM contacts')]
+
+    def items(self):
+        return [(key, self.get(key)) for key in self.keys()]
+
+    def all(self):
+        return self.items()
+
+    def lookup(self, field, value):
+        """ {key: None} of contacts whose `field` is `value` """
+        with self.lock:
+            return dict.fromkeys(row[0] for row in self.conn.execute(
+                'SELECT key FROM contacts WHERE %s = ?' % field, (value,)))
+
+    def load_session(self):
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT value FROM meta WHERE key = 'session'").fetchone()
+            return row[0] if row else None
+
+    def save_session(self, session):
+        with self.lock:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO meta VALUES ('session', ?)", (session,))
+            self._commit(force=True)
+
+
 class Store(object):
     """
     * 微信账号:
@@ -44,26 +374,124 @@ class Store(object):
         - 公众号
     * 微信消息:
         -
+
+    Contacts are indexed on `INDEXES`, `select` is a dict lookup per key.
+    A backend with its own `lookup(field, value)` keeps its own indexes.
+    Group members live apart from the contacts, in the `members` LRU.
+    MsgIds already received are in `seen`, redeliveries are not queued.
     """
 
+    INDEXES = INDEXES
+
     def __init__(self, backend=None):
         self.cache = backend() if backend else Cache()
-        self.msgs = Queue()
+        self.msgs = MsgQueue(config.MSG_QUEUE_SIZE, config.MSG_QUEUE_POLICY)
+        self.members = MemberCache()
+        self.seen = MsgIdIndex()
+        self.lock = threading.RLock()
+        self.indexes = {}
+        if not hasattr(type(self.cache), 'lookup'):
+            self.indexes = {field: {} for field in self.INDEXES}
+            for k, v in self.cache.items():
+                self._index(k, v)
+
+    def __len__(self):
+        return len(self.cache)
+
+    def _lookup(self, field, value):
+        if not self.indexes:
+            return self.cache.lookup(field, value)
+        return self.indexes[field].get(value, {})
+
+    def warm(self, session):
+        """ True if the backend holds the contacts of `session`,
+        otherwise the stale contacts are dropped and `session` recorded
+        """
+        load = getattr(self.cache, 'load_session', None)
+        if load is None:
+            return False
+        with self.lock:
+            if load() == session and len(self.cache):
+                return True
+            self.cache.clear()
+            self.members.clear()
+            self.cache.save_session(session)
+            return False
+
+    def flush(self):
+        flush = getattr(self.cache, 'flush', None)
+        if flush:
+            flush()
+
+    def _index(self, key, value):
+        for field, index in self.indexes.items():
+            val = value.get(field)
+            if val is not None:
+                index.setdefault(val, {})[key] = None
+
+    def _unindex(self, key, value):
+        for field, index in self.indexes.items():
+            val = value.get(field)
+            keys = index.get(val)
+            if keys is None:
+                continue
+            keys.pop(key, None)
+            if not keys:
+                del index[val]
 
     def update(self, k, v):
-        self.cache.set(k, v)
+        with self.lock:
+            old = self.cache.get(k)
+            if old is not None:
+                self._unindex(k, old)
+            self.cache.set(k, v)
+            self._index(k, v)
+
+    def delete(self, k):
+        with self.lock:
+            old = self.cache.get(k)
+            self.members.discard(k)
+            if old is None:
+                return
+            self._unindex(k, old)
+            self.cache.delete(k)
 
     def get(self, key):
         return self.cache.get(key)
 
-    def select(self, **kwargs):
-        """ Select """
-        ret = list()
-        limit = kwargs.get('limit', 1)
-        for l, (k, v) in zip(itertools.count(), kwargs.items()):
-            for user_name, user in self.cache.items():
-                if user.get(k) == v:
-                    ret.append(user)
-                if limit is not None and l == limit:
-                    return ret
+    def keys(self):
+        with self.lock:
+            return list(self.cache.keys())
+
+    @profiled('Store.select')
+    def select(self, limit=None, first=False, **kwargs):
+        """ Select contacts matching all of `kwargs`
+
+        :param limit: max number of contacts, None for all
+        :param first: return the first match or None instead of a list
+        :return: [contact, ...], nothing for no `kwargs`
+        """
+        if first:
+            limit = 1
+        if not kwargs:
+            return None if first else []
+        with self.lock:
+            keys = None
+            for field, value in kwargs.items():
+                if field in self.INDEXES:
+                    matched = self._lookup(field, value)
+                else:
+                    matched = {
+                        k: None for k, v in self.cache.items()
+                        if v.get(field) == value
+                    }
+                if keys is None:
+                    keys = matched
+                else:
+                    keys = {k: None for k in keys if k in matched}
+                if not keys:
+                    break
+            ret = [self.cache.get(k) for k in itertools.islice(keys, limit)]
+        if first:
+            return ret[0] if ret else None
         return ret
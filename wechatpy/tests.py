@@ -1 +1,1100 @@
+import os
+import time
+import json
+import asyncio
+import tempfile
+import unittest
+import threading
+from queue import Empty
+from unittest import mock
+
+from . import config
+from . import metrics
+from . import parsers
+from . import profiling
 from .core import WeChatBot
+from .dispatch import Dispatcher
+from .fake_broker import FakeBroker
+from .listeners import Fanout, Listener
+from .media import MultipartBody
+from .policy import CircuitBreaker, backoff
+from .records import EMPTY, Contact, Message
+from .resolver import ContactResolver
+from .scheduler import SendScheduler, TokenBucket
+from .storage import (
+    Cache, MemberCache, MsgIdIndex, MsgQueue, SqliteCache, Store)
+
+
+class ParsersTest(unittest.TestCase):
+
+    def test_login(self):
+        text = 'window.code=200;\nwindow.redirect_uri="https://wx.qq.com/x";'
+        self.assertEqual(parsers.parse_login(text), {'code': '200'})
+        self.assertEqual(parsers.parse_redirect_uri(text),
+                         {'redirect_uri': 'https://wx.qq.com/x'})
+        self.assertEqual(parsers.parse_login('window.code=408;'),
+                         {'code': '408'})
+        self.assertEqual(parsers.parse_redirect_uri('window.code=408;'), {})
+
+    def test_synccheck(self):
+        self.assertEqual(
+            parsers.parse_synccheck(
+                'window.synccheck={retcode:"1101",selector:"0"}'),
+            {'retcode': '1101', 'selector': '0'})
+        self.assertEqual(parsers.parse_synccheck('<html>'), {})
+
+    def test_loads_invalid_utf8(self):
+        body = b'{"Ret": 0, "NickName": "\xe4\xb8"}'  # a truncated sequence
+        for backend in (parsers._json, parsers.json):
+            with mock.patch.object(parsers, '_json', backend):
+                self.assertEqual(parsers.loads(body)['Ret'], 0)
+
+    def test_group_content(self):
+        self.assertEqual(parsers.parse_group_content('@a1:<br/>hi'),
+                         ('@a1', 'hi'))
+        self.assertEqual(parsers.parse_group_content('a:<br/>hi'),
+                         (None, 'a:<br/>hi'))
+
+
+class SnapshotTest(unittest.TestCase):
+
+    def test_dump_load_restore(self):
+        import requests
+        from . import snapshot
+        bot = WeChatBot(auto_reload=False)
+        bot.cache.set('skey', '@crypt_1')
+        cookies = requests.cookies.RequestsCookieJar()
+        cookies.set('wxsid', 'sid', domain='wx.qq.com', path='/')
+        with tempfile.TemporaryDirectory() as d:
+            path = os.path.join(d, '.session')
+            snapshot.dump(bot.cache, cookies, path)
+            if os.name == 'posix':
+                self.assertEqual(os.stat(path).st_mode & 0o777, 0o600)
+            saved = snapshot.load(path)
+        restored = WeChatBot(auto_reload=False)
+        jar = requests.cookies.RequestsCookieJar()
+        snapshot.restore(saved, restored.cache, jar)
+        self.assertEqual(restored.cache.skey, '@crypt_1')
+        self.assertEqual(jar.get('wxsid'), 'sid')
+
+
+class SessionSaveTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.bot = WeChatBot(auto_reload=False)
+        self.bot.configure(session_path=os.path.join(self.dir, '.session'))
+
+    def saved_key(self):
+        from . import snapshot
+        return snapshot.load(self.bot.session_path)['cache']['sync_key_str']
+
+    def sync_key(self, val):
+        self.bot._update_sync_key(
+            {'Count': 1, 'List': [{'Key': 1, 'Val': val}]})
+
+    def test_sync_key_refreshes_snapshot(self):
+        self.assertFalse(os.path.exists(self.bot.session_path))
+        self.sync_key(1)
+        self.assertEqual(self.saved_key(), '1_1')
+        self.sync_key(2)
+        self.assertEqual(self.saved_key(), '1_1')
+        with mock.patch.object(config, 'SESSION_SAVE_INTERVAL', 0):
+            self.sync_key(3)
+        self.assertEqual(self.saved_key(), '1_3')
+
+    def test_saved_on_interrupt(self):
+        bot = self.bot
+        bot.login = bot.status_notify = bot._init_all_contacts = mock.Mock()
+        bot._warm_start = mock.Mock(return_value=False)
+        bot.cache.set('self', {'UserName': '@me'})
+
+        def proc_msg():
+            self.sync_key(2)
+            raise KeyboardInterrupt
+        bot._proc_msg = proc_msg
+        self.sync_key(1)
+        with self.assertRaises(KeyboardInterrupt):
+            bot.run()
+        self.assertEqual(self.saved_key(), '1_2')
+        self.assertFalse(bot.alive)
+
+
+class HandleMsgTest(unittest.TestCase):
+
+    def setUp(self):
+        self.bot = WeChatBot(auto_reload=False)
+        self.bot.store.update('@@g', Contact(
+            {'UserName': '@@g', 'NickName': 'group'}, contact_type=2))
+        self.bot.store.members.set('@@g', {})
+
+    def test_group_msg(self):
+        msgs = self.bot.handle_msg({'AddMsgList': [{
+            'MsgId': '1', 'FromUserName': '@@g', 'Content': '@a1:<br/>hi'}]})
+        self.assertEqual(len(msgs), 1)
+        self.assertEqual(msgs[0]['FromUserName'], '@a1')
+        self.assertEqual(msgs[0]['Content'], 'hi')
+        self.assertEqual(msgs[0]['FromGroup']['NickName'], 'group')
+
+    def test_group_msg_without_sender(self):
+        msgs = self.bot.handle_msg({'AddMsgList': [{
+            'MsgId': '2', 'MsgType': 10000, 'FromUserName': '@@g',
+            'Content': 'system notice'}]})
+        self.assertEqual(len(msgs), 1)
+        self.assertIsNone(msgs[0]['FromUserName'])
+        self.assertEqual(msgs[0]['Content'], 'system notice')
+        self.assertIs(msgs[0]['FromUser'], EMPTY)
+
+
+class BroadcastTest(unittest.TestCase):
+
+    def setUp(self):
+        self.sent = []
+
+    def make_bot(self, cls):
+        bot = cls(auto_reload=False)
+        bot.cache.set('self', {'UserName': '@me'})
+        for user_name in ('@a', '@b'):
+            bot.store.update(user_name, Contact(
+                {'UserName': user_name, 'NickName': user_name[1:]},
+                contact_type=1))
+        return bot
+
+    def post(self, url='', data=None, **kwargs):
+        self.sent.append(json.loads(data)['Msg']['ToUserName'])
+        return {'BaseResponse': {'Ret': 0}}
+
+    def check(self, res):
+        self.assertEqual(sorted(self.sent), ['@a', '@b'])
+        self.assertEqual([r['ok'] for r in res], [False, True, True])
+        self.assertEqual(res[0]['error'], 'Not Found')
+
+    def test_broadcast(self):
+        bot = self.make_bot(WeChatBot)
+        bot._post_res = self.post
+        self.check(bot.broadcast('hi', ['@a', {'NickName': 'b'}, '@c', '@b']))
+
+    def test_async_broadcast(self):
+        from .aio import AsyncWeChatBot
+        bot = self.make_bot(AsyncWeChatBot)
+
+        async def post(**kwargs):
+            return self.post(**kwargs)
+        bot._post_res = post
+        self.check(asyncio.run(
+            bot.broadcast('hi', ['@a', {'NickName': 'b'}, '@c', '@b'])))
+
+
+class SyncLoopTest(unittest.TestCase):
+
+    def test_no_response_is_not_a_logout(self):
+        bot = WeChatBot(auto_reload=False)
+        codes = [(-1, -1)] * 10 + [('1101', '0')] * config.MAX_RETRY
+        calls = []
+
+        def sync_check():
+            calls.append(1)
+            return codes[len(calls) - 1]
+        bot.sync_check = sync_check
+        with mock.patch('wechatpy.core.backoff', return_value=0):
+            bot._proc_msg()
+        self.assertEqual(len(calls), len(codes))
+        self.assertFalse(bot.alive)
+
+    def test_bad_contact_delta(self):
+        bot = WeChatBot(auto_reload=False)
+        codes = [('0', '2')] + [('1101', '0')] * config.MAX_RETRY
+        calls = []
+
+        def sync_check():
+            calls.append(1)
+            return codes[len(calls) - 1]
+        bot.sync_check = sync_check
+        bot.sync = lambda: {
+            'ModContactList': [
+                {'UserName': '@a'}, 'junk',
+                {'UserName': '@b', 'VerifyFlag': 'x'},
+                {'UserName': '@@g', 'VerifyFlag': 0}],
+            'DelContactList': [{'UserName': '@old'}, {}],
+        }
+        bot.store.update('@old', Contact({'UserName': '@old'}, contact_type=3))
+        with mock.patch('wechatpy.core.backoff', return_value=0):
+            bot._proc_msg()
+        self.assertEqual(len(calls), len(codes))
+        self.assertEqual(bot.store.get('@a').ContactType, 3)
+        self.assertEqual(bot.store.get('@@g').ContactType, 2)
+        self.assertIsNone(bot.store.get('@b'))
+        self.assertIsNone(bot.store.get('@old'))
+
+    def test_backoff_after_many_errors(self):
+        self.assertLessEqual(backoff(5000, base=0.5, cap=10), 10)
+        bot = WeChatBot(auto_reload=False)
+        self.assertLessEqual(bot._retry_delay(5000), config.BACKOFF_MAX)
+
+    def test_breaker_retry_after(self):
+        breaker = CircuitBreaker(threshold=1, reset=30)
+        self.assertEqual(breaker.retry_after(), 0)
+        breaker.failure()
+        self.assertFalse(breaker.allow())
+        self.assertGreater(breaker.retry_after(), 29)
+
+
+class PoolAdaptersTest(unittest.TestCase):
+
+    def test_index_hosts(self):
+        from .transport import AssSession, pool_adapters
+        adapters = pool_adapters()
+        session = AssSession(adapters=adapters)
+        for host in ('wx.qq.com', 'wx2.qq.com', 'web.wechat.com'):
+            self.assertIs(
+                session.get_adapter('https://%s/cgi-bin/mmwebwx-bin/webwxsync'
+                                    % host),
+                adapters['https://%s' % host])
+        self.assertIs(
+            session.get_adapter('https://file.wx.qq.com/cgi-bin/x'),
+            adapters['https://file.wx.qq.com'])
+
+
+class AsyncTimeoutTest(unittest.TestCase):
+
+    def test_endpoint_timeouts(self):
+        from .aio import client_timeout
+        timeout = client_timeout('https://wx.qq.com/jslogin?appid=x')
+        self.assertEqual(
+            (timeout.sock_connect, timeout.sock_read), config.DEFAULT_TIMEOUT)
+        timeout = client_timeout('https://wx.qq.com/cgi-bin/webwxgetmedia')
+        self.assertEqual((timeout.sock_connect, timeout.sock_read),
+                         config.TIMEOUTS['webwxgetmedia'])
+        self.assertEqual(client_timeout('https://wx.qq.com/x', 35).total, 35)
+
+
+class AsyncMediaTest(unittest.TestCase):
+
+    def setUp(self):
+        from .fake_server import FakeWeChatServer
+        self.server = FakeWeChatServer(media_size=100000).start()
+        self.addCleanup(self.server.stop)
+        self.dir = tempfile.mkdtemp()
+
+    def make_bot(self):
+        from .aio import AsyncWeChatBot
+        bot = AsyncWeChatBot(auto_reload=False)
+        url = '%s/cgi-bin/mmwebwx-bin' % self.server.url
+        for key, value in (('ticket', url), ('file_url', url),
+                           ('pass_ticket', 'fake'), ('skey', 'fake'),
+                           ('base_request', {}),
+                           ('self', {'UserName': '@me'})):
+            bot.cache.set(key, value)
+        bot.store.update('@a', Contact(
+            {'UserName': '@a', 'NickName': 'a'}, contact_type=1))
+        return bot
+
+    def test_send_image(self):
+        bot = self.make_bot()
+        path = os.path.join(self.dir, 'cat.jpg')
+        with open(path, 'wb') as fp:
+            fp.write(os.urandom(3000))
+
+        async def send():
+            try:
+                return await bot.send_image(path, NickName='a')
+            finally:
+                await bot.close()
+        with mock.patch.object(config, 'MEDIA_CHUNK_SIZE', 1024):
+            self.assertEqual(asyncio.run(send()), [1])
+        self.assertGreater(self.server.uploaded, 3000)
+        self.assertEqual(self.server.sent[0]['ToUserName'], '@a')
+        self.assertEqual(self.server.sent[0]['Type'], 3)
+
+    def test_download(self):
+        bot = self.make_bot()
+        path = os.path.join(self.dir, 'image')
+
+        async def download():
+            try:
+                return await bot.download({'MsgId': '1', 'MsgType': 3}, path)
+            finally:
+                await bot.close()
+        self.assertEqual(asyncio.run(download()), path)
+        self.assertEqual(os.path.getsize(path), 100000)
+        self.assertIsNone(asyncio.run(bot.download({'MsgType': 1})))
+
+
+class DispatcherTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dispatcher = Dispatcher(workers=2)
+
+    def tearDown(self):
+        self.dispatcher.shutdown()
+
+    def test_handler_gets_records(self):
+        called = threading.Event()
+
+        @self.dispatcher.register(msg_type=1, pattern='^ping')
+        def ping(msg):
+            called.set()
+
+        # no ReceiveTime nor CreateTime
+        msg = Message({'MsgId': '1', 'MsgType': 1, 'Content': 'ping'})
+        self.assertEqual(self.dispatcher.dispatch(msg), 1)
+        self.assertTrue(called.wait(5))
+        self.assertEqual(self.dispatcher.dispatch(
+            Message({'MsgId': '2', 'MsgType': 1, 'Content': 'pong'})), 0)
+
+    def test_bad_delay_field_is_logged(self):
+        called = threading.Event()
+
+        @self.dispatcher.register()
+        def handler(msg):
+            called.set()
+
+        self.dispatcher.dispatch({'MsgType': 1, 'ReceiveTime': 'now'})
+        self.dispatcher.shutdown()
+        self.assertEqual(self.dispatcher.stats()['handler']['errors'], 0)
+        self.assertTrue(called.is_set())
+        self.assertEqual(self.dispatcher.delay_stats(), {})
+
+    def test_concurrency_does_not_hold_workers(self):
+        release, other = threading.Event(), threading.Event()
+        running, peak = [0], [0]
+        lock = threading.Lock()
+
+        @self.dispatcher.register(msg_type=1, concurrency=1)
+        def slow(msg):
+            with lock:
+                running[0] += 1
+                peak[0] = max(peak[0], running[0])
+            release.wait(5)
+            with lock:
+                running[0] -= 1
+
+        @self.dispatcher.register(msg_type=2)
+        def fast(msg):
+            other.set()
+
+        for i in range(10):
+            self.dispatcher.dispatch({'MsgType': 1})
+        self.dispatcher.dispatch({'MsgType': 2})
+        # one worker runs slow, the other is free for fast
+        self.assertTrue(other.wait(5))
+        self.assertEqual(self.dispatcher.stats()['slow']['pending'], 9)
+        release.set()
+        self.dispatcher.shutdown()
+        self.assertEqual(self.dispatcher.stats()['slow']['calls'], 10)
+        self.assertEqual(peak[0], 1)
+
+
+class ListenerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.broker = FakeBroker()
+        self.handled = []
+        self.listener = None
+
+    def tearDown(self):
+        if self.listener:
+            self.listener.stop()
+
+    def start(self, handler, **kwargs):
+        kwargs.setdefault('batch_timeout', 0.01)
+        self.listener = Listener({'q': handler}, connect=self.broker.connect,
+                                 **kwargs).start()
+
+    def wait(self, check, timeout=5):
+        deadline = time.time() + timeout
+        while not check():
+            if time.time() > deadline:
+                self.fail('timed out, %r' % self.broker.stats())
+            time.sleep(0.005)
+
+    def settled(self):
+        return self.broker.published and not self.broker.depth() and \
+            not self.broker.unacked()
+
+    def test_ack_after_handler(self):
+        held = []
+
+        def handler(deliveries):
+            held.extend(deliveries)
+        self.start(handler, prefetch=3)
+        for i in range(5):
+            self.broker.publish('q', 'm%d' % i)
+        self.wait(lambda: len(held) == 3)
+        self.assertEqual(self.broker.unacked(), 3)
+        self.assertEqual(self.broker.acked, 0)
+        for delivery in held[:]:
+            delivery.ack()
+        self.wait(lambda: len(held) == 5)
+        for delivery in held[3:]:
+            delivery.ack()
+        self.wait(self.settled)
+        self.assertEqual(self.broker.acked, 5)
+
+    def test_redelivery_is_not_handled_again(self):
+        held = []
+
+        def handler(deliveries):
+            held.extend(deliveries)
+        self.start(handler)
+        self.broker.publish('q', 'same', message_id='1')
+        self.wait(lambda: held)
+        self.broker.drop()
+        # sent while the connection was down, the ack is lost
+        held[0].ack()
+        self.wait(self.settled)
+        self.assertEqual(len(held), 1)
+        self.assertEqual(self.listener.stats()['duplicates'], 1)
+
+    def test_reconnect_while_held(self):
+        ready = [False]
+        held = []
+
+        def handler(deliveries):
+            held.extend(deliveries)
+        self.start(handler, ready=lambda queue: ready[0])
+        self.broker.publish('q', 'm', message_id='1')
+        self.wait(lambda: self.listener.stats()['inflight'])
+        self.broker.drop()
+        self.wait(lambda: self.broker.redelivered and self.broker.unacked())
+        ready[0] = True
+        self.wait(lambda: held)
+        held[0].ack()
+        self.wait(self.settled)
+        self.assertEqual(len(held), 1)
+        self.assertTrue(held[0].redelivered)
+        self.assertEqual(self.listener.stats()['inflight'], 0)
+
+    def test_identical_bodies_without_message_id(self):
+        held = []
+
+        def handler(deliveries):
+            held.extend(deliveries)
+        self.start(handler)
+        self.broker.publish('q', 'same')
+        self.wait(lambda: held)
+        self.broker.drop()
+        held[0].ack()
+        self.broker.publish('q', 'same')
+        self.wait(lambda: len(held) == 3)
+        for delivery in held[1:]:
+            delivery.ack()
+        self.wait(self.settled)
+        self.assertEqual(self.listener.stats()['duplicates'], 0)
+
+    def test_handler_error_nacks_unsettled(self):
+        batches = []
+
+        def handler(deliveries):
+            batches.append(deliveries)
+            deliveries[0].ack()
+            if len(batches) == 1:
+                raise ValueError('boom')
+        self.start(handler, batch_size=2, batch_timeout=1)
+        self.broker.publish('q', 'a')
+        self.broker.publish('q', 'b')
+        self.wait(self.settled)
+        # a acked, b nacked once by the error and acked when redelivered
+        self.assertEqual([d.body for d in batches[1]], [b'b'])
+        self.assertEqual((self.broker.acked, self.broker.nacked), (2, 1))
+        self.assertEqual(self.listener.stats()['reconnects'], 0)
+
+    def test_fanout(self):
+        held = []
+
+        def handler(deliveries):
+            held.extend(deliveries)
+        self.start(handler)
+        for i in range(3):
+            self.broker.publish('q', 'm%d' % i)
+        self.wait(lambda: len(held) == 3)
+        sent, none, partly = [Fanout(d, 2) for d in held]
+        for fanout, results in ((sent, (True, True)), (none, (False, False)),
+                                (partly, (True, False))):
+            for res in results:
+                fanout.done(True, res)
+        self.wait(lambda: len(held) == 4)  # `none` is requeued
+        self.assertTrue(held[3].redelivered)
+        held[3].ack()
+        self.wait(self.settled)
+        self.assertEqual((self.broker.acked, self.broker.nacked), (2, 2))
+
+
+class StoreTest(unittest.TestCase):
+
+    def backend(self):
+        return None
+
+    def setUp(self):
+        self.store = Store(self.backend())
+        for i, (nick, remark) in enumerate(
+                [('a', 'x'), ('a', 'y'), ('b', 'x')]):
+            self.store.update('@%d' % i, Contact({
+                'UserName': '@%d' % i, 'NickName': nick,
+                'RemarkName': remark, 'Alias': None}, contact_type=1))
+
+    def names(self, contacts):
+        return sorted(c['UserName'] for c in contacts)
+
+    def test_select(self):
+        self.assertEqual(self.names(self.store.select(NickName='a')),
+                         ['@0', '@1'])
+        self.assertEqual(
+            self.names(self.store.select(NickName='a', RemarkName='x')),
+            ['@0'])
+        self.assertEqual(self.store.select(NickName='c'), [])
+        self.assertEqual(len(self.store.select(NickName='a', limit=1)), 1)
+        self.assertEqual(
+            self.store.select(first=True, RemarkName='y')['UserName'], '@1')
+
+    def test_select_unindexed_field(self):
+        self.assertEqual(
+            self.names(self.store.select(UserName='@2')), ['@2'])
+
+    def test_select_without_filter(self):
+        self.assertEqual(self.store.select(), [])
+        self.assertIsNone(self.store.select(first=True))
+
+    def test_reindex_on_update_and_delete(self):
+        self.store.update('@0', Contact({
+            'UserName': '@0', 'NickName': 'c', 'RemarkName': 'x'},
+            contact_type=1))
+        self.assertEqual(self.names(self.store.select(NickName='a')), ['@1'])
+        self.assertEqual(self.names(self.store.select(NickName='c')), ['@0'])
+        self.store.delete('@1')
+        self.assertEqual(self.store.select(NickName='a'), [])
+        self.assertIsNone(self.store.get('@1'))
+
+
+class SqliteStoreTest(StoreTest):
+
+    def backend(self):
+        self.dir = tempfile.TemporaryDirectory()
+        path = os.path.join(self.dir.name, 'contacts.sqlite3')
+        return lambda: SqliteCache(path)
+
+    def tearDown(self):
+        self.store.cache.conn.close()
+        self.dir.cleanup()
+
+
+class WarmStartTest(unittest.TestCase):
+
+    def test_default_backend_is_indexed(self):
+        store = Store()
+        self.assertIsInstance(store.cache, Cache)
+        self.assertTrue(store.indexes)
+
+    def test_reconcile_drops_stale_contacts(self):
+        bot = WeChatBot(auto_reload=False)
+        for user_name in ('@a', '@b', '@@g'):
+            bot.store.update(user_name, Contact(
+                {'UserName': user_name, 'NickName': user_name},
+                contact_type=2 if user_name.startswith('@@') else 1))
+        bot.get_contacts = lambda: {'MemberList': [
+            {'UserName': '@a', 'NickName': 'a', 'VerifyFlag': 0}]}
+        bot._init_all_contacts(reconcile=True)
+        self.assertEqual(sorted(bot.store.keys()), ['@@g', '@a'])
+        self.assertEqual(bot.store.get('@a')['NickName'], 'a')
+        self.assertEqual(bot.store.select(NickName='@b'), [])
+
+
+class AddNewContactTest(unittest.TestCase):
+
+    def test_chunk_failure_and_progress(self):
+        bot = WeChatBot(auto_reload=False)
+
+        def batch_get_contacts(user_list):
+            user_names = [user['UserName'] for user in user_list]
+            if '@b0' in user_names:
+                return {'BaseResponse': {'Ret': 1100}}
+            return {
+                'BaseResponse': {'Ret': 0},
+                'ContactList': [
+                    {'UserName': user_name, 'VerifyFlag': 0}
+                    for user_name in user_names],
+            }
+        bot.batch_get_contacts = batch_get_contacts
+        progress = []
+        user_list = [{'UserName': user_name}
+                     for user_name in ('@a0', '@a1', '@b0', '@b1', '@c0')]
+        with mock.patch.object(config, 'BATCH_CONTACT_SIZE', 2):
+            ret = bot.add_new_contact(
+                user_list, progress=lambda ret: progress.append(ret['done']))
+        self.assertEqual((ret['chunks'], ret['done']), (3, 3))
+        self.assertEqual(sorted(progress), [1, 2, 3])
+        self.assertEqual(
+            sorted(contact['UserName'] for contact in ret['contacts']),
+            ['@a0', '@a1', '@c0'])
+        self.assertEqual(len(ret['failed']), 1)
+        self.assertEqual(ret['failed'][0][0], user_list[2:4])
+        self.assertIsNotNone(bot.store.get('@c0'))
+        self.assertIsNone(bot.store.get('@b0'))
+
+
+class ContactResolverTest(unittest.TestCase):
+
+    def test_concurrent_lookups_share_one_fetch(self):
+        started, release = threading.Event(), threading.Event()
+        calls = []
+
+        def fetch(user_list):
+            calls.append([user['UserName'] for user in user_list])
+            started.set()
+            release.wait(5)
+            return {'contacts': [{'UserName': '@a'}]}
+        resolver = ContactResolver(fetch)
+        first = threading.Thread(target=resolver.resolve, args=(['@a'], ))
+        first.start()
+        self.assertTrue(started.wait(5))
+        second = threading.Thread(
+            target=resolver.resolve, args=(['@a', '@a'], ))
+        second.start()
+        second.join(0.05)
+        self.assertTrue(second.is_alive())
+        release.set()
+        first.join(5)
+        second.join(5)
+        self.assertFalse(second.is_alive())
+        self.assertEqual(calls, [['@a']])
+
+    def test_negative_cache_ttl(self):
+        calls = []
+
+        def fetch(user_list):
+            calls.append([user['UserName'] for user in user_list])
+            if len(calls) == 1:
+                return {'contacts': []}
+            raise ValueError('lookup failed')
+        resolver = ContactResolver(fetch, ttl=60)
+        with mock.patch('wechatpy.resolver.time') as clock:
+            clock.time.return_value = 1000
+            resolver.resolve(['@x'])
+            resolver.resolve(['@x'])
+            self.assertEqual(len(calls), 1)
+            clock.time.return_value = 1061
+            resolver.resolve(['@x'])
+            self.assertEqual(len(calls), 2)
+            # a failed fetch is cached too
+            resolver.resolve(['@x'])
+            self.assertEqual(len(calls), 2)
+
+
+class AssSessionTest(unittest.TestCase):
+
+    def session(self, statuses):
+        import requests
+        from .transport import AssSession
+        self.calls = []
+
+        def request(session, method, url, *args, **kwargs):
+            self.calls.append(url)
+            r = requests.Response()
+            r.status_code = statuses.pop(0) if statuses else 200
+            r.raw = mock.Mock()
+            return r
+        patcher = mock.patch.object(requests.Session, 'request', request)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        return AssSession()
+
+    def test_retries_with_backoff(self):
+        session = self.session([500, 502])
+        with mock.patch('wechatpy.transport.backoff',
+                        side_effect=lambda attempt: attempt / 10.0), \
+                mock.patch('wechatpy.transport.time') as clock:
+            r = session.get('https://wx.qq.com/cgi-bin/mmwebwx-bin/webwxinit')
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(len(self.calls), 3)
+        self.assertEqual(
+            [c[0][0] for c in clock.sleep.call_args_list], [0.1, 0.2])
+
+    def test_retry_budget(self):
+        from .transport import RetryBudget
+        session = self.session([500] * 10)
+        session.budget = RetryBudget(ratio=0, maximum=1)
+        with mock.patch('wechatpy.transport.backoff', return_value=0):
+            self.assertIsNone(session.get('https://wx.qq.com/x'))
+            self.assertEqual(len(self.calls), 2)
+            self.assertIsNone(session.get('https://wx.qq.com/x'))
+            self.assertEqual(len(self.calls), 3)
+
+    def test_breaker_fails_fast(self):
+        from .transport import CircuitBreaker
+        session = self.session([500] * 10)
+        session.breakers['wx.qq.com'] = CircuitBreaker(threshold=2, reset=30)
+        with mock.patch('wechatpy.transport.backoff', return_value=0):
+            self.assertIsNone(session.get('https://wx.qq.com/x'))
+            self.assertEqual(len(self.calls), 2)
+            self.assertIsNone(session.get('https://wx.qq.com/x'))
+            self.assertEqual(len(self.calls), 2)
+
+
+class SendSchedulerTest(unittest.TestCase):
+
+    def test_token_bucket(self):
+        bucket = TokenBucket(rate=1, capacity=1)
+        now = bucket.updated
+        self.assertEqual(bucket.take(now), 0)
+        self.assertAlmostEqual(bucket.take(now), 1)
+        self.assertEqual(bucket.take(now + 1), 0)
+
+    def test_pacing_per_recipient(self):
+        scheduler = SendScheduler(workers=2, rate=20, capacity=1)
+        times = {'a': [], 'b': []}
+        done = threading.Semaphore(0)
+
+        def send(key):
+            times[key].append(time.time())
+            return True
+
+        def callback(ok, res):
+            done.release()
+        try:
+            for key in 'aaab':
+                scheduler.submit(key, send, key, callback=callback)
+            for i in range(4):
+                self.assertTrue(done.acquire(timeout=5))
+        finally:
+            scheduler.stop()
+        gaps = [b - a for a, b in zip(times['a'], times['a'][1:])]
+        self.assertTrue(all(gap >= 0.04 for gap in gaps), gaps)
+        # b is not held back behind a
+        self.assertLess(times['b'][0], times['a'][1])
+        self.assertEqual(scheduler.stats()['sent'], 4)
+
+    def test_failed_task(self):
+        scheduler = SendScheduler(workers=1, rate=100)
+        results = []
+        done = threading.Event()
+
+        def fail():
+            raise ValueError('boom')
+
+        def callback(ok, res):
+            results.append((ok, res))
+            done.set()
+        try:
+            scheduler.submit('a', fail, callback=callback)
+            self.assertTrue(done.wait(5))
+        finally:
+            scheduler.stop()
+        self.assertFalse(results[0][0])
+        self.assertIsInstance(results[0][1], ValueError)
+        self.assertEqual(scheduler.stats()['failed'], 1)
+
+
+class MsgQueueTest(unittest.TestCase):
+
+    def test_drop_oldest(self):
+        q = MsgQueue(2, MsgQueue.DROP_OLDEST)
+        self.assertTrue(all(q.put(i) for i in range(3)))
+        self.assertEqual(q.drain(), [1, 2])
+        self.assertEqual(q.stats()['dropped'], 1)
+
+    def test_drop_newest(self):
+        q = MsgQueue(2, MsgQueue.DROP_NEWEST)
+        self.assertEqual([q.put(i) for i in range(3)], [True, True, False])
+        self.assertEqual(q.drain(), [0, 1])
+
+    def test_block(self):
+        q = MsgQueue(1, MsgQueue.BLOCK)
+        q.put(0)
+        self.assertFalse(q.put(1, timeout=0.01))
+        threading.Timer(0.05, q.get).start()
+        self.assertTrue(q.put(2, timeout=5))
+        self.assertEqual(q.drain(), [2])
+
+    def test_drain(self):
+        q = MsgQueue()
+        for i in range(5):
+            q.put(i)
+        self.assertEqual(q.drain(2), [0, 1])
+        self.assertEqual(q.drain(), [2, 3, 4])
+        self.assertEqual(q.drain(timeout=0.01), [])
+        self.assertRaises(Empty, q.get, timeout=0.01)
+
+    def test_unknown_policy(self):
+        self.assertRaises(ValueError, MsgQueue, 1, 'drop_all')
+
+
+class MetricsTest(unittest.TestCase):
+
+    def test_exposition(self):
+        registry = metrics.Registry()
+        sent = registry.counter('sent_total', 'Sent', ('bot', ))
+        sent.inc(bot='a')
+        sent.inc(2, bot='a"b')
+        registry.gauge('depth', 'Depth').set(3)
+        latency = registry.histogram(
+            'latency_seconds', 'Latency', buckets=(1, 0.1))
+        for value in (0.5, 0.5, 5):
+            latency.observe(value)
+        lines = registry.exposition().splitlines()
+        for line in (
+                '# HELP sent_total Sent',
+                '# TYPE sent_total counter',
+                'sent_total{bot="a"} 1',
+                'sent_total{bot="a\\"b"} 2',
+                '# TYPE depth gauge',
+                'depth 3',
+                '# TYPE latency_seconds histogram',
+                'latency_seconds_bucket{le="0.1"} 0',
+                'latency_seconds_bucket{le="1"} 2',
+                'latency_seconds_bucket{le="+Inf"} 3',
+                'latency_seconds_sum 6.0',
+                'latency_seconds_count 3'):
+            self.assertIn(line, lines)
+
+    def test_collector(self):
+        registry = metrics.Registry()
+        contacts = registry.gauge('contacts')
+
+        class Bot(object):
+            def collect(self):
+                contacts.set(7)
+        bot = Bot()
+        registry.collector(bot.collect)
+        self.assertIn('contacts 7', registry.exposition())
+        del bot
+        registry.collect()
+        self.assertEqual(registry.collectors, [])
+
+
+class ProfiledTest(unittest.TestCase):
+
+    def hook(self):
+        calls = []
+        hook = profiling.add_hook(
+            enter=lambda name: calls.append(('enter', name)),
+            exit=lambda name, seconds, error: calls.append(
+                ('exit', name, type(error))))
+        self.addCleanup(profiling.remove_hook, hook)
+        return calls
+
+    def test_hooks(self):
+        @profiling.profiled('f')
+        def f(fail):
+            if fail:
+                raise ValueError
+
+        @profiling.profiled('g')
+        async def g():
+            return 1
+        calls = self.hook()
+        f(False)
+        self.assertRaises(ValueError, f, True)
+        self.assertEqual(asyncio.run(g()), 1)
+        self.assertEqual(calls, [
+            ('enter', 'f'), ('exit', 'f', type(None)),
+            ('enter', 'f'), ('exit', 'f', ValueError),
+            ('enter', 'g'), ('exit', 'g', type(None)),
+        ])
+
+    def test_async_post_res_once(self):
+        from .aio import AsyncWeChatBot
+        bot = AsyncWeChatBot(auto_reload=False)
+        calls = self.hook()
+        res = asyncio.run(
+            bot._post_res(content=b'{"BaseResponse": {"Ret": 0}}'))
+        self.assertTrue(bot.request_ok(res))
+        self.assertEqual(calls, [
+            ('enter', '_post_res'), ('exit', '_post_res', type(None))])
+
+
+class FakeServerTest(unittest.TestCase):
+
+    def test_round_trip(self):
+        from .fake_server import FakeWeChatServer
+        server = FakeWeChatServer(
+            contacts=5, groups=2, members=3, long_poll=1).start()
+        self.addCleanup(server.stop)
+        bot = WeChatBot(auto_reload=False)
+        bot.gen_qr_code = lambda *args, **kwargs: None
+        with mock.patch.object(config, 'ROOT_URL', server.url):
+            self.assertTrue(bot.login())
+        self.assertTrue(bot.status_notify())
+        bot._init_all_contacts()
+        for user_name in list(server.contacts) + list(server.groups):
+            self.assertIsNotNone(bot.store.get(user_name))
+
+        server.inject(3, group=False)
+        self.assertEqual(bot.sync_check(), ('0', '2'))
+        sync_key = bot.cache.sync_key_str
+        res = bot.sync()
+        self.assertEqual(len(res['AddMsgList']), 3)
+        self.assertNotEqual(bot.cache.sync_key_str, sync_key)
+
+        user_name = next(iter(server.contacts))
+        self.assertTrue(bot._send_msg('hi', user_name))
+        self.assertEqual(server.sent[-1]['ToUserName'], user_name)
+        server.logout()
+        self.assertEqual(bot.sync_check()[0], '1101')
+
+
+class RunManyTest(unittest.TestCase):
+
+    def test_accounts_are_isolated(self):
+        from . import main
+        d = tempfile.mkdtemp()
+        bots = []
+
+        def run(bot):
+            bots.append(bot)
+            bot.sync_check = lambda: ('1101', '0')
+            with mock.patch('wechatpy.core.backoff', return_value=0):
+                bot._proc_msg()
+        settings = mock.Mock(QR_DIR=d)
+        with mock.patch.object(config, 'STORE_PATH',
+                               os.path.join(d, 'contacts.sqlite3')), \
+                mock.patch.object(main, 'Listener'), \
+                mock.patch.object(main.AssBot, 'run', run):
+            main.run_many(
+                [{'name': 'a', 'store_backend': SqliteCache},
+                 {'name': 'b', 'store_backend': SqliteCache}],
+                settings=settings, mailer=mock.Mock())
+        a, b = sorted(bots, key=lambda bot: bot.name)
+        self.assertIsNot(a.session, b.session)
+        self.assertNotEqual(a.session_path, b.session_path)
+        a.store.update('@x', Contact({'UserName': '@x'}, contact_type=3))
+        a.store.flush()
+        self.assertIsNone(b.store.get('@x'))
+        self.assertTrue(os.path.exists(os.path.join(d, 'contacts.a.sqlite3')))
+        self.assertTrue(os.path.exists(os.path.join(d, 'contacts.b.sqlite3')))
+        exposition = metrics.REGISTRY.exposition()
+        for name in ('a', 'b'):
+            self.assertIn('wechatpy_synccheck_total{bot="%s",retcode="1101"'
+                          % name, exposition)
+
+
+class MemberCacheTest(unittest.TestCase):
+
+    def test_lru_by_entries(self):
+        cache = MemberCache(max_entries=4)
+        cache.set('@@a', {'@1': None, '@2': None})
+        cache.set('@@b', {'@3': None, '@4': None})
+        cache.get('@@a')
+        cache.set('@@c', {'@5': None})
+        self.assertIn('@@a', cache)
+        self.assertNotIn('@@b', cache)
+        self.assertIsNone(cache.get('@@b'))
+        self.assertEqual(cache.stats()['evictions'], 1)
+
+    def test_oversized_group_is_kept(self):
+        cache = MemberCache(max_entries=1)
+        cache.set('@@a', {'@1': None, '@2': None})
+        self.assertIn('@@a', cache)
+
+
+class RecordsTest(unittest.TestCase):
+
+    def test_contact(self):
+        contact = Contact({'UserName': '@a', 'NickName': 'a', 'Sex': 1},
+                          contact_type=1, keep_raw=False)
+        self.assertEqual(contact['NickName'], 'a')
+        self.assertEqual(contact.get('Alias', 'x'), 'x')
+        self.assertRaises(KeyError, lambda: contact['Sex'])
+        self.assertEqual(contact.to_dict()['ContactType'], 1)
+
+    def test_keep_raw(self):
+        contact = Contact({'UserName': '@a', 'Sex': 1}, keep_raw=True)
+        self.assertEqual(contact['Sex'], 1)
+        self.assertIn('Sex', contact)
+
+    def test_message(self):
+        msg = Message({'MsgId': '1', 'FromUserName': '@a'})
+        msg['FromUser'] = Contact({'UserName': '@a'})
+        self.assertEqual(msg.to_dict()['FromUser']['UserName'], '@a')
+        self.assertRaises(KeyError, msg.__setitem__, 'Foo', 1)
+
+
+class MediaTest(unittest.TestCase):
+
+    def test_multipart_body(self):
+        body = MultipartBody(
+            [('name', 'a.txt'), ('size', 5)], 'filename', 'a.txt', b'x' * 5)
+        with mock.patch.object(config, 'MEDIA_STREAM_CHUNK', 2):
+            parts = [bytes(part) for part in body]
+            self.assertEqual(b''.join(parts),
+                             b''.join(bytes(part) for part in body))
+        data = b''.join(parts)
+        self.assertEqual(len(data), len(body))
+        self.assertEqual(parts[1:-1], [b'xx', b'xx', b'x'])
+        self.assertIn(b'name="size"\r\n\r\n5\r\n', data)
+        self.assertTrue(data.startswith(
+            ('--%s\r\n' % body.boundary).encode('utf-8')))
+        self.assertTrue(data.endswith(
+            ('\r\n--%s--\r\n' % body.boundary).encode('utf-8')))
+        self.assertIn(body.boundary, body.content_type)
+
+    def test_upload_send_download(self):
+        from .fake_server import FakeWeChatServer
+        server = FakeWeChatServer(media_size=100000).start()
+        self.addCleanup(server.stop)
+        bot = WeChatBot(auto_reload=False)
+        self.addCleanup(bot.media.shutdown)
+        url = '%s/cgi-bin/mmwebwx-bin' % server.url
+        for key, value in (
+                ('ticket', url), ('file_url', url), ('pass_ticket', 'fake'),
+                ('skey', 'fake'), ('base_request', {}),
+                ('self', {'UserName': '@me'})):
+            bot.cache.set(key, value)
+        bot.store.update('@a', Contact(
+            {'UserName': '@a', 'NickName': 'a'}, contact_type=3))
+        d = tempfile.mkdtemp()
+        path = os.path.join(d, 'a.txt')
+        with open(path, 'wb') as fp:
+            fp.write(os.urandom(3000))
+        with mock.patch.object(config, 'MEDIA_CHUNK_SIZE', 1024):
+            self.assertEqual(bot.send_file(path, NickName='a'), [1])
+        self.assertGreater(server.uploaded, 3000)
+        self.assertEqual(server.sent[-1]['Type'], 6)
+
+        target = os.path.join(d, 'image')
+        future = bot.download({'MsgId': '1', 'MsgType': 3}, target)
+        self.assertEqual(future.result(5), target)
+        self.assertEqual(os.path.getsize(target), 100000)
+        self.assertIsNone(bot.download({'MsgId': '2', 'MsgType': 1}))
+
+
+class MsgIdIndexTest(unittest.TestCase):
+
+    def test_duplicates(self):
+        index = MsgIdIndex(max_entries=10, window=60)
+        self.assertFalse(index.seen('1', now=0))
+        self.assertTrue(index.seen('1', now=1))
+        self.assertFalse(index.seen('2', now=1))
+        self.assertEqual(index.stats()['duplicates'], 1)
+
+    def test_window(self):
+        index = MsgIdIndex(max_entries=10, window=60)
+        index.seen('1', now=0)
+        self.assertFalse(index.seen('1', now=61))
+        self.assertEqual(index.stats()['expired'], 1)
+
+    def test_max_entries(self):
+        index = MsgIdIndex(max_entries=2, window=60)
+        for i, msg_id in enumerate('123'):
+            index.seen(msg_id, now=i)
+        self.assertEqual(len(index), 2)
+        self.assertNotIn('1', index)
+        self.assertFalse(index.seen('1', now=3))
+
+    def test_handle_msg_drops_redeliveries(self):
+        bot = WeChatBot(auto_reload=False)
+        bot.store.update('@a', Contact(
+            {'UserName': '@a', 'NickName': 'a'}, contact_type=1))
+        res = {'AddMsgList': [
+            {'MsgId': '1', 'FromUserName': '@a', 'Content': 'hi'},
+            {'MsgId': '2', 'FromUserName': '@a', 'Content': 'hi'},
+        ]}
+        self.assertEqual(len(bot.handle_msg(res)), 2)
+        res['AddMsgList'].append(
+            {'MsgId': '3', 'FromUserName': '@a', 'Content': 'hi'})
+        msgs = bot.handle_msg(res)
+        self.assertEqual([msg['MsgId'] for msg in msgs], ['3'])
+        self.assertEqual(bot.store.seen.stats()['duplicates'], 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
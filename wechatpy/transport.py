@@ -0,0 +1,91 @@
+""" Transport
+  AssSession, a requests.Session with:
+    - connection pools sized per host, `config.POOL_SIZES`, optionally
+      shared by the sessions of several accounts
+    - per endpoint (connect, read) timeouts, `config.TIMEOUTS`
+    - exponential backoff with jitter between retries
+    - a retry budget shared by all requests of the session
+    - a circuit breaker per host
+  the last three from `policy`.
+"""
+
+import time
+import logging
+import threading
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from . import config
+from .policy import endpoint, backoff, RetryBudget, CircuitBreaker, pool_hosts
+
+log = logging.getLogger('assbot')
+
+
+def pool_adapters(pool_sizes=None, scale=1):
+    """ {prefix: HTTPAdapter}, pools of `scale` times the sizes, to share
+    between the sessions of `scale` accounts
+    """
+    pool_sizes = pool_sizes or config.POOL_SIZES
+    adapters = {}
+    for prefix, pool in pool_hosts().items():
+        size = pool_sizes.get(pool, requests.adapters.DEFAULT_POOLSIZE)
+        adapters[prefix] = HTTPAdapter(
+            pool_connections=1, pool_maxsize=size * scale, pool_block=True)
+    return adapters
+
+
+class AssSession(requests.Session):
+    """
+    Cookies, retry budget and breakers are per session, `adapters` from
+    `pool_adapters` share the connection pools between sessions.
+    """
+
+    def __init__(self, pool_sizes=None, adapters=None):
+        super(AssSession, self).__init__()
+        adapters = adapters or pool_adapters(pool_sizes)
+        for prefix, adapter in adapters.items():
+            self.mount(prefix, adapter)
+        self.budget = RetryBudget()
+        self.breakers = {}
+        self.breakers_lock = threading.Lock()
+
+    def breaker(self, host):
+        with self.breakers_lock:
+            breaker = self.breakers.get(host)
+            if breaker is None:
+                breaker = self.breakers[host] = CircuitBreaker()
+            return breaker
+
+    def retry_after(self, url):
+        """ Seconds until the breaker of the host of `url` allows a probe """
+        return self.breaker(urlsplit(url).netloc).retry_after()
+
+    def request(self, method, url, *args, **kwargs):
+        """ None when the host is broken or the retries run out """
+        kwargs.setdefault(
+            'timeout', config.TIMEOUTS.get(endpoint(url), config.DEFAULT_TIMEOUT))
+        breaker = self.breaker(urlsplit(url).netloc)
+        self.budget.deposit()
+        attempt = 0
+        while True:
+            if not breaker.allow():
+                log.error('Circuit Open, %s %s' % (method, url))
+                return None
+            try:
+                r = super(AssSession, self).request(method, url, *args, **kwargs)
+            except requests.RequestException as e:
+                error = repr(e)
+            else:
+                if r.status_code < 500:
+                    breaker.success()
+                    return r
+                error = 'HTTP %d' % r.status_code
+                r.close()
+            breaker.failure()
+            attempt += 1
+            if attempt >= config.MAX_RETRY or not self.budget.withdraw():
+                log.error('Request Error, %s %s: %s' % (method, url, error))
+                return None
+            time.sleep(backoff(attempt))